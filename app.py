@@ -1,19 +1,30 @@
 # app.py
 import streamlit as st
 import os
+import time
 from utils.template_utils import (
-    load_all_templates, 
-    get_template_by_id,
     fill_template,
-    extract_template_variables,
-    filter_templates_by_dimensions
+    extract_template_variables
 )
 from utils.llm_utils import (
     initialize_llm,
     recommend_templates,
-    adjust_template_to_use_case,
-    refine_output,
-    fully_adapt_template  # Import the new function
+    adjust_template_to_use_case
+)
+from utils.template_registry import get_registry
+from utils.recommender import get_recommender
+from utils.session_store import get_session_store
+from utils.job_executor import (
+    JOB_POLL_INTERVAL,
+    get_job_executor,
+    submit_adaptation,
+    submit_refinement
+)
+from utils.instrumentation import (
+    SHOW_DIAGNOSTICS,
+    start_metrics_server,
+    metrics_snapshot,
+    recent_spans
 )
 from utils.dimension_definitions import (
     get_scale_options,
@@ -32,36 +43,74 @@ st.set_page_config(
 # Initialize session state variables if they don't exist
 if "step" not in st.session_state:
     st.session_state.step = 1
-if "selected_template" not in st.session_state:
-    st.session_state.selected_template = None
-if "filled_template" not in st.session_state:
-    st.session_state.filled_template = ""
-if "chat_history" not in st.session_state:
-    st.session_state.chat_history = []
-if "llm" not in st.session_state:
-    st.session_state.llm = None
 if "user_description" not in st.session_state:
     st.session_state.user_description = ""
 if "selected_scale" not in st.session_state:
     st.session_state.selected_scale = None
 if "selected_engagement" not in st.session_state:
     st.session_state.selected_engagement = None
+if "pending_adaptation" not in st.session_state:
+    st.session_state.pending_adaptation = False
+if "pending_refinement" not in st.session_state:
+    st.session_state.pending_refinement = None
+if "llm_notice" not in st.session_state:
+    st.session_state.llm_notice = None
+if "active_job" not in st.session_state:
+    st.session_state.active_job = None
+
+# Templates are parsed once per process and shared by every session
+template_registry = get_registry()
+recommender = get_recommender()
+
+# The selected template id, its revisions and the chat live in the shared session store,
+# which keeps them compact and spills idle sessions to disk
+session_store = get_session_store()
+if "session_id" not in st.session_state:
+    st.session_state.session_id = session_store.new_session_id()
+session = session_store.get(st.session_state.session_id)
+
+# The LLM client is shared by every session and checked in the background.
+# Until the check passes we run in fallback mode (the LLM is optional).
+shared_llm = initialize_llm()
+llm = shared_llm if shared_llm and shared_llm.is_ready() else None
+
+# Prometheus metrics are served on METRICS_PORT when it is set
+start_metrics_server()
+
+# LLM generations run on a shared worker pool; the page polls them instead of waiting
+job_executor = get_job_executor()
+# Streamlit versions with fragments refresh just the preview; older ones rerun the page
+run_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+poll_active_job = False
+
+def start_job(job):
+    """Make job the session's active job, dropping the one it supersedes."""
+    if st.session_state.active_job and st.session_state.active_job != job.id:
+        job_executor.cancel(st.session_state.active_job, st.session_state.session_id)
+    st.session_state.active_job = job.id
+
+def show_job_progress(job_id):
+    """Show the output of a running job so far, rerunning the page once it finishes."""
+    job = job_executor.get(job_id)
+    if job is None or job.done:
+        st.rerun()
+    if job.kind == "adapt":
+        st.caption("Adapting the template to your use case...")
+        st.markdown(job.text() or "_Waiting for the model..._")
+    else:
+        st.caption("Refining template...")
+        st.markdown(job.text() or session.revisions.current)
 
 # Initialize the app if it hasn't been initialized yet
-if "templates" not in st.session_state:
-    with st.spinner("Initializing application..."):
-        # Load all templates
-        templates = load_all_templates()
-        st.session_state.templates = templates
-        
-        # Initialize the LLM (this is optional - will use keyword-based fallback if not available)
-        llm = initialize_llm()
-        st.session_state.llm = llm
-        
-        if llm:
-            st.success("✅ LLM loaded successfully!")
-        else:
-            st.info("ℹ️ Running in fallback mode without LLM capabilities")
+if "initialized" not in st.session_state:
+    st.session_state.initialized = True
+    
+    if llm:
+        st.success("✅ LLM loaded successfully!")
+    elif shared_llm and shared_llm.health_status == "unknown":
+        st.info("ℹ️ Connecting to the LLM in the background - running in fallback mode until it is ready")
+    else:
+        st.info("ℹ️ Running in fallback mode without LLM capabilities")
 
 # App title
 st.title("Participatory Design Template Generator")
@@ -140,12 +189,15 @@ elif st.session_state.step == 2:
 elif st.session_state.step == 3:
     st.header("3. Select a Template")
     
-    # Filter templates based on selected dimensions
-    filtered_templates = filter_templates_by_dimensions(
-        st.session_state.templates,
-        st.session_state.selected_scale,
-        st.session_state.selected_engagement
-    )
+    # Templates matching the selected dimensions, best match for the use case first.
+    # Rankings are cached, so reruns of this step don't rank again or call the LLM.
+    with st.spinner("Finding the best templates for your use case..."):
+        filtered_templates = recommender.recommend(
+            st.session_state.user_description,
+            scale=st.session_state.selected_scale,
+            engagement=st.session_state.selected_engagement,
+            llm=llm
+        )
     
     if filtered_templates:
         st.success(f"Found {len(filtered_templates)} templates matching your criteria")
@@ -157,20 +209,11 @@ elif st.session_state.step == 3:
                 st.markdown(f"*{template['description']}*")
                 
                 if st.button(f"Select this Template", key=f"select_{i}"):
-                    selected_template = get_template_by_id(template["id"])
-                    st.session_state.selected_template = selected_template
-                    
-                    # Use the new function to fully adapt the template to the user's use case
-                    with st.spinner("Adapting template to your use case..."):
-                        adapted_template = fully_adapt_template(
-                            selected_template,
-                            st.session_state.user_description,
-                            st.session_state.llm
-                        )
-                        
-                        # Set the adapted template as the filled template
-                        st.session_state.filled_template = adapted_template
+                    session.template_key = template_registry.key_of(template)
                     
+                    # The adaptation is streamed into the Step 4 preview
+                    session.revisions.reset()
+                    st.session_state.pending_adaptation = True
                     st.session_state.step = 4
                     st.rerun()
                 
@@ -185,7 +228,57 @@ elif st.session_state.step == 3:
 
 # Step 4: Refinement through conversation (Combined customization and chat)
 elif st.session_state.step == 4:
-    st.header(f"4. Refine Template: {st.session_state.selected_template['name']}")
+    selected_template = template_registry.get_by_key(session.template_key)
+    if selected_template is None:
+        # Removed from the library since it was selected
+        st.session_state.step = 3
+        st.rerun()
+    
+    st.header(f"4. Refine Template: {selected_template['name']}")
+    
+    # Start any requested generation in the background
+    if st.session_state.pending_adaptation:
+        start_job(submit_adaptation(
+            selected_template,
+            st.session_state.user_description,
+            llm,
+            st.session_state.session_id
+        ))
+        st.session_state.pending_adaptation = False
+    
+    if st.session_state.pending_refinement:
+        # A newer request supersedes a refinement that is still running
+        start_job(submit_refinement(
+            session.revisions.current,
+            st.session_state.pending_refinement,
+            llm,
+            st.session_state.session_id
+        ))
+        st.session_state.pending_refinement = None
+    
+    # Collect the result of a finished job
+    job = job_executor.get(st.session_state.active_job)
+    if st.session_state.active_job and (job is None or job.done):
+        if job is None:
+            pass  # Expired before this session came back for it
+        elif job.kind == "adapt":
+            # The adapted template is the first revision; there is nothing before it to undo to
+            if job.status == "done":
+                session.revisions.reset(job.result)
+            else:
+                session.revisions.reset(selected_template.get("content", ""))
+                st.session_state.llm_notice = f"The template could not be adapted ({job.error}); showing the original."
+        elif job.status != "cancelled":
+            if job.status == "done":
+                session.revisions.commit(job.result)
+                reply = "I've updated the template based on your request."
+            else:
+                reply = f"Sorry, I couldn't update the template this time ({job.error}). Please try again."
+            
+            # Add assistant message to chat history
+            session.chat.append("assistant", reply)
+        st.session_state.active_job = None
+        job = None
     
     # Create two columns for chat and preview
     col1, col2 = st.columns(2)
@@ -194,14 +287,14 @@ elif st.session_state.step == 4:
         st.subheader("Conversation")
         
         # Add initial message if chat history is empty
-        if not st.session_state.chat_history:
-            st.session_state.chat_history.append({
-                "role": "assistant",
-                "content": "I've adapted the template to your use case. You can review it on the right and ask me to make any specific changes or improvements."
-            })
+        if not session.chat:
+            session.chat.append(
+                "assistant",
+                "I've adapted the template to your use case. You can review it on the right and ask me to make any specific changes or improvements."
+            )
         
         # Display chat history
-        for message in st.session_state.chat_history:
+        for message in session.chat:
             if message["role"] == "user":
                 st.markdown(f"**You**: {message['content']}")
             else:
@@ -210,42 +303,47 @@ elif st.session_state.step == 4:
         # Input for refinement
         user_feedback = st.text_area("How would you like to refine the template?", "", height=100)
         
-        if st.button("Send Request"):
+        # There is nothing to refine until the adaptation has finished
+        if st.button("Send Request", disabled=job is not None and job.kind == "adapt"):
             if user_feedback:
                 # Add user message to chat history
-                st.session_state.chat_history.append({"role": "user", "content": user_feedback})
+                session.chat.append("user", user_feedback)
                 
-                # Process the feedback using the LLM
-                with st.spinner("Refining template..."):
-                    refined_output = refine_output(
-                        st.session_state.filled_template,
-                        user_feedback,
-                        st.session_state.llm
-                    )
-                    
-                    # Update the filled template
-                    st.session_state.filled_template = refined_output
-                    
-                    # Add assistant message to chat history
-                    st.session_state.chat_history.append({
-                        "role": "assistant", 
-                        "content": "I've updated the template based on your request."
-                    })
+                # The refinement starts in the background on the next run
+                st.session_state.pending_refinement = user_feedback
                 
                 # Force a rerun to update the UI
                 st.rerun()
     
     with col2:
         st.subheader("Template Preview")
-        st.markdown(st.session_state.filled_template)
         
-        # Download option
-        st.download_button(
-            label="Download Template as Markdown",
-            data=st.session_state.filled_template,
-            file_name="participatory_design_template.md",
-            mime="text/markdown"
-        )
+        if st.session_state.llm_notice:
+            st.warning(st.session_state.llm_notice)
+            st.session_state.llm_notice = None
+        
+        if job is not None:
+            # Render the output as it is generated
+            if run_fragment:
+                run_fragment(run_every=JOB_POLL_INTERVAL)(show_job_progress)(job.id)
+            else:
+                show_job_progress(job.id)
+                poll_active_job = True
+        else:
+            filled_template = session.revisions.current
+            st.markdown(filled_template)
+            
+            # Download option
+            st.download_button(
+                label="Download Template as Markdown",
+                data=filled_template,
+                file_name="participatory_design_template.md",
+                mime="text/markdown"
+            )
+            
+            if st.button("Undo Last Change", disabled=not session.revisions.can_undo) and session.revisions.undo() is not None:
+                session.chat.append("assistant", "I've undone the last change to the template.")
+                st.rerun()
     
     # Back button
     if st.button("Back to Templates"):
@@ -255,10 +353,12 @@ elif st.session_state.step == 4:
 # Reset button (available on all steps)
 if st.button("Start Over"):
     # Reset all relevant session state variables
+    job_executor.cancel(st.session_state.active_job, st.session_state.session_id)
+    st.session_state.active_job = None
     st.session_state.step = 1
-    st.session_state.selected_template = None
-    st.session_state.filled_template = ""
-    st.session_state.chat_history = []
+    session.reset()
+    st.session_state.pending_adaptation = False
+    st.session_state.pending_refinement = None
     st.session_state.user_description = ""
     st.session_state.selected_scale = None
     st.session_state.selected_engagement = None
@@ -266,6 +366,28 @@ if st.button("Start Over"):
     # Force a rerun to update the UI
     st.rerun()
 
+# Diagnostics panel (set SHOW_DIAGNOSTICS=1 to enable)
+if SHOW_DIAGNOSTICS:
+    with st.expander("Diagnostics"):
+        snapshot = metrics_snapshot()
+        st.markdown("**Stage timings**")
+        st.dataframe([dict(stats, span=name) for name, stats in snapshot["spans"].items()],
+                     column_order=["span", "count", "errors", "avg_ms", "max_ms", "total_s"])
+        st.markdown("**Counters**")
+        st.dataframe([
+            {"counter": counter["name"],
+             "labels": ", ".join(f"{key}={value}" for key, value in counter["labels"].items()),
+             "value": counter["value"]}
+            for counter in snapshot["counters"]
+        ])
+        st.markdown("**Recent spans**")
+        st.json(recent_spans(20), expanded=False)
+
 # Footer
 st.markdown("---")
-st.markdown("Participatory Design Template Generator - Powered by HuggingFace & Streamlit")
\ No newline at end of file
+st.markdown("Participatory Design Template Generator - Powered by HuggingFace & Streamlit")
+
+# Without fragments, poll a running job by rerunning the whole page
+if poll_active_job:
+    time.sleep(JOB_POLL_INTERVAL)
+    st.rerun()
\ No newline at end of file
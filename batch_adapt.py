@@ -0,0 +1,194 @@
+# batch_adapt.py
+"""Adapt templates for many use cases without the Streamlit app.
+
+    python batch_adapt.py use_cases.jsonl --output-dir batch_output --workers 4
+
+The input is a JSONL or CSV file with one use case per row: a
+`description` (or `use_case`) field and optional `id`, `scale`,
+`engagement` and `template` (template id, skipping recommendation) fields.
+
+Each adapted template is written to `<output-dir>/<id>.md` as soon as it is
+done (use cases whose ids map to an already used file name fail), and a
+line is appended to `<output-dir>/results.jsonl`. With an LLM, a use case
+whose adaptation failed is recorded as an error. Re-running with the same
+output directory resumes: use cases that already succeeded are skipped.
+"""
+import os
+import re
+import csv
+import sys
+import json
+import time
+import argparse
+import threading
+import concurrent.futures
+from typing import List, Dict, Any, Iterator, Optional
+
+from utils.template_registry import get_registry
+from utils.llm_utils import initialize_llm, recommend_templates, fully_adapt_template
+
+RESULTS_FILE = "results.jsonl"
+
+def read_use_cases(path: str) -> Iterator[Dict[str, Any]]:
+    """Yield use cases from a JSONL or CSV file, giving each an id (its row number if none is set)."""
+    with open(path, 'r', encoding='utf-8', newline='') as file:
+        if path.lower().endswith(".csv"):
+            rows = csv.DictReader(file)
+        else:
+            rows = (json.loads(line) for line in file if line.strip())
+        for number, row in enumerate(rows, start=1):
+            row = {key.strip().lower(): value for key, value in row.items() if key}
+            row["description"] = (row.get("description") or row.get("use_case") or "").strip()
+            row["id"] = str(row.get("id") or number).strip()
+            yield row
+
+def output_name(item_id: str) -> str:
+    """File name for a use case's adapted template."""
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", item_id).strip("._") or "item"
+
+def completed_ids(output_dir: str) -> set:
+    """Ids of use cases that already have a successful result, for resuming."""
+    done = set()
+    try:
+        with open(os.path.join(output_dir, RESULTS_FILE), 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue  # A line cut short by an interrupted run
+                if result.get("status") == "ok" and os.path.exists(os.path.join(output_dir, result["output"])):
+                    done.add(result["id"])
+    except FileNotFoundError:
+        pass
+    return done
+
+def adapt_use_case(item: Dict[str, Any], registry, llm, output_dir: str) -> Dict[str, Any]:
+    """Filter, recommend and adapt a template for one use case, writing the result to disk."""
+    started = time.perf_counter()
+    result = {"id": item["id"], "status": "error", "template_id": None, "output": None}
+    try:
+        if not item["description"]:
+            raise ValueError("empty description")
+
+        if item.get("template"):
+            template = registry.get(item["template"])
+            if template is None:
+                raise ValueError(f"unknown template {item['template']!r}")
+        else:
+            candidates = registry.filter_by_dimensions(scale=item.get("scale"), engagement=item.get("engagement"))
+            if not candidates:
+                raise ValueError("no templates match the selected scale and engagement")
+            template = recommend_templates(item["description"], candidates, llm)[0]
+
+        adapted = fully_adapt_template(template, item["description"], llm)
+        if llm is not None and adapted == template.get("content", ""):
+            # fully_adapt_template falls back to the original when the LLM fails; don't mark that done
+            raise RuntimeError("adaptation failed, the template was left unchanged")
+
+        filename = output_name(item["id"]) + ".md"
+        tmp_path = os.path.join(output_dir, filename + ".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            file.write(adapted)
+        os.replace(tmp_path, os.path.join(output_dir, filename))
+
+        result.update(status="ok", template_id=template.get("id"), output=filename, chars=len(adapted),
+                      adapted=adapted != template.get("content", ""))
+    except Exception as e:
+        result["error"] = str(e)
+    result["seconds"] = round(time.perf_counter() - started, 3)
+    return result
+
+def wait_for_llm(timeout: float):
+    """Return the shared LLM once its health check passes, or None to run without it."""
+    llm = initialize_llm()
+    if llm is None:
+        return None
+    deadline = time.monotonic() + timeout
+    while not llm.is_ready():
+        if llm.health_status == "error" or time.monotonic() >= deadline:
+            print("LLM unavailable; templates will be recommended locally and left unadapted.")
+            return None
+        time.sleep(0.2)
+    return llm
+
+def run_batch(input_path: str, output_dir: str, workers: int = 4, template_dir: str = "templates",
+              llm=None, resume: bool = True) -> Dict[str, Any]:
+    """Adapt every use case in input_path on a bounded worker pool; returns summary statistics."""
+    os.makedirs(output_dir, exist_ok=True)
+    registry = get_registry(template_dir)
+    skip = completed_ids(output_dir) if resume else set()
+
+    summary = {"ok": 0, "error": 0, "skipped": 0}
+    latencies: List[float] = []
+    results_lock = threading.Lock()
+    started = time.perf_counter()
+
+    with open(os.path.join(output_dir, RESULTS_FILE), 'a', encoding='utf-8') as results_file, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+
+        def record(result: Dict[str, Any]):
+            with results_lock:
+                results_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+                results_file.flush()
+                summary[result["status"]] += 1
+                latencies.append(result["seconds"])
+                done = summary["ok"] + summary["error"]
+                status = result["status"] if result["status"] == "ok" else f"error: {result.get('error')}"
+                print(f"[{done}] {result['id']} -> {result.get('template_id')} ({result['seconds']:.1f}s) {status}")
+
+        # Keep at most two use cases queued per worker, so huge inputs aren't read into memory at once
+        in_flight = set()
+        # Output file name -> id of the use case writing it, so duplicate ids can't overwrite each other
+        outputs: Dict[str, str] = {}
+        for item in read_use_cases(input_path):
+            filename = output_name(item["id"]) + ".md"
+            if filename in outputs:
+                record({"id": item["id"], "status": "error", "template_id": None, "output": None, "seconds": 0.0,
+                        "error": f"duplicate id: {filename} is already used by {outputs[filename]!r}"})
+                continue
+            outputs[filename] = item["id"]
+            if item["id"] in skip:
+                summary["skipped"] += 1
+                continue
+            if len(in_flight) >= workers * 2:
+                finished, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    record(future.result())
+            in_flight.add(executor.submit(adapt_use_case, item, registry, llm, output_dir))
+        for future in concurrent.futures.as_completed(in_flight):
+            record(future.result())
+
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    summary.update(
+        elapsed=elapsed,
+        throughput=(summary["ok"] + summary["error"]) / elapsed if elapsed else 0.0,
+        p50=latencies[len(latencies) // 2] if latencies else 0.0,
+        p95=latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0,
+    )
+    return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Adapt templates for a file of use cases.")
+    parser.add_argument("input", help="JSONL or CSV file of use cases")
+    parser.add_argument("--output-dir", default="batch_output")
+    parser.add_argument("--workers", type=int, default=4, help="use cases adapted in parallel")
+    parser.add_argument("--template-dir", default="templates")
+    parser.add_argument("--no-llm", action="store_true", help="recommend locally and skip adaptation")
+    parser.add_argument("--no-resume", action="store_true", help="redo use cases that already succeeded")
+    parser.add_argument("--llm-wait", type=float, default=15.0, help="seconds to wait for the LLM health check")
+    args = parser.parse_args(argv)
+
+    llm = None if args.no_llm else wait_for_llm(args.llm_wait)
+    summary = run_batch(args.input, args.output_dir, max(1, args.workers), args.template_dir,
+                        llm, resume=not args.no_resume)
+
+    print(f"\n{summary['ok']} adapted, {summary['error']} failed, {summary['skipped']} skipped (already done)")
+    print(f"{summary['elapsed']:.1f}s total, {summary['throughput']:.2f} use cases/s, "
+          f"p50 {summary['p50']:.1f}s, p95 {summary['p95']:.1f}s per use case")
+    if llm is not None and llm.response_cache is not None:
+        print(f"Response cache hit rate: {llm.response_cache.hit_rate():.0%}")
+    return 1 if summary["error"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,214 @@
+# benchmarks/bench_pipeline.py
+"""Latency, throughput and memory benchmark of the template pipeline, run offline.
+
+    python benchmarks/bench_pipeline.py --sizes 3 100 1000 --concurrency 1 4 16
+    python benchmarks/bench_pipeline.py --compare benchmarks/results/<earlier run>.json
+
+The LLM is a deterministic StubLLM (utils/llm_stub.py), so numbers measure
+our own code plus the simulated model latency, and are comparable between
+versions. Each stage is run at every library size and concurrency level;
+results are written as JSON under benchmarks/results/.
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import platform
+import subprocess
+import tracemalloc
+import contextlib
+import concurrent.futures
+from typing import List, Dict, Any, Callable
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yaml
+
+from utils.template_registry import TemplateRegistry
+from utils.llm_stub import StubLLM
+from utils.llm_utils import (
+    recommend_templates,
+    fully_adapt_template,
+    refine_output,
+    refine_output_incremental
+)
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+SOURCE_TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "templates")
+
+USE_CASES = [
+    "Redesigning a neighbourhood park with residents and local businesses",
+    "Gathering student feedback on the new school lunch menu",
+    "Planning a community garden with volunteers of all ages",
+    "Setting priorities for a city cycling network with commuters",
+    "Collecting staff ideas for a hybrid office layout",
+    "Co-designing a library makerspace with teenagers",
+]
+
+FEEDBACK = [
+    "Make step 3 more specific to a school setting",
+    "Add a short icebreaker to the welcome step",
+    "Rewrite the whole template in a more formal tone",
+]
+
+EXTRA_WORDS = ("housing", "transport", "health", "youth", "climate", "library", "market", "safety",
+               "heritage", "water", "energy", "schools", "elders", "arts", "sports", "tourism")
+
+def build_library(source_dir: str, target_dir: str, size: int, seed: int = 0):
+    """Write `size` synthetic templates, varied copies of the ones in source_dir."""
+    rng = random.Random(seed)
+    base = []
+    for filename in sorted(os.listdir(source_dir)):
+        if filename.endswith((".yaml", ".yml")):
+            with open(os.path.join(source_dir, filename), 'r', encoding='utf-8') as file:
+                base.append(yaml.safe_load(file))
+    for i in range(size):
+        template = dict(base[i % len(base)])
+        if i >= len(base):
+            topic = " ".join(rng.sample(EXTRA_WORDS, 2))
+            template["id"] = f"{template['id']}_{i}"
+            template["name"] = f"{template['name']} for {topic}"
+            template["description"] = f"{template['description']} Focused on {topic}."
+        with open(os.path.join(target_dir, f"{i:05d}.yaml"), 'w', encoding='utf-8') as file:
+            yaml.safe_dump(template, file, sort_keys=False, allow_unicode=True)
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def measure(task: Callable[[int], Any], requests: int, concurrency: int) -> Dict[str, float]:
+    """Run task(i) for i in range(requests) on `concurrency` threads; latency in ms, memory in KiB."""
+    latencies = []
+
+    def timed(i):
+        started = time.perf_counter()
+        task(i)
+        return time.perf_counter() - started
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    # The pipeline logs every call; keep the benchmark output readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = sorted(executor.map(timed, range(requests)))
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "requests": requests,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "throughput_rps": requests / elapsed if elapsed else 0.0,
+        "peak_memory_kib": peak / 1024,
+    }
+
+def bench_library(size: int, concurrency_levels: List[int], requests: int, llm_options: Dict[str, Any]) -> List[Dict[str, Any]]:
+    results = []
+    with tempfile.TemporaryDirectory() as library_dir:
+        build_library(SOURCE_TEMPLATE_DIR, library_dir, size)
+        snapshot_path = os.path.join(library_dir, "templates.snapshot")
+
+        def record(stage, concurrency, metrics):
+            results.append(dict(metrics, stage=stage, library_size=size, concurrency=concurrency))
+            print(f"  {stage:<22} size={size:<6} c={concurrency:<3} p50={metrics['p50_ms']:8.1f}ms "
+                  f"p95={metrics['p95_ms']:8.1f}ms p99={metrics['p99_ms']:8.1f}ms "
+                  f"{metrics['throughput_rps']:8.1f} req/s  peak {metrics['peak_memory_kib']:9.0f} KiB")
+
+        # Startup: parsing every file, then loading the snapshot written by the first pass
+        record("load_yaml", 1, measure(lambda i: TemplateRegistry(library_dir).refresh(), 1, 1))
+        TemplateRegistry(library_dir, snapshot_path=snapshot_path).refresh()
+        record("load_snapshot", 1, measure(
+            lambda i: TemplateRegistry(library_dir, snapshot_path=snapshot_path).refresh(), 3, 1))
+
+        registry = TemplateRegistry(library_dir)
+        templates = registry.all()
+        template = templates[0]
+        adapted = template["content"]
+
+        for concurrency in concurrency_levels:
+            llm = StubLLM(**llm_options)
+            stages = {
+                "filter": lambda i: registry.filter_by_dimensions(scale="medium", engagement="high"),
+                "recommend": lambda i: recommend_templates(USE_CASES[i % len(USE_CASES)], templates, llm),
+                "fully_adapt": lambda i: fully_adapt_template(template, USE_CASES[i % len(USE_CASES)], llm),
+                "fully_adapt_chunked": lambda i: fully_adapt_template(template, USE_CASES[i % len(USE_CASES)],
+                                                                      llm, chunked=True),
+                "refine": lambda i: refine_output(adapted, FEEDBACK[i % len(FEEDBACK)], llm),
+                "refine_incremental": lambda i: refine_output_incremental(adapted, FEEDBACK[i % len(FEEDBACK)], llm),
+            }
+            for stage, task in stages.items():
+                record(stage, concurrency, measure(task, requests, concurrency))
+    return results
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+def compare(current: Dict[str, Any], baseline_path: str):
+    """Print p95 and throughput changes against an earlier results file."""
+    with open(baseline_path, 'r', encoding='utf-8') as file:
+        baseline = json.load(file)
+    previous = {(r["stage"], r["library_size"], r["concurrency"]): r for r in baseline["results"]}
+    print(f"\nCompared with {baseline.get('revision') or baseline_path}:")
+    for result in current["results"]:
+        old = previous.get((result["stage"], result["library_size"], result["concurrency"]))
+        if not old:
+            continue
+        p95_change = (result["p95_ms"] / old["p95_ms"] - 1) * 100 if old["p95_ms"] else 0.0
+        throughput_change = ((result["throughput_rps"] / old["throughput_rps"] - 1) * 100
+                             if old["throughput_rps"] else 0.0)
+        flag = "  <-- slower" if p95_change > 10 else ""
+        print(f"  {result['stage']:<22} size={result['library_size']:<6} c={result['concurrency']:<3} "
+              f"p95 {p95_change:+6.1f}%  throughput {throughput_change:+6.1f}%{flag}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the template pipeline with a stub LLM.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[3, 100, 1000], help="template library sizes")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=32, help="requests per stage and concurrency level")
+    parser.add_argument("--latency", type=float, default=0.05, help="stub LLM base latency in seconds")
+    parser.add_argument("--tokens-per-second", type=float, default=500.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--shape", default="echo", help="stub response shape")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="results file (default: benchmarks/results/<revision>-<time>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args(argv)
+
+    llm_options = {"latency": args.latency, "tokens_per_second": args.tokens_per_second,
+                   "error_rate": args.error_rate, "shape": args.shape, "seed": args.seed}
+    results = []
+    for size in args.sizes:
+        print(f"Library of {size} templates:")
+        results.extend(bench_library(size, args.concurrency, args.requests, llm_options))
+
+    revision = git_revision()
+    report = {
+        "revision": revision,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "settings": dict(llm_options, requests=args.requests),
+        "results": results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{revision or 'unknown'}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        compare(report, args.compare)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,334 @@
+# benchmarks/load_test.py
+"""Load test of app.py: many concurrent sessions stepping through the 4-step flow, run offline.
+
+    python benchmarks/load_test.py --sessions 1 10 50 100 --latency 0.5
+    python benchmarks/load_test.py --compare benchmarks/results/<earlier load run>.json
+
+Each simulated user is a headless Streamlit AppTest session. It describes
+a use case and its dimensions, selects the top template, waits for the
+adaptation and sends `--refinements` refinements. All sessions run in this
+one process, as they would on a Streamlit server, so they share its
+template registry, session store, job executor and LLM. The LLM is the
+StubBackend (LLM_BACKEND=stub) with the given latency and token rate.
+
+For every number of concurrent sessions this reports:
+- rerun latency: script runs (`AppTest.run`) that open the page, move to
+  step 3 and rerun the finished step 4
+- how long users wait for the adaptation and for each refinement
+- throughput, in script runs and completed sessions per second
+- resident memory, and session store bytes, per session
+Results are written as JSON under benchmarks/results/.
+"""
+import io
+import os
+import gc
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import threading
+import contextlib
+import concurrent.futures
+from typing import List, Dict, Any, Optional
+from unittest.mock import MagicMock
+
+# The load test never calls a real model
+os.environ["LLM_BACKEND"] = "stub"
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from streamlit import logger as streamlit_logger
+from streamlit.testing.v1 import AppTest, local_script_runner
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.runtime.media_file_manager import MediaFileManager
+from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+
+from bench_pipeline import RESULTS_DIR, USE_CASES, FEEDBACK, percentile, git_revision
+from utils.llm_utils import initialize_llm
+from utils.session_store import get_session_store
+from utils.recommender import get_recommender
+
+APP_PATH = os.path.join(ROOT_DIR, "app.py")
+
+# Script runs timed as rerun latency: opening the page, moving to step 3, rerunning step 4
+ACTIONS = ("open", "describe", "rerun")
+
+def share_test_runtime():
+    """Let AppTests run concurrently in this process, sharing what a server process shares.
+
+    Each AppTest run installs its own mock Runtime and clears it when it
+    finishes, which breaks every other session still running; and each
+    compiles the script itself, which is not thread-safe on some Python
+    versions. Serve one Runtime and one bytecode cache instead.
+    """
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime.instance = classmethod(lambda cls: runtime)
+    Runtime.exists = classmethod(lambda cls: True)
+    script_cache = ScriptCache()
+    local_script_runner.ScriptCache = lambda: script_cache
+
+class SessionFailed(Exception):
+    """Raised when a simulated session hits an app exception or cannot continue."""
+
+class SimulatedUser:
+    """One scripted session, recording the duration of every script run it triggers."""
+
+    def __init__(self, index: int, refinements: int, think_time: float, timeout: float,
+                 shared_descriptions: bool, scale: str, engagement: str):
+        self.index = index
+        self.refinements = refinements
+        self.think_time = think_time
+        self.timeout = timeout
+        self.description = USE_CASES[index % len(USE_CASES)]
+        if not shared_descriptions:
+            self.description += f" (group {index})"
+        self.scale = scale
+        self.engagement = engagement
+        self.rng = random.Random(index)
+        self.runs: Dict[str, List[float]] = {action: [] for action in ACTIONS}
+        self.adapt_wait = 0.0
+        self.refine_waits: List[float] = []
+        self.script_runs = 0
+        self.session_id: Optional[str] = None
+        self.app: Optional[AppTest] = None
+
+    def _run(self, action: Optional[str] = None) -> float:
+        """Run the script once (with any reruns it triggers); returns the duration."""
+        started = time.perf_counter()
+        self.app.run(timeout=self.timeout)
+        duration = time.perf_counter() - started
+        self.script_runs += 1
+        if action:
+            self.runs[action].append(duration)
+        if self.app.exception:
+            raise SessionFailed(f"{action or 'poll'}: {self.app.exception[0].value}")
+        return duration
+
+    def _think(self):
+        if self.think_time:
+            time.sleep(self.rng.uniform(0, 2 * self.think_time))
+
+    def _generate(self) -> float:
+        """Run the script until the requested generation has finished; returns how long that took.
+
+        Without fragments the page polls the job by rerunning itself, so a
+        single run usually lasts until the job is done.
+        """
+        started = time.perf_counter()
+        state = self.app.session_state
+        self._run()
+        while state["pending_adaptation"] or state["pending_refinement"] or state["active_job"] is not None:
+            if time.perf_counter() - started > self.timeout:
+                raise SessionFailed("Timed out waiting for a generation")
+            if self._run() < 0.01:
+                time.sleep(0.05)
+        return time.perf_counter() - started
+
+    def run(self):
+        # Each action sets the session state its button handler sets, then runs the script.
+        # AppTest merges the elements of a run and of the st.rerun() it triggers into one
+        # tree, and the previous step's leftover widgets would break the next interaction.
+        # Step 2 is skipped: AppTest cannot read back a selectbox with a format_func.
+        self.app = AppTest.from_file(APP_PATH, default_timeout=self.timeout)
+        self._run("open")
+        state = self.app.session_state
+        self.session_id = state["session_id"]
+
+        self._think()
+        state["user_description"] = self.description
+        state["selected_scale"] = self.scale
+        state["selected_engagement"] = self.engagement
+        state["step"] = 3
+        self._run("describe")
+
+        self._think()
+        # The page's first "Select this Template" button; the ranking is cached, so this is free
+        templates = get_recommender().recommend(self.description, scale=self.scale, engagement=self.engagement,
+                                                llm=initialize_llm())
+        if not templates:
+            raise SessionFailed(f"No templates for scale={self.scale} engagement={self.engagement}")
+        session = get_session_store().get(self.session_id)
+        session.template_key = get_recommender().registry.key_of(templates[0])
+        session.revisions.reset()
+        state["pending_adaptation"] = True
+        state["step"] = 4
+        self.adapt_wait = self._generate()
+        # A plain rerun of the finished page, as typing in the chat box causes
+        self._run("rerun")
+
+        for number in range(self.refinements):
+            self._think()
+            feedback = FEEDBACK[(self.index + number) % len(FEEDBACK)]
+            session.chat.append("user", feedback)
+            state["pending_refinement"] = feedback
+            self.refine_waits.append(self._generate())
+            self._run("rerun")
+
+def _rss_kib() -> float:
+    """Resident memory of this process in KiB (the peak, where the current value is unavailable)."""
+    try:
+        with open("/proc/self/statm", 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 if sys.platform == "darwin" else float(peak)
+
+def _stats(values: List[float]) -> Dict[str, float]:
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 0.50) * 1000,
+        "p95_ms": percentile(values, 0.95) * 1000,
+        "p99_ms": percentile(values, 0.99) * 1000,
+    }
+
+def run_level(sessions: int, args) -> Dict[str, Any]:
+    """Run `sessions` simulated users at once and summarize them."""
+    users = [SimulatedUser(i, args.refinements, args.think_time, args.timeout, args.shared_descriptions,
+                           args.scale, args.engagement) for i in range(sessions)]
+    errors: List[str] = []
+    errors_lock = threading.Lock()
+
+    def simulate(user: SimulatedUser):
+        time.sleep(random.Random(user.index).uniform(0, args.ramp))
+        started = time.perf_counter()
+        try:
+            user.run()
+        except Exception as e:
+            with errors_lock:
+                errors.append(f"session {user.index}: {type(e).__name__}: {e}")
+            return None
+        return time.perf_counter() - started
+
+    gc.collect()
+    rss_before = _rss_kib()
+    started = time.perf_counter()
+    # The pipeline logs every call; keep the load test output readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=sessions) as executor:
+            durations = list(executor.map(simulate, users))
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    rss_after = _rss_kib()
+
+    # Measure what the sessions hold while their AppTests are still alive, then release them
+    store = get_session_store()
+    store_bytes = 0
+    for user in users:
+        if user.session_id:
+            data = store.get(user.session_id)
+            store_bytes += data.revisions.size() + sum(len(message["content"]) for message in data.chat)
+            store.discard(user.session_id)
+        user.app = None
+
+    completed = [duration for duration in durations if duration is not None]
+    script_runs = sum(user.script_runs for user in users)
+    result = {
+        "sessions": sessions,
+        "completed": len(completed),
+        "errors": len(errors),
+        "elapsed_s": elapsed,
+        "sessions_per_s": len(completed) / elapsed if elapsed else 0.0,
+        "runs_per_s": script_runs / elapsed if elapsed else 0.0,
+        "runs": {action: _stats([value for user in users for value in user.runs[action]]) for action in ACTIONS},
+        "all_runs": _stats([value for user in users for values in user.runs.values() for value in values]),
+        "adapt_wait": _stats([user.adapt_wait for user in users if user.adapt_wait]),
+        "refine_wait": _stats([wait for user in users for wait in user.refine_waits]),
+        "session": _stats(completed),
+        "rss_mib": rss_after / 1024,
+        "rss_kib_per_session": max(0.0, rss_after - rss_before) / sessions,
+        "store_kib_per_session": store_bytes / 1024 / sessions,
+        "first_errors": errors[:5],
+    }
+    print(f"  sessions={sessions:<4} done={len(completed):<4} errors={len(errors):<3} "
+          f"rerun p50={result['all_runs']['p50_ms']:7.1f}ms p95={result['all_runs']['p95_ms']:7.1f}ms  "
+          f"adapt p95={result['adapt_wait']['p95_ms']:8.1f}ms refine p95={result['refine_wait']['p95_ms']:8.1f}ms  "
+          f"{result['runs_per_s']:6.1f} runs/s {result['sessions_per_s']:5.2f} sessions/s  "
+          f"rss {result['rss_mib']:6.0f} MiB (+{result['rss_kib_per_session']:6.0f} KiB/session)")
+    for error in result["first_errors"]:
+        print(f"    {error}")
+    return result
+
+def compare(current: Dict[str, Any], baseline_path: str):
+    """Print latency and throughput changes against an earlier load test results file."""
+    with open(baseline_path, 'r', encoding='utf-8') as file:
+        baseline = json.load(file)
+    previous = {result["sessions"]: result for result in baseline["results"]}
+    print(f"\nCompared with {baseline.get('revision') or baseline_path}:")
+    for result in current["results"]:
+        old = previous.get(result["sessions"])
+        if not old:
+            continue
+        changes = []
+        for name, new_value, old_value in (
+            ("rerun p95", result["all_runs"]["p95_ms"], old["all_runs"]["p95_ms"]),
+            ("refine p95", result["refine_wait"]["p95_ms"], old["refine_wait"]["p95_ms"]),
+            ("sessions/s", result["sessions_per_s"], old["sessions_per_s"]),
+        ):
+            changes.append(f"{name} {(new_value / old_value - 1) * 100 if old_value else 0.0:+6.1f}%")
+        slower = old["all_runs"]["p95_ms"] and result["all_runs"]["p95_ms"] > 1.1 * old["all_runs"]["p95_ms"]
+        print(f"  sessions={result['sessions']:<4} {'  '.join(changes)}{'  <-- slower' if slower else ''}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test app.py with concurrent simulated sessions and a stub LLM.")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 10, 50],
+                        help="numbers of concurrent sessions to run, one level after another")
+    parser.add_argument("--refinements", type=int, default=2, help="refinement requests per session")
+    parser.add_argument("--latency", type=float, default=0.5, help="stub LLM base latency in seconds")
+    parser.add_argument("--tokens-per-second", type=float, default=500.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--think-time", type=float, default=0.0, help="mean pause between user actions, seconds")
+    parser.add_argument("--ramp", type=float, default=1.0, help="sessions start spread over this many seconds")
+    parser.add_argument("--timeout", type=float, default=120.0, help="longest a single step may take, seconds")
+    parser.add_argument("--scale", default="medium")
+    parser.add_argument("--engagement", default="high")
+    parser.add_argument("--shared-descriptions", action="store_true",
+                        help="reuse a few use case descriptions, so identical adaptations coalesce")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="results file (default: benchmarks/results/load-<revision>-<time>.json)")
+    parser.add_argument("--compare", help="earlier load test results file to compare against")
+    args = parser.parse_args(argv)
+
+    os.chdir(ROOT_DIR)
+    share_test_runtime()
+    # Setting a session's state between runs happens outside a script run, which Streamlit warns about
+    streamlit_logger.set_log_level("error")
+    llm = initialize_llm()
+    llm.latency = args.latency
+    llm.tokens_per_second = args.tokens_per_second
+    llm.error_rate = args.error_rate
+    llm.seed = args.seed
+
+    print(f"Load test of {APP_PATH} with a stub LLM ({args.latency}s + {args.tokens_per_second} tokens/s):")
+    results = [run_level(sessions, args) for sessions in args.sessions]
+
+    revision = git_revision()
+    report = {
+        "revision": revision,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "results": results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR,
+                                         f"load-{revision or 'unknown'}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        compare(report, args.compare)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+# utils/coalescing.py
+import os
+import re
+import time
+import random
+import hashlib
+import threading
+import unicodedata
+from collections import deque
+from typing import Dict, Any, Callable, Hashable, List, Optional, Tuple
+
+from utils.instrumentation import increment
+
+# Treat near-identical use case descriptions (e.g. the same brief with a typo fixed) as one request.
+# Off by default: the later sessions get the adaptation written for the first description.
+NEAR_DUPLICATE_COALESCING = os.environ.get("NEAR_DUPLICATE_COALESCING", "").lower() in ("1", "true", "yes")
+# Estimated Jaccard similarity of description shingles above which two descriptions are the same request
+NEAR_DUPLICATE_THRESHOLD = float(os.environ.get("NEAR_DUPLICATE_THRESHOLD", "0.85"))
+# How long, in seconds, a description stays available as the canonical one for later near duplicates
+NEAR_DUPLICATE_WINDOW = float(os.environ.get("NEAR_DUPLICATE_WINDOW", "300"))
+
+SHINGLE_SIZE = 5
+MINHASH_PERMUTATIONS = 64
+_MERSENNE_PRIME = (1 << 61) - 1
+
+_NON_WORD = re.compile(r"[^\w\s]+")
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_description(text: str) -> str:
+    """Case, accents, punctuation and whitespace folded away, for comparing use case descriptions."""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(char for char in text if not unicodedata.combining(char)).casefold()
+    text = _NON_WORD.sub(" ", text)
+    return _WHITESPACE.sub(" ", text).strip()
+
+class SingleFlight:
+    """Runs one call per key at a time; concurrent callers with the same key share its result.
+
+    Nothing is cached: once the call returns, the next caller with that key
+    starts a new one. An exception from the call is raised in every waiter.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, Dict[str, Any]] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None}
+
+        if not leader:
+            increment("coalesced_requests", stage=self.name)
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except BaseException as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+class NearDuplicateDetector:
+    """Maps descriptions to a recent, near-identical one using MinHash signatures of their shingles.
+
+    Each description is normalized, cut into overlapping character shingles
+    and summarized as a MinHash signature; the share of matching signature
+    slots estimates the Jaccard similarity of the shingle sets.
+    """
+
+    def __init__(self, threshold: float = NEAR_DUPLICATE_THRESHOLD, window: float = NEAR_DUPLICATE_WINDOW,
+                 max_entries: int = 512, seed: int = 1):
+        self.threshold = threshold
+        self.window = window
+        self._lock = threading.Lock()
+        # (time seen, normalized text, signature, original description), oldest first
+        self._recent: "deque[Tuple[float, str, List[int], str]]" = deque(maxlen=max_entries)
+        rng = random.Random(seed)
+        self._permutations = [(rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+                              for _ in range(MINHASH_PERMUTATIONS)]
+
+    def signature(self, normalized: str) -> List[int]:
+        padded = f" {normalized} "
+        shingles = {padded[i:i + SHINGLE_SIZE] for i in range(max(1, len(padded) - SHINGLE_SIZE + 1))}
+        hashes = [int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), "big")
+                  for shingle in shingles]
+        return [min((a * value + b) % _MERSENNE_PRIME for value in hashes) for a, b in self._permutations]
+
+    @staticmethod
+    def similarity(first: List[int], second: List[int]) -> float:
+        return sum(x == y for x, y in zip(first, second)) / len(first)
+
+    def canonical(self, description: str) -> str:
+        """The earlier description this one duplicates, or the description itself (now remembered)."""
+        normalized = normalize_description(description)
+        if not normalized:
+            return description
+        signature = self.signature(normalized)
+        now = time.monotonic()
+        with self._lock:
+            while self._recent and now - self._recent[0][0] > self.window:
+                self._recent.popleft()
+            best, best_similarity = None, self.threshold
+            for seen, text, other, original in self._recent:
+                similarity = 1.0 if text == normalized else self.similarity(signature, other)
+                if similarity >= best_similarity:
+                    best, best_similarity = original, similarity
+            if best is not None:
+                increment("near_duplicate_descriptions")
+                return best
+            self._recent.append((now, normalized, signature, description))
+        return description
+
+_detector: Optional[NearDuplicateDetector] = None
+_detector_lock = threading.Lock()
+
+def coalesce_description(description: str) -> str:
+    """The description to adapt for: an earlier near-identical one if coalescing is enabled."""
+    global _detector
+    if not NEAR_DUPLICATE_COALESCING:
+        return description
+    if _detector is None:
+        with _detector_lock:
+            if _detector is None:
+                _detector = NearDuplicateDetector()
+    return _detector.canonical(description)
@@ -22,4 +22,12 @@ def get_scale_definition(scale):
     return SCALE_DEFINITIONS.get(scale, "")
 
 def get_engagement_definition(engagement):
-    return ENGAGEMENT_DEFINITIONS.get(engagement, "")
\ No newline at end of file
+    return ENGAGEMENT_DEFINITIONS.get(engagement, "")
+
+def normalize_dimension_values(value):
+    """Normalize a template dimension value (a string or a list of strings) to a set."""
+    if value is None:
+        return frozenset()
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return frozenset(str(item).strip().lower() for item in value if item is not None)
+    return frozenset([str(value).strip().lower()])
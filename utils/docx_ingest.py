@@ -0,0 +1,299 @@
+# utils/docx_ingest.py
+"""Convert the Word (.docx) templates into the YAML template library.
+
+    python -m utils.docx_ingest [template_dir] [--force]
+
+Each document becomes a YAML template next to it. If a YAML template with
+the same id already exists (the id is the slugified file name), only its
+content is replaced, so hand-maintained metadata such as dimensions and
+description is kept. A manifest of document hashes makes re-runs convert
+only the documents that changed.
+"""
+import os
+import re
+import sys
+import json
+import hashlib
+import argparse
+import unicodedata
+from typing import List, Dict, Any, Optional, Tuple
+
+import yaml
+
+try:
+    import docx
+    from docx.oxml.ns import qn
+    from docx.table import Table
+    HAVE_DOCX = True
+except ImportError:
+    HAVE_DOCX = False
+
+from utils.template_registry import YAML_LOADER, TEMPLATE_EXTENSIONS
+
+DOCX_EXTENSION = ".docx"
+MANIFEST_DIR = os.environ.get("DOCX_MANIFEST_DIR", ".cache")
+
+HEADING_STYLE = re.compile(r"^Heading (\d)$")
+# Four spaces nest a list item under both "1. " and "- " parents
+LIST_INDENT = "    "
+
+def template_id_for(name: str) -> str:
+    """Slugify a file name into a template id: "World Café" -> "world_cafe"."""
+    ascii_name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"[^a-z0-9]+", "_", ascii_name.lower()).strip("_")
+
+def _numbering_formats(document) -> Dict[str, Dict[str, str]]:
+    """Map numId -> list level -> number format ("decimal", "bullet", ...)."""
+    try:
+        numbering = document.part.numbering_part.element
+    except (KeyError, NotImplementedError):
+        return {}
+
+    abstract_formats = {}
+    for abstract in numbering.findall(qn("w:abstractNum")):
+        levels = {}
+        for level in abstract.findall(qn("w:lvl")):
+            number_format = level.find(qn("w:numFmt"))
+            levels[level.get(qn("w:ilvl"))] = number_format.get(qn("w:val")) if number_format is not None else "bullet"
+        abstract_formats[abstract.get(qn("w:abstractNumId"))] = levels
+
+    formats = {}
+    for num in numbering.findall(qn("w:num")):
+        abstract_id = num.find(qn("w:abstractNumId"))
+        if abstract_id is not None:
+            formats[num.get(qn("w:numId"))] = abstract_formats.get(abstract_id.get(qn("w:val")), {})
+    return formats
+
+def _list_level(paragraph) -> Optional[Tuple[str, int]]:
+    """Return (numId, level) for a list paragraph, or None."""
+    properties = paragraph._p.pPr
+    if properties is None or properties.numPr is None or properties.numPr.numId is None:
+        return None
+    level = properties.numPr.ilvl.val if properties.numPr.ilvl is not None else 0
+    return str(properties.numPr.numId.val), level
+
+def _inline_markdown(paragraph) -> str:
+    """Paragraph text with bold and italic runs marked up."""
+    runs = paragraph.runs
+    if "".join(run.text for run in runs) != paragraph.text:
+        # Hyperlinks and fields aren't plain runs; keep their text unformatted
+        return paragraph.text.strip()
+
+    parts = []
+    for run in runs:
+        text = run.text
+        if text.strip() and (run.bold or run.italic):
+            marker = ("**" if run.bold else "") + ("*" if run.italic else "")
+            leading = text[:len(text) - len(text.lstrip())]
+            trailing = text[len(text.rstrip()):]
+            text = f"{leading}{marker}{text.strip()}{marker[::-1]}{trailing}"
+        parts.append(text)
+    return "".join(parts).strip()
+
+def _table_markdown(table) -> str:
+    rows = [[cell.text.strip().replace("\n", " ").replace("|", "\\|") for cell in row.cells] for row in table.rows]
+    if not rows:
+        return ""
+    width = max(len(row) for row in rows)
+    rows = [row + [""] * (width - len(row)) for row in rows]
+    lines = ["| " + " | ".join(rows[0]) + " |", "|" + " --- |" * width]
+    lines.extend("| " + " | ".join(row) + " |" for row in rows[1:])
+    return "\n".join(lines)
+
+def docx_to_markdown(path: str) -> str:
+    """Convert a Word document to markdown: headings, numbered and bulleted lists, tables."""
+    document = docx.Document(path)
+    formats = _numbering_formats(document)
+    counters: Dict[str, List[int]] = {}
+
+    # (list numId or None, text); items of the same list share a line break, everything else a blank line
+    blocks: List[Tuple[Optional[str], str]] = []
+    for item in document.iter_inner_content():
+        if isinstance(item, Table):
+            text = _table_markdown(item)
+            if text:
+                blocks.append((None, text))
+            continue
+
+        text = _inline_markdown(item)
+        if not text:
+            continue
+
+        style = item.style.name if item.style is not None else ""
+        heading = HEADING_STYLE.match(style)
+        if heading:
+            blocks.append((None, f"{'#' * int(heading.group(1))} {item.text.strip()}"))
+            continue
+        if style == "Title":
+            blocks.append((None, f"# {item.text.strip()}"))
+            continue
+
+        list_level = _list_level(item)
+        if list_level is None:
+            blocks.append((None, text))
+            continue
+
+        num_id, level = list_level
+        number_format = formats.get(num_id, {}).get(str(level), "bullet")
+        if number_format in ("bullet", "none"):
+            marker = "-"
+        else:
+            # Word continues a numbering sequence across interruptions; deeper levels restart
+            levels = counters.setdefault(num_id, [])
+            del levels[level + 1:]
+            levels.extend([0] * (level + 1 - len(levels)))
+            levels[level] += 1
+            marker = f"{levels[level]}."
+        blocks.append((num_id, f"{LIST_INDENT * level}{marker} {text}"))
+
+    lines = []
+    for i, (num_id, text) in enumerate(blocks):
+        if i and not (num_id is not None and blocks[i - 1][0] == num_id):
+            lines.append("")
+        lines.append(text)
+    return "\n".join(lines) + "\n"
+
+def docx_to_template(path: str, existing: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Build a template from a Word document, keeping the metadata of an existing template."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    content = docx_to_markdown(path)
+    if existing:
+        template = dict(existing)
+        template["content"] = content
+        return template
+
+    properties = docx.Document(path).core_properties
+    return {
+        "id": template_id_for(stem),
+        "name": properties.title or stem,
+        "dimensions": {},
+        "description": properties.subject or properties.comments or "",
+        "content": content,
+    }
+
+class _TemplateDumper(yaml.SafeDumper):
+    """Dump multi-line strings as literal blocks, like the hand-written templates."""
+
+def _represent_str(dumper, value):
+    style = "|" if "\n" in value else None
+    return dumper.represent_scalar("tag:yaml.org,2002:str", value, style=style)
+
+_TemplateDumper.add_representer(str, _represent_str)
+
+def dump_template(template: Dict[str, Any]) -> str:
+    return yaml.dump(template, Dumper=_TemplateDumper, sort_keys=False, allow_unicode=True, width=1000)
+
+def _yaml_templates_by_id(template_dir: str) -> Dict[str, Tuple[str, Dict[str, Any]]]:
+    templates = {}
+    for filename in sorted(os.listdir(template_dir)):
+        if not filename.endswith(TEMPLATE_EXTENSIONS):
+            continue
+        path = os.path.join(template_dir, filename)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                template = yaml.load(file, Loader=YAML_LOADER)
+        except Exception as e:
+            print(f"Error loading template {filename}: {e}")
+            continue
+        if isinstance(template, dict) and template.get("id") is not None:
+            templates.setdefault(str(template["id"]), (path, template))
+    return templates
+
+def default_manifest_path(template_dir: str) -> str:
+    key = hashlib.sha1(os.path.abspath(template_dir).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(MANIFEST_DIR, f"docx-{key}.json")
+
+def sync_docx_templates(template_dir: str = "templates", manifest_path: str = None,
+                        force: bool = False) -> Dict[str, int]:
+    """Convert new or changed Word documents in template_dir into YAML templates.
+
+    Documents are skipped while their mtime and size match the manifest, and
+    only re-converted when their content hash changed. Returns counts of
+    converted, unchanged and failed documents.
+    """
+    stats = {"converted": 0, "unchanged": 0, "failed": 0}
+    if not HAVE_DOCX:
+        print("python-docx is not installed; skipping .docx templates.")
+        return stats
+
+    manifest_path = manifest_path or default_manifest_path(template_dir)
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        manifest = {}
+
+    try:
+        dir_entries = sorted(os.scandir(template_dir), key=lambda entry: entry.name)
+    except FileNotFoundError:
+        print(f"Template directory not found: {template_dir}")
+        return stats
+
+    yaml_templates = None
+    updated = False
+    for dir_entry in dir_entries:
+        # Word keeps "~$name.docx" lock files next to open documents
+        if not dir_entry.name.endswith(DOCX_EXTENSION) or dir_entry.name.startswith("~$"):
+            continue
+        stat = dir_entry.stat()
+        record = manifest.get(dir_entry.name)
+        output_exists = record is not None and os.path.exists(os.path.join(template_dir, record["output"]))
+        if (not force and output_exists
+                and record["mtime_ns"] == stat.st_mtime_ns and record["size"] == stat.st_size):
+            stats["unchanged"] += 1
+            continue
+
+        with open(dir_entry.path, 'rb') as file:
+            digest = hashlib.sha1(file.read()).hexdigest()
+        if not force and output_exists and record["sha1"] == digest:
+            record.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+            updated = True
+            stats["unchanged"] += 1
+            continue
+
+        if yaml_templates is None:
+            yaml_templates = _yaml_templates_by_id(template_dir)
+        stem = os.path.splitext(dir_entry.name)[0]
+        output_path, existing = yaml_templates.get(template_id_for(stem),
+                                                   (os.path.join(template_dir, f"{stem}.yaml"), None))
+        try:
+            template = docx_to_template(dir_entry.path, existing)
+        except Exception as e:
+            print(f"Error converting {dir_entry.name}: {e}")
+            stats["failed"] += 1
+            continue
+
+        tmp_path = f"{output_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            file.write(dump_template(template))
+        os.replace(tmp_path, output_path)
+        yaml_templates[str(template["id"])] = (output_path, template)
+
+        manifest[dir_entry.name] = {"sha1": digest, "mtime_ns": stat.st_mtime_ns, "size": stat.st_size,
+                                    "output": os.path.basename(output_path)}
+        updated = True
+        stats["converted"] += 1
+        print(f"Converted {dir_entry.name} -> {os.path.basename(output_path)}")
+
+    if updated:
+        directory = os.path.dirname(manifest_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{manifest_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(manifest, file, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, manifest_path)
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert .docx templates into the YAML template library.")
+    parser.add_argument("template_dir", nargs="?", default="templates")
+    parser.add_argument("--force", action="store_true", help="re-convert every document")
+    args = parser.parse_args(argv)
+
+    stats = sync_docx_templates(args.template_dir, force=args.force)
+    print(f"{stats['converted']} converted, {stats['unchanged']} unchanged, {stats['failed']} failed")
+    return 1 if stats["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
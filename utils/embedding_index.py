@@ -0,0 +1,197 @@
+# utils/embedding_index.py
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
+
+try:
+    import numpy as np
+    import torch
+    from transformers import AutoTokenizer, AutoModel
+    HAVE_EMBEDDINGS = True
+except ImportError:
+    HAVE_EMBEDDINGS = False
+
+# Local embeddings are opt-in: the first use downloads the encoder model
+USE_EMBEDDINGS = os.environ.get("USE_EMBEDDINGS", "").lower() in ("1", "true", "yes")
+EMBEDDING_MODEL_NAME = os.environ.get("EMBEDDING_MODEL_NAME", "sentence-transformers/all-MiniLM-L6-v2")
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", os.path.join(".cache", "embeddings"))
+
+# Only the start of the content is embedded; it carries the overview of the method
+CONTENT_CHARS = 1500
+
+def template_embedding_text(template: Dict[str, Any]) -> str:
+    """Build the text that represents a template in embedding space."""
+    keywords = template.get("keywords") or []
+    if isinstance(keywords, str):
+        keywords = [keywords]
+    parts = [
+        str(template.get("name", "")),
+        str(template.get("description", "")),
+        ", ".join(str(keyword) for keyword in keywords),
+        str(template.get("content", ""))[:CONTENT_CHARS],
+    ]
+    return "\n".join(part for part in parts if part)
+
+class EmbeddingIndex:
+    """CPU sentence-embedding index backed by a memory-mapped matrix on disk.
+
+    Each template is encoded once; vectors are stored in `vectors.f32` and
+    looked up by the hash of the template's embedding text, so unchanged
+    templates are never re-encoded, even across restarts.
+    """
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL_NAME, cache_dir: str = EMBEDDING_CACHE_DIR,
+                 batch_size: int = 32, max_tokens: int = 256):
+        self.model_name = model_name
+        self.store_dir = os.path.join(cache_dir, model_name.replace("/", "__"))
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self._lock = threading.RLock()
+        self._tokenizer = None
+        self._model = None
+        self._dim = 0
+        self._capacity = 0
+        self._rows: Dict[str, int] = {}
+        self._matrix = None
+        # fingerprint of a template list -> (templates, gathered vectors)
+        self._gathered: "OrderedDict[Tuple[int, ...], Tuple[List[Dict[str, Any]], Any]]" = OrderedDict()
+        self._load_store()
+
+    @property
+    def _manifest_path(self) -> str:
+        return os.path.join(self.store_dir, "manifest.json")
+
+    @property
+    def _vectors_path(self) -> str:
+        return os.path.join(self.store_dir, "vectors.f32")
+
+    def _load_store(self):
+        try:
+            with open(self._manifest_path, 'r', encoding='utf-8') as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return
+        if manifest.get("model") != self.model_name:
+            return
+        try:
+            self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode='r+',
+                                     shape=(manifest["capacity"], manifest["dim"]))
+        except (OSError, ValueError) as e:
+            print(f"Discarding embedding store in {self.store_dir}: {e}")
+            return
+        self._dim = manifest["dim"]
+        self._capacity = manifest["capacity"]
+        self._rows = manifest["rows"]
+
+    def _save_manifest(self):
+        manifest = {"model": self.model_name, "dim": self._dim, "capacity": self._capacity, "rows": self._rows}
+        tmp_path = self._manifest_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(manifest, file)
+        os.replace(tmp_path, self._manifest_path)
+
+    def _ensure_capacity(self, rows_needed: int):
+        if rows_needed <= self._capacity:
+            return
+        new_capacity = max(rows_needed, self._capacity * 2, 256)
+        if self._matrix is not None:
+            self._matrix.flush()
+            self._matrix = None
+        os.makedirs(self.store_dir, exist_ok=True)
+        with open(self._vectors_path, 'ab') as file:
+            file.truncate(new_capacity * self._dim * 4)
+        self._capacity = new_capacity
+        self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode='r+',
+                                 shape=(self._capacity, self._dim))
+
+    def _load_model(self):
+        if self._model is None:
+            print(f"Loading embedding model {self.model_name}...")
+            self._tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            self._model = AutoModel.from_pretrained(self.model_name)
+            self._model.eval()
+
+    def encode(self, texts: List[str]) -> "np.ndarray":
+        """Encode texts into L2-normalized, mean-pooled vectors."""
+        with self._lock:
+            self._load_model()
+            batches = []
+            with torch.inference_mode():
+                for start in range(0, len(texts), self.batch_size):
+                    batch = self._tokenizer(texts[start:start + self.batch_size], padding=True, truncation=True,
+                                            max_length=self.max_tokens, return_tensors="pt")
+                    hidden = self._model(**batch).last_hidden_state
+                    mask = batch["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+                    pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+                    pooled = torch.nn.functional.normalize(pooled, p=2, dim=1)
+                    batches.append(pooled.numpy().astype(np.float32))
+            return np.concatenate(batches) if batches else np.zeros((0, self._dim), dtype=np.float32)
+
+    def sync(self, templates: List[Dict[str, Any]]) -> List[int]:
+        """Make sure every template has a stored vector; returns their row numbers."""
+        hashes = [hashlib.sha1(template_embedding_text(template).encode('utf-8')).hexdigest()
+                  for template in templates]
+        with self._lock:
+            missing = list(dict.fromkeys(digest for digest in hashes if digest not in self._rows))
+            if missing:
+                texts = {}
+                for template, digest in zip(templates, hashes):
+                    texts.setdefault(digest, template_embedding_text(template))
+                vectors = self.encode([texts[digest] for digest in missing])
+                if not self._dim:
+                    self._dim = vectors.shape[1]
+                start = len(self._rows)
+                self._ensure_capacity(start + len(missing))
+                self._matrix[start:start + len(missing)] = vectors
+                self._matrix.flush()
+                for offset, digest in enumerate(missing):
+                    self._rows[digest] = start + offset
+                self._save_manifest()
+                print(f"Encoded {len(missing)} templates into the embedding index")
+            return [self._rows[digest] for digest in hashes]
+
+    def _vectors_for(self, templates: List[Dict[str, Any]]) -> "np.ndarray":
+        # The cache keeps the template objects alive, so their identities stay unique
+        key = tuple(id(template) for template in templates)
+        with self._lock:
+            cached = self._gathered.get(key)
+            if cached is not None:
+                self._gathered.move_to_end(key)
+                return cached[1]
+        with self._lock:
+            # Gather under the lock: a concurrent sync() may grow and remap the matrix
+            rows = self.sync(templates)
+            vectors = np.asarray(self._matrix[rows])
+            self._gathered[key] = (list(templates), vectors)
+            while len(self._gathered) > 4:
+                self._gathered.popitem(last=False)
+        return vectors
+
+    def search(self, query: str, templates: List[Dict[str, Any]],
+               top_k: int = 3) -> List[Tuple[Dict[str, Any], float]]:
+        """Return the top_k (template, cosine similarity) pairs for the query, best first."""
+        if not templates:
+            return []
+        vectors = self._vectors_for(templates)
+        scores = vectors @ self.encode([query])[0]
+        top_k = min(top_k, len(templates))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [(templates[i], float(scores[i])) for i in best]
+
+_embedding_index: Optional[EmbeddingIndex] = None
+_embedding_index_lock = threading.Lock()
+
+def get_embedding_index() -> Optional[EmbeddingIndex]:
+    """Get the shared embedding index, or None if local embeddings are disabled or unavailable."""
+    global _embedding_index
+    if not (USE_EMBEDDINGS and HAVE_EMBEDDINGS):
+        return None
+    if _embedding_index is None:
+        with _embedding_index_lock:
+            if _embedding_index is None:
+                _embedding_index = EmbeddingIndex()
+    return _embedding_index
@@ -0,0 +1,245 @@
+# utils/instrumentation.py
+import os
+import json
+import time
+import inspect
+import functools
+import threading
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Dict, Any, Optional, Tuple
+
+# Structured span logs are appended here as JSON lines, if set
+INSTRUMENTATION_LOG = os.environ.get("INSTRUMENTATION_LOG", "")
+# Serve Prometheus text metrics on this port, if set
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0") or 0)
+# Show the diagnostics panel in the app
+SHOW_DIAGNOSTICS = os.environ.get("SHOW_DIAGNOSTICS", "").lower() in ("1", "true", "yes")
+
+# Span duration histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.025, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RECENT_SPANS = 200
+
+class Span:
+    """A timed unit of work. Attributes set on it end up in its log record."""
+
+    __slots__ = ("name", "parent", "attributes", "started", "duration", "status")
+
+    def __init__(self, name: str, parent: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.started = time.time()
+        self.duration = 0.0
+        self.status = "ok"
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self.attributes, span=self.name, parent=self.parent, status=self.status,
+                    start=round(self.started, 3), duration_ms=round(self.duration * 1000, 2))
+
+class _Metrics:
+    """Process-wide span statistics and counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # span name -> [count, errors, total seconds, max seconds, bucket counts...]
+        self.spans: Dict[str, List[float]] = {}
+        # (counter name, sorted label items) -> value
+        self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self.recent: "deque[Dict[str, Any]]" = deque(maxlen=RECENT_SPANS)
+        self._log_file = None
+
+    def record_span(self, span: Span):
+        record = span.to_dict()
+        with self._lock:
+            stats = self.spans.get(span.name)
+            if stats is None:
+                stats = self.spans[span.name] = [0, 0, 0.0, 0.0] + [0] * len(LATENCY_BUCKETS)
+            stats[0] += 1
+            stats[1] += span.status == "error"
+            stats[2] += span.duration
+            stats[3] = max(stats[3], span.duration)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if span.duration <= bound:
+                    stats[4 + i] += 1
+            self.recent.append(record)
+            if INSTRUMENTATION_LOG:
+                self._write_log(record)
+
+    def _write_log(self, record: Dict[str, Any]):
+        try:
+            if self._log_file is None:
+                directory = os.path.dirname(INSTRUMENTATION_LOG)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._log_file = open(INSTRUMENTATION_LOG, 'a', encoding='utf-8', buffering=1)
+            self._log_file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        except OSError as e:
+            print(f"Could not write instrumentation log: {e}")
+
+    def increment(self, name: str, value: float = 1, **labels: str):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+_metrics = _Metrics()
+_context = threading.local()
+
+def current_span() -> Optional[Span]:
+    """The innermost open span on this thread, if any."""
+    stack = getattr(_context, "stack", None)
+    return stack[-1] if stack else None
+
+@contextmanager
+def span(name: str, **attributes):
+    """Time a block of work as a named span; nested spans record their parent."""
+    stack = getattr(_context, "stack", None)
+    if stack is None:
+        stack = _context.stack = []
+    current = Span(name, stack[-1].name if stack else None, attributes)
+    stack.append(current)
+    started = time.perf_counter()
+    try:
+        yield current
+    except GeneratorExit:
+        # A streaming consumer stopped reading early
+        current.status = "cancelled"
+        raise
+    except BaseException as e:
+        current.status = "error"
+        current.attributes.setdefault("error", f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        current.duration = time.perf_counter() - started
+        # Generator spans stay open across yields and may finish out of order (or on
+        # another thread), so remove this span rather than whatever is on top
+        if current in stack:
+            stack.remove(current)
+        _metrics.record_span(current)
+
+def instrumented(name: str):
+    """Decorator recording every call of a function (or every run of a generator) as a span."""
+    def decorator(function):
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def generator_wrapper(*args, **kwargs):
+                # The span covers the whole iteration, not just creating the generator
+                with span(name) as current:
+                    chunks = 0
+                    for chunk in function(*args, **kwargs):
+                        chunks += 1
+                        yield chunk
+                    current.set(chunks=chunks)
+            return generator_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def increment(name: str, value: float = 1, **labels: str):
+    """Add to a counter, e.g. increment("llm_output_tokens", 120, model="gemini-2.0-flash")."""
+    _metrics.increment(name, value, **labels)
+
+def record_fallback(stage: str, reason: str):
+    """Count a fallback (e.g. to the original template) and note it on the current span."""
+    _metrics.increment("fallbacks", stage=stage, reason=reason)
+    current = current_span()
+    if current is not None:
+        current.set(fallback=reason)
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count for when the API doesn't report one: about four characters per token."""
+    return (len(text) + 3) // 4
+
+def metrics_snapshot() -> Dict[str, Any]:
+    """Span statistics and counters, for the diagnostics panel."""
+    with _metrics._lock:
+        spans = {
+            name: {"count": int(stats[0]), "errors": int(stats[1]),
+                   "avg_ms": round(stats[2] / stats[0] * 1000, 2) if stats[0] else 0.0,
+                   "max_ms": round(stats[3] * 1000, 2), "total_s": round(stats[2], 3)}
+            for name, stats in sorted(_metrics.spans.items())
+        }
+        counters = [
+            {"name": name, "labels": dict(labels), "value": value}
+            for (name, labels), value in sorted(_metrics.counters.items())
+        ]
+    return {"spans": spans, "counters": counters}
+
+def recent_spans(limit: int = 50) -> List[Dict[str, Any]]:
+    """The most recent span records, newest first."""
+    with _metrics._lock:
+        return list(_metrics.recent)[-limit:][::-1]
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _label_text(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in labels) + "}"
+
+def prometheus_text() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    with _metrics._lock:
+        if _metrics.spans:
+            lines.append("# TYPE span_duration_seconds histogram")
+            for name, stats in sorted(_metrics.spans.items()):
+                for i, bound in enumerate(LATENCY_BUCKETS):
+                    lines.append(f'span_duration_seconds_bucket{{span="{name}",le="{bound}"}} {int(stats[4 + i])}')
+                lines.append(f'span_duration_seconds_bucket{{span="{name}",le="+Inf"}} {int(stats[0])}')
+                lines.append(f'span_duration_seconds_sum{{span="{name}"}} {stats[2]:.6f}')
+                lines.append(f'span_duration_seconds_count{{span="{name}"}} {int(stats[0])}')
+            lines.append("# TYPE span_errors_total counter")
+            for name, stats in sorted(_metrics.spans.items()):
+                lines.append(f'span_errors_total{{span="{name}"}} {int(stats[1])}')
+
+        declared = set()
+        for (name, labels), value in sorted(_metrics.counters.items()):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name}_total counter")
+            lines.append(f"{name}_total{_label_text(labels)} {value:g}")
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+_metrics_server: Optional[ThreadingHTTPServer] = None
+_metrics_server_lock = threading.Lock()
+
+def start_metrics_server(port: int = METRICS_PORT) -> Optional[ThreadingHTTPServer]:
+    """Serve /metrics on a background thread, once per process. Does nothing if port is 0."""
+    global _metrics_server
+    if not port:
+        return None
+    with _metrics_server_lock:
+        if _metrics_server is None:
+            try:
+                _metrics_server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+            except OSError as e:
+                print(f"Could not start metrics server on port {port}: {e}")
+                return None
+            threading.Thread(target=_metrics_server.serve_forever, name="metrics-server", daemon=True).start()
+            print(f"Serving metrics on http://0.0.0.0:{port}/metrics")
+    return _metrics_server
@@ -0,0 +1,200 @@
+# utils/job_executor.py
+import os
+import time
+import uuid
+import hashlib
+import threading
+import concurrent.futures
+from typing import Dict, Callable, Iterator, Optional, Hashable, Set
+
+from utils.llm_utils import (
+    LLMError,
+    stream_fully_adapt_template,
+    stream_refine_output,
+    finalize_streamed_output,
+    finalize_streamed_adaptation,
+    incremental_refinement_applies,
+    refine_output_incremental,
+    adaptation_key
+)
+from utils.coalescing import coalesce_description
+from utils.instrumentation import span, increment
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "8"))
+# Finished jobs are kept this long so the session that started them can collect the result
+JOB_RESULT_TTL = float(os.environ.get("JOB_RESULT_TTL", "600"))
+# How often the UI checks a running job, in seconds
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "0.5"))
+
+class Job:
+    """A generation running on the job executor, shared by every session that asked for it.
+
+    `text()` returns the output produced so far, so the UI can show partial
+    results while polling; once `done`, `result` holds the final text, or
+    `error` the kind of LLM error that ended it.
+    """
+
+    def __init__(self, key: Hashable, kind: str, subscriber: Hashable = None):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.kind = kind
+        self.status = "queued"  # "queued", "running", "done", "failed" or "cancelled"
+        self.result: Optional[str] = None
+        self.error: Optional[str] = None
+        self.created = time.monotonic()
+        self.finished: Optional[float] = None
+        # Who is waiting for the job, e.g. session ids; resubmitting from the same one adds nothing
+        self.subscribers: Set[Hashable] = {subscriber}
+        self._chunks = []
+        self._cancelled = threading.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("done", "failed", "cancelled")
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def text(self) -> str:
+        """The output so far (the final result once done)."""
+        if self.result is not None:
+            return self.result
+        return "".join(self._chunks)
+
+class JobExecutor:
+    """Per-process worker pool for LLM generations, so reruns never wait on the model.
+
+    Submitting a job whose key matches one that is still queued or running
+    attaches to that job instead of starting another generation. A job is
+    only stopped when every session that asked for it has cancelled it.
+    """
+
+    def __init__(self, max_workers: int = JOB_WORKERS):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, Job] = {}
+        self._in_flight: Dict[Hashable, Job] = {}
+
+    def submit(self, key: Hashable, kind: str, produce: Callable[[], Iterator[str]],
+               finalize: Optional[Callable[[str], str]] = None, subscriber: Hashable = None) -> Job:
+        """Run produce() on the pool, collecting its chunks; finalize(text) gives the result.
+
+        Returns the already running job if one with the same key is in flight,
+        adding `subscriber` (e.g. the session id) to those waiting for it.
+        """
+        with self._lock:
+            self._expire()
+            job = self._in_flight.get(key)
+            if job is not None and not job.cancelled:
+                job.subscribers.add(subscriber)
+                increment("jobs_deduplicated", kind=kind)
+                return job
+            job = Job(key, kind, subscriber)
+            self._jobs[job.id] = job
+            self._in_flight[key] = job
+        increment("jobs_submitted", kind=kind)
+        self._executor.submit(self._run, job, produce, finalize)
+        return job
+
+    def _run(self, job: Job, produce: Callable[[], Iterator[str]], finalize: Optional[Callable[[str], str]]):
+        with span("jobs.run", kind=job.kind, queued_ms=round((time.monotonic() - job.created) * 1000, 1)) as current:
+            job.status = "running"
+            chunks = None
+            try:
+                if not job.cancelled:
+                    chunks = produce()
+                    for chunk in chunks:
+                        job._chunks.append(chunk)
+                        if job.cancelled:
+                            break
+                if job.cancelled:
+                    job.status = "cancelled"
+                else:
+                    text = "".join(job._chunks)
+                    job.result = finalize(text) if finalize else text
+                    job.status = "done"
+            except LLMError as e:
+                job.error = e.result.error_kind
+                job.status = "failed"
+            except Exception as e:
+                print(f"Error in {job.kind} job: {e}")
+                job.error = "error"
+                job.status = "failed"
+            finally:
+                if chunks is not None and hasattr(chunks, "close"):
+                    # Stops the underlying LLM stream if we left it early
+                    chunks.close()
+                job.finished = time.monotonic()
+                with self._lock:
+                    if self._in_flight.get(job.key) is job:
+                        del self._in_flight[job.key]
+                current.set(status=job.status, error_kind=job.error)
+                increment("jobs_finished", kind=job.kind, status=job.status)
+
+    def get(self, job_id: Optional[str]) -> Optional[Job]:
+        if not job_id:
+            return None
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: Optional[str], subscriber: Hashable = None):
+        """Drop one subscriber's interest in a job; the job stops once nobody is waiting for it."""
+        with self._lock:
+            job = self._jobs.get(job_id) if job_id else None
+            if job is None or job.done:
+                return
+            job.subscribers.discard(subscriber)
+            if not job.subscribers:
+                job._cancelled.set()
+                if self._in_flight.get(job.key) is job:
+                    del self._in_flight[job.key]
+
+    def _expire(self):
+        now = time.monotonic()
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.finished is not None and now - job.finished > JOB_RESULT_TTL]:
+            del self._jobs[job_id]
+
+_job_executor: Optional[JobExecutor] = None
+_job_executor_lock = threading.Lock()
+
+def get_job_executor() -> JobExecutor:
+    """Get the process-wide job executor, creating it on first use."""
+    global _job_executor
+    if _job_executor is None:
+        with _job_executor_lock:
+            if _job_executor is None:
+                _job_executor = JobExecutor()
+    return _job_executor
+
+def _digest(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def submit_adaptation(template: Dict, use_case_description: str, llm, subscriber: Hashable = None) -> Job:
+    """Start adapting a template to a use case; identical requests share one generation."""
+    use_case_description = coalesce_description(use_case_description)
+    key = ("adapt",) + adaptation_key(template, use_case_description) + (llm is None,)
+    return get_job_executor().submit(
+        key, "adapt",
+        lambda: stream_fully_adapt_template(template, use_case_description, llm),
+        lambda text: finalize_streamed_adaptation(text, template, use_case_description, llm),
+        subscriber
+    )
+
+def submit_refinement(current_output: str, user_feedback: str, llm, subscriber: Hashable = None) -> Job:
+    """Start refining the current output with the user's feedback."""
+    key = ("refine", _digest(current_output), user_feedback.strip(), llm is None)
+    if llm and incremental_refinement_applies(current_output, user_feedback):
+        # Small, targeted edits only regenerate the affected sections; there is no partial text
+        return get_job_executor().submit(
+            key, "refine",
+            lambda: iter([refine_output_incremental(current_output, user_feedback, llm)]),
+            subscriber=subscriber
+        )
+    return get_job_executor().submit(
+        key, "refine",
+        lambda: stream_refine_output(current_output, user_feedback, llm),
+        lambda text: finalize_streamed_output(text, current_output),
+        subscriber
+    )
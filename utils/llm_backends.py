@@ -0,0 +1,436 @@
+# utils/llm_backends.py
+"""LLM backends behind the `llm(prompt, max_length)` interface, and a router between them.
+
+    LLM_BACKEND=auto     Gemini when a key is set, plus a local model if LOCAL_LLM_MODEL is set
+    LLM_BACKEND=gemini   Gemini only
+    LLM_BACKEND=local    the local CPU model only
+    LLM_BACKEND=stub     the deterministic offline StubLLM (utils/llm_stub.py)
+
+With more than one backend, an LLMRouter picks one per request by prompt
+size, expected latency, health and remaining quota, and falls back to the
+next on failure.
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+
+try:
+    import torch
+    from transformers import (AutoTokenizer, AutoModelForCausalLM, TextIteratorStreamer, StoppingCriteria,
+                              StoppingCriteriaList)
+    HAVE_TRANSFORMERS = True
+except ImportError:
+    HAVE_TRANSFORMERS = False
+
+from utils.llm_utils import (
+    GeminiLLM,
+    LLMResult,
+    LLMError,
+    GEMINI_MODEL_NAME,
+    GEMINI_API_KEY,
+    HAVE_GENAI,
+    HEALTH_RETRY_INTERVAL
+)
+from utils.llm_stub import StubLLM
+from utils.response_cache import get_response_cache, make_cache_key
+from utils.prompt_builder import count_tokens
+from utils.instrumentation import span, increment, estimate_tokens
+
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "auto").lower()
+# A Hugging Face causal LM to run on CPU, e.g. "Qwen/Qwen2.5-0.5B-Instruct". Unset, there is no local backend.
+LOCAL_LLM_MODEL = os.environ.get("LOCAL_LLM_MODEL", "")
+LOCAL_LLM_MAX_PROMPT_TOKENS = int(os.environ.get("LOCAL_LLM_MAX_PROMPT_TOKENS", "2048"))
+LOCAL_LLM_MAX_NEW_TOKENS = int(os.environ.get("LOCAL_LLM_MAX_NEW_TOKENS", "1024"))
+# Expected latency, in seconds, a request may take on a backend before another is preferred
+LLM_LATENCY_SLO = float(os.environ.get("LLM_LATENCY_SLO", "20"))
+# Requests for at most this many output tokens (e.g. recommendations) run locally when possible
+LOCAL_SMALL_JOB_TOKENS = int(os.environ.get("LOCAL_SMALL_JOB_TOKENS", "64"))
+# How long a backend is passed over after it fails a request
+BACKEND_COOLDOWN = float(os.environ.get("LLM_BACKEND_COOLDOWN", "30"))
+# Attention key/value states kept for this many prompt prefixes on the local model (tens of MB each)
+LOCAL_KV_CACHE_ENTRIES = int(os.environ.get("LOCAL_KV_CACHE_ENTRIES", "4"))
+
+class BackendStats:
+    """Latency bookkeeping for routing: a moving average of seconds per output token."""
+
+    name = "backend"
+    local = False
+    max_prompt_tokens = 1_000_000
+    seconds_per_token = 0.01
+    base_latency = 0.5
+
+    def observe(self, result: LLMResult):
+        if not result.ok or result.cached:
+            return
+        tokens = result.output_tokens or estimate_tokens(result.text)
+        if tokens:
+            per_token = max(0.0, result.latency - self.base_latency) / tokens
+            self.seconds_per_token = 0.8 * self.seconds_per_token + 0.2 * per_token
+
+    def estimated_latency(self, max_length: int) -> float:
+        """Worst case for a request: the whole output budget generated at the observed rate."""
+        return self.base_latency + self.seconds_per_token * max_length
+
+    def has_quota(self) -> bool:
+        return True
+
+class GeminiBackend(BackendStats, GeminiLLM):
+    """The Gemini API, with its shared rate limit as the quota."""
+
+    name = "gemini"
+
+    def generate(self, prompt: str, max_length: int = 512, deadline: Optional[float] = None) -> LLMResult:
+        result = super().generate(prompt, max_length, deadline)
+        self.observe(result)
+        return result
+
+    def has_quota(self) -> bool:
+        return self.client.has_quota()
+
+class StubBackend(BackendStats, StubLLM):
+    """The offline StubLLM, for load tests and development without an API key."""
+
+    name = "stub"
+    local = True
+
+    def estimated_latency(self, max_length: int) -> float:
+        rate = max_length / self.tokens_per_second if self.tokens_per_second else 0.0
+        return self.latency + rate
+
+class LocalTransformersBackend(BackendStats):
+    """A small instruction-tuned model run on CPU with transformers.
+
+    The model is loaded in the background on first use; until then the
+    backend reports health "unknown" and is not ready. Greedy decoding makes
+    responses deterministic, so they go through the shared response cache.
+    The key/value states of recent prompt prefixes are kept, so a request
+    for a template seen before only runs the model over its own suffix.
+    """
+
+    local = True
+    seconds_per_token = 0.05
+    base_latency = 1.0
+
+    def __init__(self, model_name: str = LOCAL_LLM_MODEL, max_prompt_tokens: int = LOCAL_LLM_MAX_PROMPT_TOKENS,
+                 max_new_tokens: int = LOCAL_LLM_MAX_NEW_TOKENS, response_cache=None,
+                 kv_cache_entries: int = LOCAL_KV_CACHE_ENTRIES):
+        self.name = f"local:{model_name}"
+        self.model_name = model_name
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_new_tokens = max_new_tokens
+        self.response_cache = response_cache
+        self.health_status = "unknown"
+        self.health_error = ""
+        self._tokenizer = None
+        self._model = None
+        self._load_lock = threading.Lock()
+        self._load_thread: Optional[threading.Thread] = None
+        self._load_failed_at = 0.0
+        # One generation at a time: a CPU model gains nothing from running requests side by side
+        self._generate_lock = threading.Lock()
+        self.kv_cache_entries = kv_cache_entries
+        # prefix hash -> (prefix token ids, past key values); used under _generate_lock
+        self._prefix_states: "OrderedDict[str, Tuple[List[int], Any]]" = OrderedDict()
+
+    def check_health(self, force: bool = False):
+        """Start loading the model in the background if it isn't loaded or loading."""
+        with self._load_lock:
+            if self._model is not None or (self._load_thread is not None and self._load_thread.is_alive()):
+                return
+            if not force and self._load_failed_at and time.monotonic() - self._load_failed_at < HEALTH_RETRY_INTERVAL:
+                return
+            self._load_thread = threading.Thread(target=self._load, name="local-llm-load", daemon=True)
+            self._load_thread.start()
+
+    def _load(self):
+        try:
+            print(f"Loading local model {self.model_name}...")
+            tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            model = AutoModelForCausalLM.from_pretrained(self.model_name, torch_dtype=torch.float32)
+            model.eval()
+            self._tokenizer, self._model = tokenizer, model
+            self.health_status = "ok"
+            self.health_error = ""
+            print(f"Local model {self.model_name} loaded")
+        except Exception as e:
+            print(f"Error loading local model {self.model_name}: {e}")
+            self.health_status = "error"
+            self.health_error = str(e)
+            self._load_failed_at = time.monotonic()
+
+    def is_ready(self) -> bool:
+        self.check_health()
+        return self._model is not None
+
+    def _input_ids(self, prompt: str):
+        if getattr(self._tokenizer, "chat_template", None):
+            return self._tokenizer.apply_chat_template([{"role": "user", "content": prompt}],
+                                                       add_generation_prompt=True, return_tensors="pt")
+        return self._tokenizer(prompt, return_tensors="pt").input_ids
+
+    def _prefix_ids(self, prompt) -> Optional[List[int]]:
+        """Token ids of the model input up to the end of prompt's cacheable prefix."""
+        if getattr(self._tokenizer, "chat_template", None):
+            rendered = self._tokenizer.apply_chat_template([{"role": "user", "content": prompt}],
+                                                          add_generation_prompt=True, tokenize=False)
+            start = rendered.find(prompt)
+            if start < 0:
+                return None
+            return self._tokenizer(rendered[:start + prompt.prefix_length], add_special_tokens=False).input_ids
+        return self._tokenizer(prompt.prefix).input_ids
+
+    def _prefix_state(self, prompt, input_ids):
+        """Past key values covering the start of input_ids, computed once per prompt prefix; or None."""
+        if not (self.kv_cache_entries and getattr(prompt, "prefix_length", 0)):
+            return None
+        ids = input_ids[0].tolist()
+        key = prompt.prefix_hash
+        state = self._prefix_states.get(key)
+        if state is not None:
+            prefix_ids, past = state
+            if len(prefix_ids) < len(ids) and ids[:len(prefix_ids)] == prefix_ids:
+                self._prefix_states.move_to_end(key)
+                increment("kv_prefix_cache", outcome="hit")
+                return past
+            return None
+
+        prefix_ids = self._prefix_ids(prompt)
+        if not prefix_ids:
+            return None
+        # Tokens can merge across the prefix boundary; keep the part that matches, and at least one token to run
+        length = 0
+        limit = min(len(prefix_ids), len(ids) - 1)
+        while length < limit and prefix_ids[length] == ids[length]:
+            length += 1
+        if length == 0:
+            return None
+        past = self._model(input_ids[:, :length], use_cache=True).past_key_values
+        if hasattr(past, "to_legacy_cache"):
+            # Tuples of tensors: generation extends a copy and leaves them intact for the next request
+            past = past.to_legacy_cache()
+        self._prefix_states[key] = (ids[:length], past)
+        while len(self._prefix_states) > self.kv_cache_entries:
+            self._prefix_states.popitem(last=False)
+        increment("kv_prefix_cache", outcome="miss")
+        return past
+
+    def _cache_key(self, prompt: str, max_new_tokens: int) -> str:
+        return make_cache_key(prompt, self.name, {"max_output_tokens": max_new_tokens, "temperature": 0})
+
+    def generate(self, prompt: str, max_length: int = 512, deadline: Optional[float] = None) -> LLMResult:
+        with span("llm.generate", model=self.name, max_length=max_length) as current:
+            result = self._generate(prompt, max_length)
+            current.set(output_tokens=result.output_tokens, cached=result.cached,
+                        finish_reason=result.finish_reason, error_kind=result.error_kind)
+            increment("llm_requests", model=self.name, outcome="cached" if result.cached else (result.error_kind or "ok"))
+            self.observe(result)
+            return result
+
+    def _generate(self, prompt: str, max_length: int) -> LLMResult:
+        if not self.is_ready():
+            return LLMResult(error_kind="unavailable", error="Local model is not loaded")
+        max_new_tokens = min(max_length, self.max_new_tokens)
+        cache_key = self._cache_key(prompt, max_new_tokens)
+        if self.response_cache:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                return LLMResult(text=cached, cached=True)
+
+        started = time.monotonic()
+        try:
+            with self._generate_lock, torch.inference_mode():
+                input_ids = self._input_ids(prompt)
+                output = self._model.generate(input_ids, max_new_tokens=max_new_tokens, do_sample=False,
+                                              pad_token_id=self._tokenizer.eos_token_id,
+                                              past_key_values=self._prefix_state(prompt, input_ids))
+        except Exception as e:
+            return LLMResult(error_kind="error", error=str(e), attempts=1, latency=time.monotonic() - started)
+
+        generated = output[0, input_ids.shape[1]:]
+        text = self._tokenizer.decode(generated, skip_special_tokens=True)
+        finish_reason = "MAX_TOKENS" if len(generated) >= max_new_tokens else "STOP"
+        if self.response_cache and text and finish_reason != "MAX_TOKENS":
+            self.response_cache.set(cache_key, text)
+        return LLMResult(text=text, attempts=1, latency=time.monotonic() - started, finish_reason=finish_reason,
+                         prompt_tokens=int(input_ids.shape[1]), output_tokens=len(generated))
+
+    def __call__(self, prompt, max_length=512) -> List[Dict[str, Any]]:
+        result = self.generate(prompt, max_length)
+        output = {"generated_text": result.text}
+        if not result.ok:
+            output["error"] = result.error_kind
+        if result.finish_reason:
+            output["finish_reason"] = result.finish_reason
+        return [output]
+
+    def stream(self, prompt, max_length=512) -> Iterator[str]:
+        """Yield the response as it is decoded. Raises LLMError on failure.
+
+        Generation runs on a worker thread that holds the model lock until it
+        finishes, so a consumer that stops reading never keeps the model
+        locked; closing the generator stops the worker at the next token and
+        waits for it.
+        """
+        if not self.is_ready():
+            raise LLMError(LLMResult(error_kind="unavailable", error="Local model is not loaded"))
+        max_new_tokens = min(max_length, self.max_new_tokens)
+        streamer = TextIteratorStreamer(self._tokenizer, skip_prompt=True, skip_special_tokens=True)
+        stop = threading.Event()
+        failure = []
+
+        def run():
+            try:
+                with self._generate_lock, torch.inference_mode():
+                    if stop.is_set():
+                        streamer.end()
+                        return
+                    input_ids = self._input_ids(prompt)
+                    self._model.generate(input_ids, max_new_tokens=max_new_tokens, do_sample=False,
+                                         pad_token_id=self._tokenizer.eos_token_id, streamer=streamer,
+                                         stopping_criteria=StoppingCriteriaList([_StopWhenSet(stop)]),
+                                         past_key_values=self._prefix_state(prompt, input_ids))
+            except Exception as e:
+                failure.append(e)
+                streamer.end()
+
+        worker = threading.Thread(target=run, name="local-llm-stream", daemon=True)
+        worker.start()
+        try:
+            for text in streamer:
+                if text:
+                    yield text
+        finally:
+            stop.set()
+            worker.join()
+        if failure:
+            raise LLMError(LLMResult(error_kind="error", error=str(failure[0])))
+
+if HAVE_TRANSFORMERS:
+    class _StopWhenSet(StoppingCriteria):
+        """Stops generation once `event` is set, e.g. when a stream's consumer goes away."""
+
+        def __init__(self, event: threading.Event):
+            self.event = event
+
+        def __call__(self, input_ids, scores, **kwargs) -> bool:
+            return self.event.is_set()
+
+class LLMRouter:
+    """Sends each request to the best available backend, falling back to the others.
+
+    Backends that are not ready, cooling down after a failure, or can't
+    take the prompt are skipped. Small requests (at most
+    `small_job_tokens` of output) prefer local backends, everything else
+    prefers remote ones; a backend out of quota, or expected to miss the
+    latency SLO, is only tried after the rest.
+    """
+
+    def __init__(self, backends: List[Any], latency_slo: float = LLM_LATENCY_SLO,
+                 small_job_tokens: int = LOCAL_SMALL_JOB_TOKENS, cooldown: float = BACKEND_COOLDOWN):
+        self.backends = backends
+        self.latency_slo = latency_slo
+        self.small_job_tokens = small_job_tokens
+        self.cooldown = cooldown
+        # Backends built by get_llm_backend share one response cache; expose it
+        # so callers can report its hit rate.
+        self.response_cache = next((b.response_cache for b in backends
+                                    if getattr(b, "response_cache", None) is not None), None)
+        self._cooling_until: Dict[str, float] = {}
+
+    @property
+    def health_status(self) -> str:
+        statuses = [backend.health_status for backend in self.backends]
+        if "ok" in statuses:
+            return "ok"
+        return "unknown" if "unknown" in statuses else "error"
+
+    def is_ready(self) -> bool:
+        # Checking every backend also starts their background health checks
+        return any([backend.is_ready() for backend in self.backends])
+
+    def route(self, prompt: str, max_length: int) -> List[Any]:
+        """Backends to try for a request, best first."""
+        prompt_tokens = count_tokens(prompt)
+        small = max_length <= self.small_job_tokens
+        now = time.monotonic()
+        candidates = [
+            (position, backend) for position, backend in enumerate(self.backends)
+            if backend.is_ready() and prompt_tokens <= backend.max_prompt_tokens
+        ]
+
+        def preference(candidate):
+            position, backend = candidate
+            return (
+                self._cooling_until.get(backend.name, 0.0) > now,
+                not backend.has_quota(),
+                backend.estimated_latency(max_length) > self.latency_slo,
+                backend.local != small,
+                position,
+            )
+        return [backend for position, backend in sorted(candidates, key=preference)]
+
+    def _failed(self, backend, result: LLMResult):
+        print(f"LLM backend {backend.name} failed ({result.error_kind}), trying the next one")
+        self._cooling_until[backend.name] = time.monotonic() + self.cooldown
+
+    def generate(self, prompt: str, max_length: int = 512, deadline: Optional[float] = None) -> LLMResult:
+        result = LLMResult(error_kind="unavailable", error="No LLM backend is available")
+        for backend in self.route(prompt, max_length):
+            result = backend.generate(prompt, max_length, deadline)
+            increment("llm_routed", backend=backend.name, outcome=result.error_kind or "ok")
+            if result.ok:
+                return result
+            self._failed(backend, result)
+        return result
+
+    def __call__(self, prompt, max_length=512) -> List[Dict[str, Any]]:
+        result = self.generate(prompt, max_length)
+        output = {"generated_text": result.text}
+        if not result.ok:
+            output["error"] = result.error_kind
+        if result.finish_reason:
+            output["finish_reason"] = result.finish_reason
+        return [output]
+
+    def stream(self, prompt, max_length=512) -> Iterator[str]:
+        """Stream from the best backend; falls back to the next only if nothing was produced yet."""
+        error = LLMError(LLMResult(error_kind="unavailable", error="No LLM backend is available"))
+        for backend in self.route(prompt, max_length):
+            produced = False
+            try:
+                for chunk in backend.stream(prompt, max_length):
+                    produced = True
+                    yield chunk
+                increment("llm_routed", backend=backend.name, outcome="ok")
+                return
+            except LLMError as e:
+                increment("llm_routed", backend=backend.name, outcome=e.result.error_kind)
+                if produced:
+                    raise
+                self._failed(backend, e.result)
+                error = e
+        raise error
+
+def create_llm(backend: str = LLM_BACKEND):
+    """Build the configured LLM: a single backend, a router over several, or None if none is usable."""
+    backends = []
+    if backend == "stub":
+        backends.append(StubBackend())
+    if backend in ("auto", "gemini") and HAVE_GENAI and GEMINI_API_KEY:
+        backends.append(GeminiBackend(GEMINI_MODEL_NAME, get_response_cache()))
+    if backend == "local" or (backend == "auto" and LOCAL_LLM_MODEL):
+        if not HAVE_TRANSFORMERS:
+            print("transformers is not installed, the local LLM backend is unavailable.")
+        elif not LOCAL_LLM_MODEL:
+            print("LLM_BACKEND=local needs LOCAL_LLM_MODEL to be set.")
+        else:
+            backends.append(LocalTransformersBackend(LOCAL_LLM_MODEL, response_cache=get_response_cache()))
+
+    for instance in backends:
+        if hasattr(instance, "check_health"):
+            instance.check_health()
+    if not backends:
+        return None
+    return backends[0] if len(backends) == 1 else LLMRouter(backends)
@@ -0,0 +1,143 @@
+# utils/llm_stub.py
+import re
+import time
+import random
+import hashlib
+import threading
+from typing import List, Dict, Any, Iterator, Optional
+
+from utils.llm_utils import LLMError, LLMResult, ADAPTATION_PREFIXES
+
+# Roughly four characters per token, as the prompts assume
+CHARS_PER_TOKEN = 4
+
+RESPONSE_SHAPES = ("echo", "prefixed", "short", "fixed")
+
+_SECTION_BLOCK = re.compile(r"<<<(S\d+)\n(.*?)\n>>>", re.DOTALL)
+
+def _between(prompt: str, start: str, end: str) -> Optional[str]:
+    begin = prompt.find(start)
+    if begin < 0:
+        return None
+    begin = prompt.find("\n", begin) + 1
+    finish = prompt.rfind(end)
+    return prompt[begin:finish] if finish > begin else None
+
+class StubLLM:
+    """Deterministic offline stand-in for the Gemini LLM, for benchmarks and local runs.
+
+    It follows the `llm(prompt, max_length)` -> `[{"generated_text": ...}]`
+    interface and understands the prompts in utils/llm_utils.py well enough
+    to give plausible answers:
+
+    - "echo": returns the template or section from the prompt unchanged
+      (patches for incremental refinement, "1,2" for recommendations)
+    - "prefixed": like echo, with a lead-in line the pipeline must strip
+    - "short": a one-line answer the pipeline should reject
+    - "fixed": always `fixed_text`
+
+    Each call waits `latency` seconds plus the output tokens at
+    `tokens_per_second`, fails with probability `error_rate`, and is cut
+    off at `max_length` tokens. Outcomes depend only on the seed, the
+    prompt and how often that prompt was seen, never on thread timing.
+    """
+
+    def __init__(self, latency: float = 0.05, tokens_per_second: float = 200.0, error_rate: float = 0.0,
+                 shape: str = "echo", seed: int = 0, fixed_text: str = "OK", stream_chunk_tokens: int = 16):
+        if shape not in RESPONSE_SHAPES:
+            raise ValueError(f"Unknown response shape {shape!r}, expected one of {RESPONSE_SHAPES}")
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.shape = shape
+        self.seed = seed
+        self.fixed_text = fixed_text
+        self.stream_chunk_tokens = stream_chunk_tokens
+        self.health_status = "ok"
+        self.response_cache = None
+        self._lock = threading.Lock()
+        self._seen: Dict[str, int] = {}
+        self.stats = {"calls": 0, "errors": 0, "prompt_tokens": 0, "output_tokens": 0}
+
+    def is_ready(self) -> bool:
+        return True
+
+    def _rng(self, prompt: str) -> random.Random:
+        digest = hashlib.sha1(prompt.encode('utf-8')).hexdigest()
+        with self._lock:
+            attempt = self._seen.get(digest, 0)
+            self._seen[digest] = attempt + 1
+        return random.Random(f"{self.seed}:{digest}:{attempt}")
+
+    def respond(self, prompt: str) -> str:
+        """The full (untruncated) response text for a prompt."""
+        if self.shape == "fixed":
+            return self.fixed_text
+        if self.shape == "short":
+            return "OK"
+
+        if "Return the template numbers" in prompt:
+            return "1,2"
+        if "SECTIONS YOU MAY EDIT:" in prompt:
+            return "\n".join(f"@@ REPLACE {section_id}\n{text}\n@@ END"
+                             for section_id, text in _SECTION_BLOCK.findall(prompt))
+        if "suggest appropriate values for these template variables" in prompt:
+            names = re.findall(r"^- (\S+)$", prompt, re.MULTILINE)
+            return "\n".join(f"{name}: example {name.replace('_', ' ')}" for name in names)
+
+        text = (_between(prompt, "PART TO ADAPT:", "\n\nUSER'S USE CASE DESCRIPTION:")
+                or _between(prompt, "ORIGINAL TEMPLATE (", "\n\nUSER'S USE CASE DESCRIPTION:")
+                or _between(prompt, "ORIGINAL TEMPLATE:", "\n\nUSER FEEDBACK:")
+                or prompt)
+        if self.shape == "prefixed":
+            text = f"{ADAPTATION_PREFIXES[0]}\n{text}"
+        return text
+
+    def generate(self, prompt: str, max_length: int = 512, deadline: Optional[float] = None) -> LLMResult:
+        rng = self._rng(prompt)
+        started = time.perf_counter()
+        failed = rng.random() < self.error_rate
+        text = "" if failed else self.respond(prompt)[:max_length * CHARS_PER_TOKEN]
+        output_tokens = len(text) // CHARS_PER_TOKEN
+        time.sleep(self.latency + (output_tokens / self.tokens_per_second if self.tokens_per_second else 0.0))
+
+        with self._lock:
+            self.stats["calls"] += 1
+            self.stats["prompt_tokens"] += len(prompt) // CHARS_PER_TOKEN
+            self.stats["output_tokens"] += output_tokens
+            self.stats["errors"] += failed
+        if failed:
+            return LLMResult(error_kind="unavailable", error="simulated failure", latency=time.perf_counter() - started)
+        finish_reason = "MAX_TOKENS" if output_tokens >= max_length else "STOP"
+        return LLMResult(text=text, latency=time.perf_counter() - started, finish_reason=finish_reason)
+
+    def __call__(self, prompt, max_length=512) -> List[Dict[str, Any]]:
+        result = self.generate(prompt, max_length)
+        output = {"generated_text": result.text}
+        if not result.ok:
+            output["error"] = result.error_kind
+        if result.finish_reason:
+            output["finish_reason"] = result.finish_reason
+        return [output]
+
+    def stream(self, prompt, max_length=512) -> Iterator[str]:
+        """Yield the response in chunks of `stream_chunk_tokens`, paced at `tokens_per_second`."""
+        rng = self._rng(prompt)
+        time.sleep(self.latency)
+        with self._lock:
+            self.stats["calls"] += 1
+            self.stats["prompt_tokens"] += len(prompt) // CHARS_PER_TOKEN
+        if rng.random() < self.error_rate:
+            with self._lock:
+                self.stats["errors"] += 1
+            raise LLMError(LLMResult(error_kind="unavailable", error="simulated failure"))
+
+        text = self.respond(prompt)[:max_length * CHARS_PER_TOKEN]
+        step = self.stream_chunk_tokens * CHARS_PER_TOKEN
+        for start in range(0, len(text), step):
+            chunk = text[start:start + step]
+            if self.tokens_per_second:
+                time.sleep(len(chunk) / CHARS_PER_TOKEN / self.tokens_per_second)
+            with self._lock:
+                self.stats["output_tokens"] += len(chunk) // CHARS_PER_TOKEN
+            yield chunk
@@ -1,6 +1,15 @@
 # utils/llm_utils.py
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, Optional
+from dataclasses import dataclass
 import os
+import re
+import time
+import random
+import asyncio
+import threading
+import hashlib
+import datetime
+import concurrent.futures
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -14,10 +23,38 @@ except ImportError:
     print("Google Generative AI package not found. Run 'pip install google-generativeai'")
     HAVE_GENAI = False
 
+try:
+    from google.generativeai import caching as genai_caching
+    HAVE_CONTEXT_CACHING = True
+except ImportError:
+    HAVE_CONTEXT_CACHING = False
+
+try:
+    from google.api_core import exceptions as google_exceptions
+    HAVE_GOOGLE_EXCEPTIONS = True
+except ImportError:
+    HAVE_GOOGLE_EXCEPTIONS = False
+
 from utils.template_utils import (
     extract_template_variables,
     fill_template
 )
+from utils.search_index import BM25Index, get_search_index, tokenize
+from utils.embedding_index import get_embedding_index
+from utils.response_cache import make_cache_key
+from utils.prompt_builder import Prompt, build_prompt, count_tokens, output_budget, PromptTooLarge
+from utils.instrumentation import span, instrumented, increment, record_fallback, estimate_tokens
+from utils.coalescing import SingleFlight, coalesce_description, normalize_description
+from utils.output_validator import validate_output, repair_output
+from utils.markdown_sections import (
+    Section,
+    split_sections,
+    join_sections,
+    heading_titles,
+    outline,
+    parse_section_patch,
+    apply_section_patch
+)
 
 # Set up the Gemini API
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY", "")  # Get from .env file
@@ -26,46 +63,645 @@ GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY", "")  # Get from .env file
 if GEMINI_API_KEY and HAVE_GENAI:
     genai.configure(api_key=GEMINI_API_KEY)
 
-def initialize_llm():
-    """Initialize Gemini API connection."""
-    if not HAVE_GENAI:
-        print("Google Generative AI package not installed.")
+GEMINI_MODEL_NAME = 'gemini-2.0-flash'
+
+# How long a health check result is trusted before it is re-validated in the background
+HEALTH_CHECK_INTERVAL = float(os.environ.get("LLM_HEALTH_CHECK_INTERVAL", "300"))
+HEALTH_RETRY_INTERVAL = float(os.environ.get("LLM_HEALTH_RETRY_INTERVAL", "30"))
+
+# Libraries bigger than this are shortlisted locally before asking the LLM
+RECOMMEND_SHORTLIST_SIZE = int(os.environ.get("RECOMMEND_SHORTLIST_SIZE", "20"))
+
+# Request limits shared by every session in the process (0 requests per minute: no rate limit)
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "4"))
+LLM_REQUESTS_PER_MINUTE = float(os.environ.get("LLM_REQUESTS_PER_MINUTE", "60"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "3"))
+LLM_DEADLINE = float(os.environ.get("LLM_DEADLINE", "90"))
+
+# Gemini context caching of prompt prefixes (instructions plus template) that repeat across requests.
+# The API rejects prefixes below a model-specific minimum size, and cache storage is billed per hour.
+# The bundled templates' prefixes are 1,000-1,300 tokens, under the minimum for gemini-2.0-flash,
+# so with the default model nothing is cached; newer models accept smaller caches.
+CONTEXT_CACHE_ENABLED = os.environ.get("GEMINI_CONTEXT_CACHE", "1").lower() not in ("0", "false", "no")
+CONTEXT_CACHE_MIN_TOKENS_BY_MODEL = {
+    "gemini-2.5-flash": 1024,
+    "gemini-2.5-pro": 4096,
+    "gemini-2.0-flash": 4096,
+    "gemini-1.5-flash": 32768,
+    "gemini-1.5-pro": 32768,
+}
+# Overrides the per-model minimum when set
+CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "0"))
+# A prefix is cached once this many requests have used it within the TTL
+CONTEXT_CACHE_MIN_USES = int(os.environ.get("GEMINI_CONTEXT_CACHE_MIN_USES", "2"))
+CONTEXT_CACHE_TTL = float(os.environ.get("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+# Cached content is tied to a stable model version
+CONTEXT_CACHE_MODEL_NAME = os.environ.get("GEMINI_CONTEXT_CACHE_MODEL", f"models/{GEMINI_MODEL_NAME}-001")
+
+def context_cache_min_tokens(model_name: str) -> int:
+    """The smallest prefix, in tokens, the API will cache for a model (the longest matching name wins)."""
+    if CONTEXT_CACHE_MIN_TOKENS > 0:
+        return CONTEXT_CACHE_MIN_TOKENS
+    name = model_name.split("/")[-1]
+    matches = [prefix for prefix in CONTEXT_CACHE_MIN_TOKENS_BY_MODEL if name.startswith(prefix)]
+    if not matches:
+        return max(CONTEXT_CACHE_MIN_TOKENS_BY_MODEL.values())
+    return CONTEXT_CACHE_MIN_TOKENS_BY_MODEL[max(matches, key=len)]
+
+@dataclass
+class LLMResult:
+    """Outcome of one LLM request. `error_kind` is None on success."""
+    text: str = ""
+    error_kind: Optional[str] = None  # "rate_limited", "timeout", "unavailable", "blocked", "invalid_request" or "error"
+    error: str = ""
+    attempts: int = 0
+    latency: float = 0.0
+    finish_reason: Optional[str] = None
+    cached: bool = False
+    prompt_tokens: int = 0
+    output_tokens: int = 0
+
+    @property
+    def ok(self) -> bool:
+        return self.error_kind is None
+
+class LLMError(Exception):
+    """Raised by streaming calls, which cannot return an LLMResult, when a request fails."""
+
+    def __init__(self, result: LLMResult):
+        super().__init__(f"{result.error_kind}: {result.error}")
+        self.result = result
+
+# Errors worth retrying; everything else fails fast
+RETRYABLE_ERRORS = ("rate_limited", "timeout", "unavailable")
+
+def classify_llm_error(error: Exception) -> str:
+    """Map an exception from the Gemini SDK to one of our error kinds."""
+    if HAVE_GOOGLE_EXCEPTIONS:
+        if isinstance(error, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)):
+            return "rate_limited"
+        if isinstance(error, (google_exceptions.DeadlineExceeded, google_exceptions.GatewayTimeout)):
+            return "timeout"
+        if isinstance(error, (google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError,
+                              google_exceptions.BadGateway)):
+            return "unavailable"
+        if isinstance(error, (google_exceptions.InvalidArgument, google_exceptions.PermissionDenied,
+                              google_exceptions.Unauthenticated, google_exceptions.NotFound)):
+            return "invalid_request"
+    if isinstance(error, (TimeoutError, concurrent.futures.TimeoutError)):
+        return "timeout"
+    if isinstance(error, ConnectionError):
+        return "unavailable"
+    if type(error).__name__ in ("BlockedPromptException", "StopCandidateException"):
+        return "blocked"
+    if isinstance(error, ValueError) and "response.text" in str(error):
+        # The SDK raises ValueError when a response has no text (e.g. safety-blocked)
+        return "blocked"
+    return "error"
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, bursts of up to `capacity`.
+
+    A rate of 0 or less means no limit.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: float) -> bool:
+        """Take one token, waiting up to `timeout` seconds. Returns False if none became available."""
+        if self.rate <= 0:
+            return True
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def available(self) -> float:
+        """Tokens that could be taken right now, without taking them."""
+        if self.rate <= 0:
+            return self.capacity
+        with self._lock:
+            return min(self.capacity, self._tokens + (time.monotonic() - self._updated) * self.rate)
+
+class ContextCache:
+    """Gemini cached contents for prompt prefixes that repeat across requests.
+
+    A Prompt's prefix is cached once it has been used `min_uses` times
+    within the TTL and is at least `min_tokens` long (by default the
+    model's minimum); requests with a cached prefix send only their suffix,
+    to a model bound to the cache. Creating a cache takes a token from
+    `rate_limiter` and is waited for no longer than the caller's timeout;
+    a creation that finishes later is still used by later requests. While
+    one request creates a cache, others send their whole prompt. Failures
+    are remembered so a prefix is not retried until its entry expires.
+    """
+
+    def __init__(self, model_name: str = CONTEXT_CACHE_MODEL_NAME, min_tokens: Optional[int] = None,
+                 min_uses: int = CONTEXT_CACHE_MIN_USES, ttl: float = CONTEXT_CACHE_TTL, max_entries: int = 256,
+                 rate_limiter: TokenBucket = None):
+        self.model_name = model_name
+        self.min_tokens = context_cache_min_tokens(model_name) if min_tokens is None else min_tokens
+        self.min_uses = min_uses
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.rate_limiter = rate_limiter
+        self._lock = threading.Lock()
+        # prefix hash -> {"uses", "expires", "model", "failed", "creating"}
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="context-cache")
+
+    def model_for(self, prompt: str, timeout: float):
+        """The model bound to prompt's cached prefix, or None to send the whole prompt as usual."""
+        if not isinstance(prompt, Prompt) or not prompt.prefix_length:
+            return None
+        if count_tokens(prompt.prefix) < self.min_tokens:
+            return None
+        key = prompt.prefix_hash
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["expires"] <= now:
+                if len(self._entries) >= self.max_entries:
+                    self._prune(now)
+                entry = self._entries[key] = {"uses": 0, "expires": now + self.ttl, "model": None,
+                                              "failed": False, "creating": False}
+            entry["uses"] += 1
+            model = entry["model"]
+            if model is None and (entry["failed"] or entry["creating"] or entry["uses"] < self.min_uses):
+                return None
+            if model is None:
+                entry["creating"] = True
+        if model is not None:
+            increment("context_cache", outcome="hit")
+            return model
+        return self._create(entry, prompt.prefix, timeout)
+
+    def _create(self, entry: Dict[str, Any], prefix: str, timeout: float):
+        if self.rate_limiter is not None and not self.rate_limiter.acquire(max(0.0, timeout)):
+            with self._lock:
+                entry["creating"] = False
+            return None
+        future = self._executor.submit(self._create_model, prefix)
+        future.add_done_callback(lambda done: self._created(entry, done))
+        try:
+            return future.result(timeout=max(0.0, timeout))
+        except Exception:
+            # Failures are recorded by _created; a creation still running is used once it finishes
+            return None
+
+    def _create_model(self, prefix: str):
+        # Leave a margin so a request never uses a cache the API is about to drop
+        cached = genai_caching.CachedContent.create(
+            model=self.model_name, contents=[prefix],
+            ttl=datetime.timedelta(seconds=self.ttl + 60)
+        )
+        return genai.GenerativeModel.from_cached_content(cached)
+
+    def _created(self, entry: Dict[str, Any], future: concurrent.futures.Future):
+        error = future.exception()
+        with self._lock:
+            entry["creating"] = False
+            if error is None:
+                entry["model"] = future.result()
+                entry["expires"] = time.monotonic() + self.ttl
+            else:
+                entry["failed"] = True
+        if error is None:
+            increment("context_cache", outcome="created")
+        else:
+            print(f"Could not create a context cache for a prompt prefix: {error}")
+            increment("context_cache", outcome="error")
+
+    def invalidate(self, prompt: str):
+        """Stop using prompt's cached prefix, e.g. after the API no longer recognizes it."""
+        with self._lock:
+            entry = self._entries.get(prompt.prefix_hash)
+            if entry is not None:
+                entry["model"] = None
+                entry["failed"] = True
+
+    def _prune(self, now: float):
+        for key in [key for key, entry in self._entries.items() if entry["expires"] <= now]:
+            del self._entries[key]
+        while len(self._entries) >= self.max_entries:
+            del self._entries[next(iter(self._entries))]
+
+def is_stale_cache_error(error: Exception) -> bool:
+    """True if a request failed because the API no longer knows (or rejects) its cached content."""
+    if HAVE_GOOGLE_EXCEPTIONS and isinstance(error, google_exceptions.NotFound):
+        return True
+    return classify_llm_error(error) == "invalid_request" and "cache" in str(error).lower()
+
+def finish_reason_of(response) -> Optional[str]:
+    """The finish reason name of a response or streamed chunk, e.g. "STOP" or "MAX_TOKENS", if it has one."""
+    if not getattr(response, "candidates", None):
         return None
-        
-    if not GEMINI_API_KEY:
-        print("No Gemini API key found in .env file.")
+    name = getattr(response.candidates[0].finish_reason, "name", None)
+    return None if name == "FINISH_REASON_UNSPECIFIED" else name
+
+class LLMClient:
+    """Shared Gemini transport with backpressure, retries and deadlines.
+
+    All sessions go through one client per process, so a single model
+    object (and its underlying connection) is reused. Concurrency is bounded
+    by a semaphore and request rate by a token bucket; retryable errors are
+    retried with exponential backoff and full jitter until the per-call
+    deadline runs out. Failures come back as LLMResult values instead of
+    empty strings. Repeated prompt prefixes are served from a Gemini
+    context cache when they are large enough for the API to accept.
+    """
+
+    def __init__(self, model_name: str = GEMINI_MODEL_NAME, max_concurrency: int = LLM_MAX_CONCURRENCY,
+                 requests_per_minute: float = LLM_REQUESTS_PER_MINUTE, max_retries: int = LLM_MAX_RETRIES,
+                 deadline: float = LLM_DEADLINE, base_delay: float = 1.0, max_delay: float = 20.0):
+        self.model_name = model_name
+        self.max_retries = max_retries
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._rate_limiter = TokenBucket(requests_per_minute / 60.0, max(1.0, max_concurrency))
+        self._model = None
+        self._model_lock = threading.Lock()
+        self.context_cache = (ContextCache(rate_limiter=self._rate_limiter)
+                              if CONTEXT_CACHE_ENABLED and HAVE_CONTEXT_CACHING else None)
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    self._model = genai.GenerativeModel(self.model_name)
+        return self._model
+
+    def has_quota(self) -> bool:
+        """True if a request could start now without waiting for the rate limit."""
+        return self._rate_limiter.available() >= 1
+
+    def _request(self, prompt: str, use_cache: bool, deadline_at: float):
+        """The model and contents to send: the suffix alone when the prompt's prefix is cached.
+
+        Called holding a concurrency slot, so creating a cache is limited and
+        bounded by the deadline like any other request.
+        """
+        model = None
+        if use_cache and self.context_cache:
+            model = self.context_cache.model_for(prompt, deadline_at - time.monotonic())
+        if model is None:
+            return self.model, prompt
+        return model, prompt.suffix
+
+    def _drop_stale_cache(self, prompt: str, model, error: Exception) -> bool:
+        """Stop using a cached prefix the API no longer accepts; True if the request should be resent whole.
+
+        Other failures (rate limits, timeouts) keep the cache and are retried as usual.
+        """
+        if model is self.model or not is_stale_cache_error(error):
+            return False
+        self.context_cache.invalidate(prompt)
+        return True
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _acquire(self, deadline_at: float) -> Optional[LLMResult]:
+        """Wait for a concurrency slot and a rate-limit token; returns an error result on timeout."""
+        if not self._slots.acquire(timeout=max(0.0, deadline_at - time.monotonic())):
+            return LLMResult(error_kind="timeout", error="Timed out waiting for a free LLM slot")
+        if not self._rate_limiter.acquire(max(0.0, deadline_at - time.monotonic())):
+            self._slots.release()
+            return LLMResult(error_kind="rate_limited", error="Local request rate limit reached")
         return None
-    
-    try:
-        # Create a simple test to verify connection - using the newest model
-        model = genai.GenerativeModel('gemini-2.0-flash')  # Updated to the latest model
-        response = model.generate_content("Hello")
-        print("Gemini API connected successfully!")
-        
-        # Create a wrapper function to match our expected interface
-        def gemini_wrapper(prompt, max_length=512):
+
+    def generate(self, prompt: str, generation_config: Dict[str, Any],
+                 deadline: Optional[float] = None) -> LLMResult:
+        """Generate a response, retrying transient failures until the deadline (in seconds)."""
+        started = time.monotonic()
+        deadline_at = started + (deadline or self.deadline)
+        use_cache = True
+        result = LLMResult()
+        for attempt in range(self.max_retries + 1):
+            failure = self._acquire(deadline_at)
+            if failure:
+                failure.attempts = attempt
+                failure.latency = time.monotonic() - started
+                return failure
+            model = self.model
+            stale_cache = False
             try:
-                response = model.generate_content(prompt, generation_config={
-                    "max_output_tokens": max_length,
-                    "temperature": 0.2  # Lower temperature for more consistent outputs
-                })
-                # Format to match our expected format
-                return [{"generated_text": response.text}]
+                model, contents = self._request(prompt, use_cache, deadline_at)
+                response = model.generate_content(
+                    contents, generation_config=generation_config,
+                    request_options={"timeout": max(1.0, deadline_at - time.monotonic())}
+                )
+                text = response.text
+                usage = getattr(response, "usage_metadata", None)
+                return LLMResult(text=text, attempts=attempt + 1, finish_reason=finish_reason_of(response),
+                                 latency=time.monotonic() - started,
+                                 prompt_tokens=getattr(usage, "prompt_token_count", 0) or 0,
+                                 output_tokens=getattr(usage, "candidates_token_count", 0) or 0)
             except Exception as e:
-                print(f"Error generating content: {e}")
-                # Return empty text on error
-                return [{"generated_text": ""}]
-        
-        return gemini_wrapper
-    except Exception as e:
-        print(f"Error initializing Gemini API: {e}")
-        return None
+                result = LLMResult(error_kind=classify_llm_error(e), error=str(e), attempts=attempt + 1)
+                stale_cache = self._drop_stale_cache(prompt, model, e)
+            finally:
+                self._slots.release()
 
+            if stale_cache and attempt < self.max_retries:
+                # Resend the whole prompt at once; the failure was ours, not the API's load
+                use_cache = False
+                continue
+            delay = self._backoff(attempt)
+            if (result.error_kind not in RETRYABLE_ERRORS or attempt == self.max_retries
+                    or time.monotonic() + delay >= deadline_at):
+                break
+            print(f"LLM request failed ({result.error_kind}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+        result.latency = time.monotonic() - started
+        print(f"LLM request failed after {result.attempts} attempt(s): {result.error_kind}: {result.error}")
+        return result
+
+    def stream(self, prompt: str, generation_config: Dict[str, Any],
+               deadline: Optional[float] = None, outcome: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+        """Yield response chunks. Retries only before the first chunk; raises LLMError on failure.
+
+        If `outcome` is given, its "finish_reason" is set from the last chunk.
+        """
+        started = time.monotonic()
+        deadline_at = started + (deadline or self.deadline)
+        use_cache = True
+        for attempt in range(self.max_retries + 1):
+            failure = self._acquire(deadline_at)
+            if failure:
+                failure.attempts = attempt
+                raise LLMError(failure)
+            produced = False
+            model = self.model
+            stale_cache = False
+            try:
+                model, contents = self._request(prompt, use_cache, deadline_at)
+                response = model.generate_content(
+                    contents, generation_config=generation_config, stream=True,
+                    request_options={"timeout": max(1.0, deadline_at - time.monotonic())}
+                )
+                for chunk in response:
+                    if outcome is not None:
+                        outcome["finish_reason"] = finish_reason_of(chunk) or outcome.get("finish_reason")
+                    text = chunk.text
+                    if text:
+                        produced = True
+                        yield text
+                return
+            except Exception as e:
+                result = LLMResult(error_kind=classify_llm_error(e), error=str(e), attempts=attempt + 1,
+                                   latency=time.monotonic() - started)
+                stale_cache = not produced and self._drop_stale_cache(prompt, model, e)
+            finally:
+                self._slots.release()
+
+            if stale_cache and attempt < self.max_retries:
+                use_cache = False
+                continue
+            delay = self._backoff(attempt)
+            if (produced or result.error_kind not in RETRYABLE_ERRORS or attempt == self.max_retries
+                    or time.monotonic() + delay >= deadline_at):
+                raise LLMError(result)
+            print(f"LLM stream failed ({result.error_kind}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+        raise LLMError(result)
+
+    async def agenerate(self, prompt: str, generation_config: Dict[str, Any],
+                        deadline: Optional[float] = None) -> LLMResult:
+        """Async version of generate.
+
+        Runs on a worker thread so that every event loop and every session
+        shares the same concurrency and rate limits.
+        """
+        return await asyncio.to_thread(self.generate, prompt, generation_config, deadline)
+
+    async def agenerate_many(self, prompts: List[str], generation_config: Dict[str, Any],
+                             deadline: Optional[float] = None) -> List[LLMResult]:
+        """Generate several prompts concurrently, in order; the client's limits apply."""
+        return await asyncio.gather(*(self.agenerate(prompt, generation_config, deadline) for prompt in prompts))
+
+class GeminiLLM:
+    """Callable wrapper around a Gemini model matching our expected interface.
+
+    `llm(prompt, max_length)` returns `[{"generated_text": ...}]`, and
+    `llm.stream(prompt, max_length)` yields the text in chunks as it is generated.
+    Failed requests add an "error" key with the error kind, so callers can
+    tell a failure from a short answer; `llm.generate` returns the LLMResult.
+    Connectivity is verified by a background health check instead of a
+    blocking test generation.
+    """
+
+    def __init__(self, model_name: str = GEMINI_MODEL_NAME, response_cache=None, client: LLMClient = None):
+        self.model_name = model_name
+        self.response_cache = response_cache
+        self.client = client or LLMClient(model_name)
+        self.health_status = "unknown"  # "unknown", "ok" or "error"
+        self.health_error = ""
+        self._health_lock = threading.Lock()
+        self._health_thread: Optional[threading.Thread] = None
+        self._health_checked = 0.0
+
+    def check_health(self, force: bool = False):
+        """Start a background health check unless the cached status is still fresh."""
+        with self._health_lock:
+            if self._health_thread is not None and self._health_thread.is_alive():
+                return
+            interval = HEALTH_CHECK_INTERVAL if self.health_status == "ok" else HEALTH_RETRY_INTERVAL
+            if not force and self._health_checked and time.monotonic() - self._health_checked < interval:
+                return
+            self._health_thread = threading.Thread(target=self._run_health_check,
+                                                   name="llm-health-check", daemon=True)
+            self._health_thread.start()
+
+    def _run_health_check(self):
+        try:
+            # A model metadata lookup verifies the key and model without spending generation quota
+            genai.get_model(f"models/{self.model_name}", request_options={"timeout": 10, "retry": None})
+            if self.health_status != "ok":
+                print("Gemini API connected successfully!")
+            self.health_status = "ok"
+            self.health_error = ""
+        except Exception as e:
+            print(f"Error checking Gemini API: {e}")
+            self.health_status = "error"
+            self.health_error = str(e)
+        self._health_checked = time.monotonic()
+
+    def is_ready(self) -> bool:
+        """True if the last health check succeeded; re-validates in the background when stale."""
+        self.check_health()
+        return self.health_status == "ok"
+
+    def _generation_config(self, max_length: int) -> Dict[str, Any]:
+        return {
+            "max_output_tokens": max_length,
+            "temperature": 0.2  # Lower temperature for more consistent outputs
+        }
+
+    def generate(self, prompt: str, max_length: int = 512, deadline: Optional[float] = None) -> LLMResult:
+        """Generate a response, answering identical requests from the cache."""
+        with span("llm.generate", model=self.model_name, max_length=max_length) as current:
+            result = self._generate(prompt, max_length, deadline)
+            self._record(current, prompt, result)
+            return result
+
+    def _generate(self, prompt: str, max_length: int, deadline: Optional[float]) -> LLMResult:
+        generation_config = self._generation_config(max_length)
+        # Identical requests are answered from the cache without using API quota
+        cache_key = make_cache_key(prompt, self.model_name, generation_config)
+        if self.response_cache:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                return LLMResult(text=cached, cached=True)
+        result = self.client.generate(prompt, generation_config, deadline)
+        # A response cut off at max_output_tokens is not worth serving again
+        if result.ok and self.response_cache and result.text and result.finish_reason != "MAX_TOKENS":
+            self.response_cache.set(cache_key, result.text)
+        return result
+
+    def _record(self, current, prompt: str, result: LLMResult):
+        """Add a request's tokens, retries and outcome to its span and the LLM counters."""
+        prompt_tokens = result.prompt_tokens or estimate_tokens(prompt)
+        output_tokens = result.output_tokens or estimate_tokens(result.text)
+        current.set(prompt_chars=len(prompt), prompt_tokens=prompt_tokens, output_tokens=output_tokens,
+                    cached=result.cached, attempts=result.attempts, finish_reason=result.finish_reason,
+                    error_kind=result.error_kind)
+        outcome = "cached" if result.cached else (result.error_kind or "ok")
+        increment("llm_requests", model=self.model_name, outcome=outcome)
+        if not result.cached:
+            increment("llm_prompt_tokens", prompt_tokens, model=self.model_name)
+            increment("llm_output_tokens", output_tokens, model=self.model_name)
+            if result.attempts > 1:
+                increment("llm_retries", result.attempts - 1, model=self.model_name)
+
+    async def agenerate(self, prompt: str, max_length: int = 512, deadline: Optional[float] = None) -> LLMResult:
+        """Async version of generate."""
+        return await asyncio.to_thread(self.generate, prompt, max_length, deadline)
+
+    def __call__(self, prompt, max_length=512):
+        result = self.generate(prompt, max_length)
+        # Format to match our expected format
+        output = {"generated_text": result.text}
+        if not result.ok:
+            output["error"] = result.error_kind
+        if result.finish_reason:
+            output["finish_reason"] = result.finish_reason
+        return [output]
+
+    def stream(self, prompt, max_length=512) -> Iterator[str]:
+        """Yield the response text chunk by chunk as the model generates it. Raises LLMError on failure."""
+        with span("llm.stream", model=self.model_name, max_length=max_length) as current:
+            started = time.monotonic()
+            generation_config = self._generation_config(max_length)
+            cache_key = make_cache_key(prompt, self.model_name, generation_config)
+            if self.response_cache:
+                cached = self.response_cache.get(cache_key)
+                if cached is not None:
+                    self._record(current, prompt, LLMResult(text=cached, cached=True))
+                    yield cached
+                    return
+            chunks = []
+            outcome: Dict[str, Any] = {}
+            try:
+                for text in self.client.stream(prompt, generation_config, outcome=outcome):
+                    if not chunks:
+                        current.set(first_chunk_ms=round((time.monotonic() - started) * 1000, 1))
+                    chunks.append(text)
+                    yield text
+            except LLMError as e:
+                self._record(current, prompt, e.result)
+                raise
+            finish_reason = outcome.get("finish_reason")
+            self._record(current, prompt, LLMResult(text="".join(chunks), attempts=1, finish_reason=finish_reason))
+            # A stream cut off at max_output_tokens isn't cached, as in generate()
+            if self.response_cache and chunks and finish_reason != "MAX_TOKENS":
+                self.response_cache.set(cache_key, "".join(chunks))
+
+_shared_llm = None
+_shared_llm_lock = threading.Lock()
+_unavailable_reported = False
+
+def initialize_llm():
+    """Get the process-wide LLM, creating it on first call.
+
+    That is the Gemini client by default; LLM_BACKEND and LOCAL_LLM_MODEL
+    select other backends or a router between several (see
+    utils/llm_backends.py). This never blocks on the network or on loading
+    a model: readiness is verified in the background, so callers should
+    treat the LLM as unavailable until `is_ready()` returns True.
+    """
+    global _shared_llm, _unavailable_reported
+    if _shared_llm is not None:
+        return _shared_llm
+    
+    # Imported here because the backends build on this module
+    from utils.llm_backends import LLM_BACKEND, create_llm
+    
+    with _shared_llm_lock:
+        if _shared_llm is None:
+            llm = create_llm()
+            if llm is None:
+                # Report once per process rather than on every rerun
+                if not _unavailable_reported:
+                    _unavailable_reported = True
+                    if LLM_BACKEND not in ("auto", "gemini"):
+                        print(f"The {LLM_BACKEND} LLM backend is unavailable.")
+                    elif not HAVE_GENAI:
+                        print("Google Generative AI package not installed.")
+                    else:
+                        print("No Gemini API key found in .env file.")
+                return None
+            _shared_llm = llm
+    return _shared_llm
+
+def get_ready_llm():
+    """Return the shared LLM if its health check has passed, otherwise None (fallback mode)."""
+    llm = initialize_llm()
+    if llm is not None and llm.is_ready():
+        return llm
+    return None
+
+RECOMMEND_PROMPT = """Based on the following user description:
+"{user_description}"
+
+Please recommend the most suitable templates from this list:
+{template_text}
+
+Return the template numbers separated by commas (e.g., "1,3,5").
+"""
+
+@instrumented("pipeline.recommend")
 def recommend_templates(user_description: str, templates: List[Dict[str, Any]], llm) -> List[Dict[str, Any]]:
-    """Use the LLM to recommend templates based on the user's description."""
+    """Use the LLM to recommend templates based on the user's description.
+
+    Large libraries are first narrowed to a local shortlist, so the prompt
+    only ever lists RECOMMEND_SHORTLIST_SIZE templates.
+    """
     if not llm:
-        # Fallback to keyword matching if LLM isn't available
-        return keyword_based_recommendations(user_description, templates)
+        # Fallback to local ranking if LLM isn't available
+        record_fallback("recommend", "no_llm")
+        return local_recommendations(user_description, templates)
+    
+    if len(templates) > RECOMMEND_SHORTLIST_SIZE:
+        templates = local_recommendations(user_description, templates, top_k=RECOMMEND_SHORTLIST_SIZE)
     
     # Create a prompt that asks the LLM to recommend templates
     template_summaries = []
@@ -75,18 +711,19 @@ def recommend_templates(user_description: str, templates: List[Dict[str, Any]],
     
     template_text = "\n".join(template_summaries)
     
-    prompt = f"""Based on the following user description:
-"{user_description}"
-
-Please recommend the most suitable templates from this list:
-{template_text}
-
-Return the template numbers separated by commas (e.g., "1,3,5").
-"""
+    # Over budget, the list loses its lowest-ranked templates before the description is cut
+    prompt, _ = build_prompt(RECOMMEND_PROMPT, {"user_description": user_description, "template_text": template_text},
+                             {"template_text": 1, "user_description": 2})
     
     # Generate recommendations using the LLM
     try:
-        response = llm(prompt, max_length=50)[0]["generated_text"]
+        # A few tokens per listed template number
+        output = llm(prompt, max_length=max(16, 4 * len(templates)))[0]
+        if output.get("error"):
+            print(f"LLM recommendation failed ({output['error']}), using local ranking")
+            record_fallback("recommend", output["error"])
+            return local_recommendations(user_description, templates)
+        response = output["generated_text"]
         print(f"Raw recommendation response: {response}")
         
         # Extract the recommended template numbers
@@ -94,42 +731,75 @@ Return the template numbers separated by commas (e.g., "1,3,5").
         # Return the recommended templates
         recommended_templates = [templates[idx] for idx in recommended_indices if 0 <= idx < len(templates)]
         
-        # If no recommendations were found, fall back to keyword matching
+        # If no recommendations were found, fall back to local ranking
         if not recommended_templates:
-            print("No valid template indices found in response, using keyword matching")
-            return keyword_based_recommendations(user_description, templates)
+            print("No valid template indices found in response, using local ranking")
+            record_fallback("recommend", "unparseable_response")
+            return local_recommendations(user_description, templates)
         
         return recommended_templates
     except Exception as e:
         print(f"Error getting recommendations from LLM: {e}")
-        return keyword_based_recommendations(user_description, templates)
+        record_fallback("recommend", "exception")
+        return local_recommendations(user_description, templates)
 
-def keyword_based_recommendations(user_description: str, templates: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    """Fallback method using keyword matching for template recommendations."""
-    user_words = set(user_description.lower().split())
-    scored_templates = []
+@instrumented("pipeline.local_rank")
+def local_recommendations(user_description: str, templates: List[Dict[str, Any]],
+                          top_k: int = 3, index: BM25Index = None) -> List[Dict[str, Any]]:
+    """Rank templates without calling the LLM.
+
+    Uses the local embedding index when it is enabled and falls back to
+    BM25 keyword ranking otherwise (with `index`, if given).
+    """
+    embedding_index = get_embedding_index()
+    if embedding_index is not None:
+        try:
+            return [template for template, score in embedding_index.search(user_description, templates, top_k)]
+        except Exception as e:
+            print(f"Error ranking templates with embeddings: {e}")
+            record_fallback("local_rank", "embedding_error")
+    return keyword_based_recommendations(user_description, templates, top_k=top_k, index=index)
+
+def keyword_based_recommendations(user_description: str, templates: List[Dict[str, Any]],
+                                  top_k: int = 3, index: BM25Index = None) -> List[Dict[str, Any]]:
+    """Fallback method ranking templates with a BM25 full-text index.
+
+    If no prebuilt index is passed (e.g. the registry's), one is built for
+    `templates` and cached for later calls with the same list.
+    """
+    if index is None:
+        index = get_search_index(templates)
+        allowed = None
+    else:
+        allowed = {id(template) for template in templates}
+
+    recommended = [template for template, score in index.search(user_description, top_k, allowed)]
     
-    for template in templates:
-        score = 0
-        
-        # Check name and description for matches
-        text_to_match = f"{template['name']} {template['description']}".lower()
-        
-        # Add keywords if available
-        if 'keywords' in template:
-            text_to_match += " " + " ".join(template['keywords']).lower()
-        
-        # Simple word matching for score
-        for word in user_words:
-            if len(word) > 3 and word in text_to_match:  # Only match meaningful words
-                score += 1
-        
-        scored_templates.append((template, score))
+    # Pad with unmatched templates in their original order, as before
+    if len(recommended) < top_k:
+        chosen = {id(template) for template in recommended}
+        for template in templates:
+            if len(recommended) >= top_k:
+                break
+            if id(template) not in chosen:
+                recommended.append(template)
     
-    # Sort by score descending and return top 3
-    scored_templates.sort(key=lambda x: x[1], reverse=True)
-    return [t[0] for t in scored_templates[:3]]
+    return recommended
 
+VARIABLES_PROMPT = """Based on this user description:
+"{user_description}"
+
+And for this template:
+"{template_summary}"
+
+Please suggest appropriate values for these template variables:
+{vars_text}
+
+Format your response as:
+variable_name: suggested value
+"""
+
+@instrumented("pipeline.suggest_variables")
 def adjust_template_to_use_case(template: Dict[str, Any], user_description: str, 
                                variables: Dict[str, str], llm) -> Dict[str, str]:
     """Use the LLM to suggest values for template variables based on the user's description."""
@@ -145,21 +815,19 @@ def adjust_template_to_use_case(template: Dict[str, Any], user_description: str,
     # Create a prompt for the LLM to fill in the variables
     vars_text = "\n".join([f"- {var}" for var in needed_vars])
     
-    prompt = f"""Based on this user description:
-"{user_description}"
-
-And for this template:
-"{template['name']} - {template['description']}"
-
-Please suggest appropriate values for these template variables:
-{vars_text}
-
-Format your response as:
-variable_name: suggested value
-"""
-    
     try:
-        response = llm(prompt, max_length=512)[0]["generated_text"]
+        prompt, _ = build_prompt(VARIABLES_PROMPT, {
+            "user_description": user_description,
+            "template_summary": f"{template['name']} - {template['description']}",
+            "vars_text": vars_text
+        }, {"user_description": 1, "template_summary": 2})
+        # One short line per variable
+        output = llm(prompt, max_length=min(512, 64 + 48 * len(needed_vars)))[0]
+        if output.get("error"):
+            print(f"LLM variable suggestion failed ({output['error']})")
+            record_fallback("suggest_variables", output["error"])
+            return variables
+        response = output["generated_text"]
         
         # Parse the response to extract variable values
         for line in response.strip().split("\n"):
@@ -174,25 +842,103 @@ variable_name: suggested value
         return variables
     except Exception as e:
         print(f"Error adjusting template with LLM: {e}")
+        record_fallback("suggest_variables", "exception")
         return variables
 
-def refine_output(current_output: str, user_feedback: str, llm):
-    """Refine the template output based on user feedback."""
-    if not llm:
-        return current_output
+# Lead-in lines the model sometimes adds before the template itself
+REFINEMENT_PREFIXES = [
+    "Here's the complete template with the requested changes:",
+    "Here is the adapted template:",
+    "Here is the complete template with your changes:",
+    "I've incorporated your feedback. Here's the updated template:"
+]
+
+ADAPTATION_PREFIXES = [
+    "Here's the adapted template:",
+    "Here is the adapted template:",
+    "I've adapted the template to your use case:",
+    "Here's the template adapted to your scenario:"
+]
+
+def _strip_common_prefix(response: str, prefixes: List[str]) -> str:
+    for prefix in prefixes:
+        if response.startswith(prefix):
+            print(f"Removed prefix: {prefix}")
+            return response[len(prefix):].lstrip()
+    return response
+
+def _clean_response(response: str, original: str, prefixes: List[str]) -> str:
+    """Validate a generated template and strip any lead-in text, reverting to the original if unusable."""
+    # Basic validation - just check if it's too short
+    if len(response) < 100:
+        print(f"Response too short ({len(response)} chars), reverting to original")
+        record_fallback("validate", "response_too_short")
+        return original
     
-    # Make sure we have a substantial template to work with
-    if len(current_output) < 50:
-        print("Current template too short, cannot refine")
-        return current_output
+    # No more aggressive splitting that might remove top content
+    return _strip_common_prefix(response, prefixes)
+
+def _stream_llm(llm, prompt: str, max_length: int) -> Iterator[str]:
+    """Stream from the LLM if it supports it, otherwise yield the whole response at once."""
+    if hasattr(llm, "stream"):
+        yield from llm.stream(prompt, max_length=max_length)
+    else:
+        output = llm(prompt, max_length=max_length)[0]
+        if output.get("error"):
+            raise LLMError(LLMResult(error_kind=output["error"]))
+        yield output["generated_text"]
+
+def _strip_prefix_stream(chunks: Iterator[str], prefixes: List[str]) -> Iterator[str]:
+    """Strip a lead-in prefix from a stream of chunks, holding back only the first few chunks."""
+    chunks = iter(chunks)
+    longest = max(len(prefix) for prefix in prefixes)
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) > longest:
+            break
+    else:
+        # The whole response was shorter than the longest prefix
+        if buffer:
+            yield _strip_common_prefix(buffer, prefixes)
+        return
     
-    prompt = f"""IMPORTANT: You are adapting a template based on user feedback. Your job is to return the COMPLETE modified template.
+    yield _strip_common_prefix(buffer, prefixes)
+    yield from chunks
 
-ORIGINAL TEMPLATE:
-{current_output}
+def _repair_refinement(current_output: str, refined: str, finish_reason: Optional[str] = None) -> str:
+    """Restore sections a truncated refinement lost from the current template.
 
-USER FEEDBACK:
-"{user_feedback}"
+    Refinements may restructure the template on request, so only truncation is checked.
+    """
+    report = validate_output(current_output, refined, finish_reason, strict=False)
+    if report.ok:
+        return refined
+    print(f"Refinement was cut off, restoring {len(report.failing)} section(s) from the current template")
+    record_fallback("refine", "truncated")
+    increment("repaired_sections", len(report.failing), stage="refine")
+    return repair_output(report)
+
+def finalize_streamed_output(response: str, original: str) -> str:
+    """Validate a fully streamed refinement (prefixes already stripped), reverting to the original if unusable."""
+    print(f"Streamed: Length of original={len(original)}, Length of response={len(response)}")
+    cleaned = _clean_response(response, original, [])
+    if cleaned is original:
+        return original
+    return _repair_refinement(original, cleaned)
+
+def finalize_streamed_adaptation(response: str, template: Dict[str, Any], user_description: str, llm) -> str:
+    """Validate a fully streamed adaptation, regenerating only the sections that failed."""
+    original = template.get("content", "")
+    print(f"Streamed: Length of original={len(original)}, Length of response={len(response)}")
+    cleaned = _clean_response(response, original, [])
+    if cleaned is original or not llm:
+        return cleaned
+    return _repair_adaptation(template, user_description, llm, cleaned)
+
+# The prompts below put the static instructions and the template first and the per-user text
+# last, so every request for the same template shares a prefix the provider can cache.
+REFINEMENT_PROMPT = """IMPORTANT: You are adapting a template based on user feedback. Your job is to return the COMPLETE modified template.
 
 INSTRUCTIONS:
 1. Start by copying the entire original template
@@ -201,99 +947,473 @@ INSTRUCTIONS:
 4. Do NOT add any commentary, explanations, or "thank you" messages
 5. The output should be the COMPLETE template with the requested changes incorporated
 
+ORIGINAL TEMPLATE:
+{current_output}
+
+USER FEEDBACK:
+"{user_feedback}"
+
 OUTPUT THE ENTIRE TEMPLATE WITH CHANGES:
 """
+
+ADAPTATION_PROMPT = """You are helping to adapt a participatory design template to a specific use case.
+
+INSTRUCTIONS:
+1. KEEP all section titles and headings EXACTLY the same
+2. KEEP all steps and process instructions EXACTLY the same 
+3. KEEP all formatting EXACTLY the same
+4. ONLY change specific examples to be more relevant to the user's scenario
+5. DO NOT add new content or remove existing content
+6. DO NOT add any personal commentary or greeting message
+7. Start your response with the exact same line as the original template
+
+Return ONLY the adapted template content. 
+Do not include any explanatory text before or after the template.
+
+ORIGINAL TEMPLATE ({template_name}):
+{content}
+
+USER'S USE CASE DESCRIPTION:
+"{user_description}"
+"""
+
+# Refinements may add to the template, so they get more room to grow than adaptations
+REFINEMENT_OUTPUT_RATIO = 1.5
+
+def _refinement_prompt(current_output: str, user_feedback: str) -> str:
+    """Raises PromptTooLarge if the template itself doesn't fit the input budget."""
+    prompt, _ = build_prompt(REFINEMENT_PROMPT, {"current_output": current_output, "user_feedback": user_feedback},
+                             {"user_feedback": 1}, prefix_until="user_feedback")
+    return prompt
+
+def _refinement_max_tokens(current_output: str) -> int:
+    return output_budget(count_tokens(current_output), ratio=REFINEMENT_OUTPUT_RATIO)
+
+def _adaptation_prompt(template: Dict[str, Any], user_description: str) -> str:
+    """Raises PromptTooLarge if the template itself doesn't fit the input budget."""
+    prompt, _ = build_prompt(ADAPTATION_PROMPT, {
+        "user_description": user_description,
+        "template_name": template.get("name", "Template"),
+        "content": template.get("content", "")
+    }, {"user_description": 1}, prefix_until="user_description")
+    return prompt
+
+@instrumented("pipeline.refine")
+def refine_output(current_output: str, user_feedback: str, llm):
+    """Refine the template output based on user feedback."""
+    if not llm:
+        return current_output
+    
+    # Make sure we have a substantial template to work with
+    if len(current_output) < 50:
+        print("Current template too short, cannot refine")
+        return current_output
     
     try:
-        response = llm(prompt, max_length=2048)[0]["generated_text"]
+        prompt = _refinement_prompt(current_output, user_feedback)
+        output = llm(prompt, max_length=_refinement_max_tokens(current_output))[0]
+        if output.get("error"):
+            print(f"LLM refinement failed ({output['error']}), keeping current template")
+            record_fallback("refine", output["error"])
+            return current_output
+        response = output["generated_text"]
         print(f"Refinement: Length of original={len(current_output)}, Length of response={len(response)}")
-        
-        # Basic validation - just check if it's too short
-        if len(response) < 100:
-            print(f"Response too short ({len(response)} chars), reverting to original")
+        cleaned = _clean_response(response, current_output, REFINEMENT_PREFIXES)
+        if cleaned is current_output:
             return current_output
-            
-        # Check for common prefixes to remove
-        common_prefixes = [
-            "Here's the complete template with the requested changes:",
-            "Here is the adapted template:",
-            "Here is the complete template with your changes:",
-            "I've incorporated your feedback. Here's the updated template:"
-        ]
-        
-        for prefix in common_prefixes:
-            if response.startswith(prefix):
-                response = response[len(prefix):].lstrip()
-                print(f"Removed prefix: {prefix}")
-                break
-                
-        # No more aggressive splitting that might remove top content
-        return response
+        return _repair_refinement(current_output, cleaned, output.get("finish_reason"))
         
+    except PromptTooLarge as e:
+        print(f"Template too large to refine: {e}")
+        record_fallback("refine", "prompt_too_large")
+        return current_output
     except Exception as e:
         print(f"Error refining output with LLM: {e}")
+        record_fallback("refine", "exception")
         return current_output
 
-def fully_adapt_template(template: Dict[str, Any], user_description: str, llm):
-    """Adapt the entire template to the user's specific use case."""
-    if not llm:
-        # Just return the original template if no LLM is available
-        return template.get("content", "")
+@instrumented("pipeline.refine_stream")
+def stream_refine_output(current_output: str, user_feedback: str, llm) -> Iterator[str]:
+    """Like refine_output, but yield the refined template in chunks as it is generated.
+
+    Pass the joined chunks to finalize_streamed_output for the final result.
+    Raises LLMError if the request fails, so callers can keep the current template.
+    """
+    if not llm or len(current_output) < 50:
+        yield current_output
+        return
     
-    # Extract the template content
-    content = template.get("content", "")
-    template_name = template.get("name", "Template")
+    try:
+        prompt = _refinement_prompt(current_output, user_feedback)
+    except PromptTooLarge as e:
+        print(f"Template too large to refine: {e}")
+        record_fallback("refine", "prompt_too_large")
+        yield current_output
+        return
+    try:
+        yield from _strip_prefix_stream(_stream_llm(llm, prompt, _refinement_max_tokens(current_output)),
+                                        REFINEMENT_PREFIXES)
+    except LLMError:
+        raise
+    except Exception as e:
+        print(f"Error refining output with LLM: {e}")
+        record_fallback("refine", "exception")
+        raise LLMError(LLMResult(error_kind="error", error=str(e))) from e
+
+# Incremental refinement only pays off when the edit touches a small part of the template
+INCREMENTAL_MAX_SECTIONS = 3
+INCREMENTAL_MAX_SHARE = 0.5
+
+STEP_REFERENCE = re.compile(r"\bstep\s+(\d+)\b", re.IGNORECASE)
+
+def select_refinement_sections(sections: List[Section], user_feedback: str) -> Optional[List[Section]]:
+    """Pick the sections a piece of feedback is about, or None if it looks like a whole-template change."""
+    feedback_terms = set(tokenize(user_feedback))
+    referenced_steps = set(STEP_REFERENCE.findall(user_feedback))
     
-    # Create a prompt for the LLM to adapt the template
-    prompt = f"""You are helping to adapt a participatory design template to a specific use case.
+    scored = []
+    for section in sections:
+        # Untitled preambles and bare container headings ("Steps:") have nothing to edit
+        if not section.title or not section.body.strip():
+            continue
+        step_number = re.match(r"\s*(\d+)", section.title)
+        if step_number and step_number.group(1) in referenced_steps:
+            scored.append((100, section))
+            continue
+        title_overlap = len(feedback_terms & set(tokenize(section.title)))
+        if title_overlap:
+            body_overlap = len(feedback_terms & set(tokenize(section.body)))
+            scored.append((3 * title_overlap + body_overlap, section))
+    
+    if not scored:
+        return None
+    
+    # Keep only the clear matches
+    best = max(score for score, section in scored)
+    selected = [section for score, section in scored if score >= 0.75 * best]
+    if len(selected) > INCREMENTAL_MAX_SECTIONS:
+        return None
+    
+    total = sum(len(section.text) for section in sections)
+    if sum(len(section.text) for section in selected) > INCREMENTAL_MAX_SHARE * total:
+        return None
+    return selected
 
-USER'S USE CASE DESCRIPTION:
-"{user_description}"
+INCREMENTAL_REFINEMENT_PROMPT = """IMPORTANT: You are editing part of a participatory design template based on user feedback. Only the relevant sections are shown.
 
-ORIGINAL TEMPLATE ({template_name}):
-{content}
+INSTRUCTIONS:
+1. Return ONLY a patch with one block per changed section, in this exact format:
+@@ REPLACE <section id>
+<the complete new text of the section, including its heading line>
+@@ END
+2. To add a new section after an existing one, use "@@ INSERT_AFTER <section id>" instead of REPLACE
+3. To remove a section, use "@@ DELETE <section id>" followed by "@@ END"
+4. Make ONLY the specific changes requested and keep headings and formatting the same
+5. Do NOT include unchanged sections, commentary or explanations
+
+TEMPLATE OUTLINE:
+{outline}
+
+SECTIONS YOU MAY EDIT:
+{shown}
+
+USER FEEDBACK:
+"{user_feedback}"
+"""
+
+def _incremental_refinement_prompt(sections: List[Section], selected: List[Section], user_feedback: str) -> str:
+    shown = "\n\n".join(f"<<<{section.id}\n{section.text.strip()}\n>>>" for section in selected)
+    prompt, _ = build_prompt(INCREMENTAL_REFINEMENT_PROMPT,
+                             {"outline": outline(sections), "shown": shown, "user_feedback": user_feedback},
+                             {"outline": 1, "user_feedback": 2}, prefix_until="user_feedback")
+    return prompt
+
+def incremental_refinement_applies(current_output: str, user_feedback: str) -> bool:
+    """True if refine_output_incremental can handle this feedback with a section patch."""
+    return select_refinement_sections(split_sections(current_output), user_feedback) is not None
+
+@instrumented("pipeline.refine_incremental")
+def refine_output_incremental(current_output: str, user_feedback: str, llm):
+    """Refine the template by patching only the sections the feedback is about.
+
+    Only an outline plus the relevant sections are sent, and the model
+    returns a section patch that is applied locally, so tokens scale with
+    the size of the change. Falls back to refine_output when the feedback
+    can't be pinned to a few sections or the patch is unusable.
+    """
+    if not llm or len(current_output) < 50:
+        return refine_output(current_output, user_feedback, llm)
+    
+    sections = split_sections(current_output)
+    selected = select_refinement_sections(sections, user_feedback)
+    if selected is None:
+        return refine_output(current_output, user_feedback, llm)
+    
+    # Room for the shown sections to grow, plus the patch markers
+    max_length = output_budget(sum(count_tokens(section.text) for section in selected),
+                               ratio=REFINEMENT_OUTPUT_RATIO, overhead=64 + 16 * len(selected))
+    
+    try:
+        prompt = _incremental_refinement_prompt(sections, selected, user_feedback)
+        output = llm(prompt, max_length=max_length)[0]
+        if output.get("error"):
+            print(f"LLM refinement failed ({output['error']}), keeping current template")
+            record_fallback("refine", output["error"])
+            return current_output
+        
+        operations = parse_section_patch(output["generated_text"])
+        patched = apply_section_patch(sections, operations, {section.id for section in selected})
+        print(f"Incremental refinement: {len(selected)} section(s) sent, {len(operations)} operation(s) returned")
+        if not operations or patched is None:
+            print("Unusable section patch, refining the whole template")
+            record_fallback("refine_incremental", "unusable_patch")
+            return refine_output(current_output, user_feedback, llm)
+        
+        return join_sections(patched)
+    
+    except Exception as e:
+        print(f"Error refining output with LLM: {e}")
+        record_fallback("refine", "exception")
+        return current_output
+
+# Templates longer than this are adapted section by section, in parallel
+CHUNKED_ADAPTATION_MIN_CHARS = int(os.environ.get("CHUNKED_ADAPTATION_MIN_CHARS", "6000"))
+# Adjacent small sections are merged so each request carries a useful amount of text
+ADAPTATION_CHUNK_CHARS = 1500
+ADAPTATION_WORKERS = int(os.environ.get("ADAPTATION_WORKERS", "4"))
+
+def _use_chunked_adaptation(content: str, chunked: Optional[bool]) -> bool:
+    if chunked is None:
+        return len(content) > CHUNKED_ADAPTATION_MIN_CHARS
+    return chunked
+
+def _adaptation_chunks(sections: List[Section]) -> List[List[Section]]:
+    """Group consecutive sections into chunks of roughly ADAPTATION_CHUNK_CHARS."""
+    chunks: List[List[Section]] = []
+    size = 0
+    for section in sections:
+        if chunks and size + len(section.text) <= ADAPTATION_CHUNK_CHARS:
+            chunks[-1].append(section)
+            size += len(section.text)
+        else:
+            chunks.append([section])
+            size = len(section.text)
+    return chunks
+
+def _normalized_titles(text: str) -> List[str]:
+    return [" ".join(title.split()) for title in heading_titles(text)]
+
+def _missing_headings(original: str, adapted: str) -> List[str]:
+    """Headings of the original that do not appear in the adapted text."""
+    adapted_titles = set(_normalized_titles(adapted))
+    return [title for title in _normalized_titles(original) if title not in adapted_titles]
+
+SECTION_ADAPTATION_PROMPT = """You are helping to adapt one part of a participatory design template to a specific use case.
 
 INSTRUCTIONS:
-1. KEEP all section titles and headings EXACTLY the same
+1. KEEP all section titles and headings in this part EXACTLY the same
 2. KEEP all steps and process instructions EXACTLY the same 
 3. KEEP all formatting EXACTLY the same
 4. ONLY change specific examples to be more relevant to the user's scenario
-5. DO NOT add new content or remove existing content
+5. DO NOT add new content or remove existing content, and DO NOT add other parts of the template
 6. DO NOT add any personal commentary or greeting message
-7. Start your response with the exact same line as the original template
+7. Start your response with the exact same line as this part
 
-Return ONLY the adapted template content. 
-Do not include any explanatory text before or after the template.
+Return ONLY the adapted part. 
+Do not include any explanatory text before or after it.
+
+OUTLINE OF THE FULL TEMPLATE ({template_name}):
+{outline}
+
+PART TO ADAPT:
+{part}
+
+USER'S USE CASE DESCRIPTION:
+"{user_description}"
 """
+
+def _section_adaptation_prompt(template: Dict[str, Any], sections: List[Section],
+                               chunk: List[Section], user_description: str) -> str:
+    prompt, _ = build_prompt(SECTION_ADAPTATION_PROMPT, {
+        "user_description": user_description,
+        "template_name": template.get("name", "Template"),
+        "outline": outline(sections),
+        "part": "".join(section.text for section in chunk).strip("\n")
+    }, {"outline": 1, "user_description": 2}, prefix_until="user_description")
+    return prompt
+
+@instrumented("pipeline.adapt_chunk")
+def _adapt_chunk(template: Dict[str, Any], sections: List[Section], chunk: List[Section],
+                 user_description: str, llm) -> str:
+    """Adapt one chunk of sections, returning the original text if the result can't be trusted."""
+    original = "".join(section.text for section in chunk)
+    if not any(section.body.strip() for section in chunk):
+        # Nothing but headings and blank lines - nothing to adapt
+        return original
     
     try:
-        # Generate the adapted template
-        response = llm(prompt, max_length=2048)[0]["generated_text"]
+        prompt = _section_adaptation_prompt(template, sections, chunk, user_description)
+        output = llm(prompt, max_length=output_budget(count_tokens(original)))[0]
+    except Exception as e:
+        print(f"Error adapting template section with LLM: {e}")
+        record_fallback("adapt_chunk", "exception")
+        return original
+    if output.get("error"):
+        print(f"LLM adaptation failed for a section ({output['error']}), keeping it unchanged")
+        record_fallback("adapt_chunk", output["error"])
+        return original
+    
+    response = _strip_common_prefix(output["generated_text"].strip("\n"), ADAPTATION_PREFIXES)
+    missing = _missing_headings(original, response)
+    if len(response) < len(original.strip()) // 2 or missing:
+        print(f"Adapted section rejected (length={len(response)}, missing headings={missing}), keeping it unchanged")
+        record_fallback("adapt_chunk", "rejected_section")
+        return original
+    
+    # Keep the original spacing between chunks
+    trailing = original[len(original.rstrip("\n")):]
+    leading = original[:len(original) - len(original.lstrip("\n"))]
+    return leading + response + trailing
+
+def _iter_adapted_chunks(template: Dict[str, Any], user_description: str, llm,
+                         max_workers: int = ADAPTATION_WORKERS) -> Iterator[str]:
+    """Adapt all chunks concurrently, yielding each one's text in document order as soon as it is ready."""
+    sections = split_sections(template.get("content", ""))
+    chunks = _adaptation_chunks(sections)
+    print(f"Chunked adaptation: {len(sections)} sections in {len(chunks)} chunks")
+    
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="adapt")
+    try:
+        futures = [
+            executor.submit(_adapt_chunk, template, sections, chunk, user_description, llm)
+            for chunk in chunks
+        ]
+        for future in futures:
+            yield future.result()
+    finally:
+        # Don't keep generating if the consumer stopped reading
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def _repair_adaptation(template: Dict[str, Any], user_description: str, llm, adapted: str,
+                       finish_reason: Optional[str] = None) -> str:
+    """Check an adaptation kept the template's structure, re-adapting only the sections that didn't."""
+    report = validate_output(template.get("content", ""), adapted, finish_reason)
+    if report.ok:
+        return adapted
+    print(f"Adaptation failed validation, re-adapting {len(report.failing)} section(s): {report.reasons}")
+    record_fallback("adapt", "repaired_sections")
+    increment("repaired_sections", len(report.failing), stage="adapt")
+    return repair_output(report, lambda run: _adapt_chunk(template, report.original, run, user_description, llm))
+
+@instrumented("pipeline.adapt_chunked")
+def fully_adapt_template_chunked(template: Dict[str, Any], user_description: str, llm,
+                                 max_workers: int = ADAPTATION_WORKERS) -> str:
+    """Adapt a template section by section in parallel, all with the same use-case context.
+
+    Wall-clock time is roughly that of the slowest chunk, and no single
+    request has to fit the whole template in its output budget. Any chunk
+    whose result drops a heading is kept as the original.
+    """
+    content = template.get("content", "")
+    if not llm:
+        return content
+    
+    adapted = "".join(_iter_adapted_chunks(template, user_description, llm, max_workers))
+    missing = _missing_headings(content, adapted)
+    print(f"Adaptation: Length of original={len(content)}, Length of response={len(adapted)}, missing headings={len(missing)}")
+    if missing:
+        record_fallback("adapt", "missing_headings")
+        return content
+    return adapted
+
+# Adaptations currently running in this process, shared by identical requests
+_adaptation_flight = SingleFlight("adapt")
+
+def adaptation_key(template: Dict[str, Any], user_description: str) -> tuple:
+    """What makes two adaptation requests the same: the template and the normalized description."""
+    content_digest = hashlib.sha1(template.get("content", "").encode('utf-8')).hexdigest()
+    return (template.get("id"), content_digest, normalize_description(user_description))
+
+@instrumented("pipeline.adapt")
+def fully_adapt_template(template: Dict[str, Any], user_description: str, llm, chunked: Optional[bool] = None):
+    """Adapt the entire template to the user's specific use case.
+
+    Large templates (or chunked=True) are adapted section by section in parallel.
+    Identical requests already in flight share one upstream call.
+    """
+    # Extract the template content
+    content = template.get("content", "")
+    if not llm:
+        # Just return the original template if no LLM is available
+        return content
+    
+    user_description = coalesce_description(user_description)
+    key = adaptation_key(template, user_description) + (chunked, id(llm))
+    return _adaptation_flight.do(key, lambda: _fully_adapt_template(template, user_description, llm, chunked))
+
+def _fully_adapt_template(template: Dict[str, Any], user_description: str, llm, chunked: Optional[bool]) -> str:
+    content = template.get("content", "")
+    if _use_chunked_adaptation(content, chunked):
+        return fully_adapt_template_chunked(template, user_description, llm)
+    
+    # Create a prompt for the LLM to adapt the template
+    try:
+        prompt = _adaptation_prompt(template, user_description)
+    except PromptTooLarge as e:
+        # Too big for one request - adapt it a few sections at a time instead
+        print(f"Template too large for a single adaptation prompt: {e}")
+        return fully_adapt_template_chunked(template, user_description, llm)
+    
+    try:
+        # Generate the adapted template, with room for the whole template in the output
+        output = llm(prompt, max_length=output_budget(count_tokens(content)))[0]
+        if output.get("error"):
+            print(f"LLM adaptation failed ({output['error']}), reverting to original")
+            record_fallback("adapt", output["error"])
+            return content
+        response = output["generated_text"]
         print(f"Adaptation: Length of original={len(content)}, Length of response={len(response)}")
-        
-        # Basic validation - just check if it's too short
-        if len(response) < 100:
-            print(f"Response too short ({len(response)} chars), reverting to original")
+        cleaned = _clean_response(response, content, ADAPTATION_PREFIXES)
+        if cleaned is content:
             return content
-            
-        # Check for common prefixes to remove
-        common_prefixes = [
-            "Here's the adapted template:",
-            "Here is the adapted template:",
-            "I've adapted the template to your use case:",
-            "Here's the template adapted to your scenario:"
-        ]
-        
-        for prefix in common_prefixes:
-            if response.startswith(prefix):
-                response = response[len(prefix):].lstrip()
-                print(f"Removed prefix: {prefix}")
-                break
-                
-        # No more aggressive splitting that might remove top content
-        return response
+        return _repair_adaptation(template, user_description, llm, cleaned, output.get("finish_reason"))
         
     except Exception as e:
         print(f"Error adapting template with LLM: {e}")
+        record_fallback("adapt", "exception")
         # Fall back to original template
-        return content
\ No newline at end of file
+        return content
+
+@instrumented("pipeline.adapt_stream")
+def stream_fully_adapt_template(template: Dict[str, Any], user_description: str, llm,
+                                chunked: Optional[bool] = None) -> Iterator[str]:
+    """Like fully_adapt_template, but yield the adapted template in chunks as it is generated.
+
+    Pass the joined chunks to finalize_streamed_adaptation for the final result.
+    Raises LLMError if the request fails, so callers can fall back to the original.
+    Large templates are adapted section by section, yielding each section in order.
+    """
+    content = template.get("content", "")
+    if not llm:
+        yield content
+        return
+    
+    if _use_chunked_adaptation(content, chunked):
+        yield from _iter_adapted_chunks(template, user_description, llm)
+        return
+    
+    try:
+        prompt = _adaptation_prompt(template, user_description)
+    except PromptTooLarge as e:
+        print(f"Template too large for a single adaptation prompt: {e}")
+        yield from _iter_adapted_chunks(template, user_description, llm)
+        return
+    try:
+        yield from _strip_prefix_stream(_stream_llm(llm, prompt, output_budget(count_tokens(content))),
+                                        ADAPTATION_PREFIXES)
+    except LLMError:
+        raise
+    except Exception as e:
+        print(f"Error adapting template with LLM: {e}")
+        record_fallback("adapt", "exception")
+        raise LLMError(LLMResult(error_kind="error", error=str(e))) from e
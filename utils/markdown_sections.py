@@ -0,0 +1,183 @@
+# utils/markdown_sections.py
+import re
+from typing import List, Dict, Optional, Tuple
+
+ATX_HEADING = re.compile(r"^\s{0,3}(#{1,6})\s+(\S.*?)\s*#*\s*$")
+BOLD_HEADING = re.compile(r"^\s*\*\*([^*]{1,80})\*\*:?\s*$")
+NUMBERED_LINE = re.compile(r"^\s*(\d+)[.)]\s+(\S.*?)\s*$")
+LABEL_HEADING = re.compile(r"^\s*([A-Za-z][^:\-*]{0,40}):\s*$")
+
+# A label such as "What You'll Need:" counts as a heading; a sentence ending in a colon does not
+MAX_LABEL_WORDS = 4
+MAX_STEP_TITLE_CHARS = 60
+
+class Section:
+    """A heading and the text under it, up to the next heading.
+
+    `text` is the exact source text, including the heading line and any
+    trailing blank lines, so joining sections reproduces the document.
+    """
+
+    __slots__ = ("id", "title", "level", "text")
+
+    def __init__(self, id: str, title: str, level: int, text: str):
+        self.id = id
+        self.title = title
+        self.level = level
+        self.text = text
+
+    @property
+    def body(self) -> str:
+        """Section text without the heading line."""
+        if not self.title:
+            return self.text
+        return self.text.split("\n", 1)[1] if "\n" in self.text else ""
+
+    def __repr__(self) -> str:
+        return f"Section({self.id!r}, {self.title!r}, level={self.level})"
+
+def _heading(lines: List[str], i: int) -> Optional[Tuple[str, int]]:
+    """Return (title, level) if line i starts a section."""
+    line = lines[i]
+    if not line.strip():
+        return None
+
+    match = ATX_HEADING.match(line)
+    if match:
+        return match.group(2), len(match.group(1))
+
+    previous_blank = i == 0 or not lines[i - 1].strip()
+    next_blank = i + 1 >= len(lines) or not lines[i + 1].strip()
+
+    match = BOLD_HEADING.match(line)
+    if match and previous_blank:
+        return match.group(1).strip(), 2
+
+    match = LABEL_HEADING.match(line)
+    if match and previous_blank and len(match.group(1).split()) <= MAX_LABEL_WORDS:
+        return line.strip(), 1
+
+    # Step titles ("3.<tab>Set Up the Tables") stand alone between blank lines;
+    # list items run on from the line before
+    match = NUMBERED_LINE.match(line)
+    if (match and previous_blank and next_blank and len(match.group(2)) <= MAX_STEP_TITLE_CHARS
+            and not match.group(2).endswith(".")):
+        return line.strip(), 2
+
+    return None
+
+def split_sections(content: str) -> List[Section]:
+    """Split a template into sections at markdown headings, labels and step titles.
+
+    Text before the first heading becomes a preamble section with an empty title.
+    """
+    lines = content.split("\n")
+    starts: List[Tuple[int, str, int]] = []
+    for i in range(len(lines)):
+        heading = _heading(lines, i)
+        if heading:
+            starts.append((i, heading[0], heading[1]))
+
+    sections = []
+    if not starts or starts[0][0] > 0:
+        end = starts[0][0] if starts else len(lines)
+        sections.append(("", 0, 0, end))
+    for n, (start, title, level) in enumerate(starts):
+        end = starts[n + 1][0] if n + 1 < len(starts) else len(lines)
+        sections.append((title, level, start, end))
+
+    return [
+        Section(f"S{number}", title, level, "\n".join(lines[start:end]) + ("\n" if end < len(lines) else ""))
+        for number, (title, level, start, end) in enumerate(sections, start=1)
+    ]
+
+def join_sections(sections: List[Section]) -> str:
+    """Reassemble sections into a document."""
+    return "".join(section.text for section in sections)
+
+def heading_titles(content: str) -> List[str]:
+    """The heading skeleton of a document: every section title, in order."""
+    return [section.title for section in split_sections(content) if section.title]
+
+def outline(sections: List[Section]) -> str:
+    """One line per titled section, indented by level, for use in prompts."""
+    lines = []
+    for section in sections:
+        if section.title:
+            lines.append(f"{'  ' * max(0, section.level - 1)}[{section.id}] {section.title}")
+    return "\n".join(lines)
+
+PATCH_START = re.compile(r"^@@\s*(REPLACE|INSERT_AFTER|DELETE)\s+(S\d+)\s*$")
+PATCH_END = re.compile(r"^@@\s*END\s*$")
+
+def parse_section_patch(response: str) -> List[Tuple[str, str, str]]:
+    """Parse a section patch into (operation, section id, text) tuples.
+
+    The format is one block per change:
+
+        @@ REPLACE S3
+        <complete new text of the section>
+        @@ END
+
+    with INSERT_AFTER adding a new section and DELETE (no text) removing one.
+    """
+    operations = []
+    current: Optional[Tuple[str, str]] = None
+    buffer: List[str] = []
+    for line in response.replace("\r\n", "\n").split("\n"):
+        if current is None:
+            match = PATCH_START.match(line.strip())
+            if match:
+                current = (match.group(1), match.group(2))
+                buffer = []
+        elif PATCH_END.match(line.strip()):
+            operations.append((current[0], current[1], "\n".join(buffer).strip("\n")))
+            current = None
+        else:
+            buffer.append(line)
+    return operations
+
+def _with_trailing_space(text: str, like: str) -> str:
+    """Give new section text the same trailing newlines as the section it replaces."""
+    trailing = like[len(like.rstrip("\n")):]
+    return text.rstrip("\n") + (trailing or "\n")
+
+def apply_section_patch(sections: List[Section], operations: List[Tuple[str, str, str]],
+                        editable_ids: Optional[set] = None) -> Optional[List[Section]]:
+    """Apply parsed patch operations, returning new sections or None if the patch is invalid.
+
+    REPLACE and DELETE may only target `editable_ids` when given; INSERT_AFTER
+    may follow any section.
+    """
+    by_id: Dict[str, Section] = {section.id: section for section in sections}
+    replaced: Dict[str, Optional[str]] = {}
+    inserted: Dict[str, List[str]] = {}
+    for operation, section_id, text in operations:
+        if section_id not in by_id:
+            return None
+        if operation in ("REPLACE", "DELETE") and editable_ids is not None and section_id not in editable_ids:
+            return None
+        if operation == "REPLACE":
+            if not text.strip():
+                return None
+            replaced[section_id] = text
+        elif operation == "DELETE":
+            replaced[section_id] = None
+        elif text.strip():
+            inserted.setdefault(section_id, []).append(text)
+
+    result = []
+    for section in sections:
+        if section.id in replaced:
+            new_text = replaced[section.id]
+            if new_text is not None:
+                result.append(Section(section.id, section.title, section.level,
+                                      _with_trailing_space(new_text, section.text)))
+        else:
+            result.append(section)
+        for number, text in enumerate(inserted.get(section.id, [])):
+            # Keep a blank line between the previous section and the new one
+            separator = "" if not result or result[-1].text.endswith("\n\n") else "\n"
+            result.append(Section(f"{section.id}.{number + 1}", "", section.level,
+                                  separator + _with_trailing_space(text, "\n\n")))
+    return result
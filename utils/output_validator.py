@@ -0,0 +1,197 @@
+# utils/output_validator.py
+import re
+import concurrent.futures
+from typing import List, Dict, Callable, Optional
+
+from utils.markdown_sections import Section, split_sections, join_sections, NUMBERED_LINE
+
+# A section whose body shrinks below this share of the original's has lost content
+MIN_BODY_RATIO = 0.5
+# Bodies shorter than this are too small to judge by length
+MIN_CHECKED_BODY_CHARS = 80
+# The last section of a truncated output is kept only if it is at least this complete
+TRUNCATED_SECTION_RATIO = 0.8
+REPAIR_WORKERS = 4
+
+# Words a finished template never ends on
+DANGLING_WORDS = {"a", "an", "and", "for", "of", "or", "the", "to", "with"}
+_LAST_WORD = re.compile(r"\b(\w+)$")
+
+class ValidationReport:
+    """How a generated template compares structurally with the text it was generated from.
+
+    `matches` maps each original section id to the output section with the
+    same heading; `failing` lists the original section ids whose output is
+    missing, cut off or broken, in document order.
+    """
+
+    def __init__(self, original: List[Section], output: List[Section], matches: Dict[str, int],
+                 failing: List[str], truncated: bool, reasons: Dict[str, str]):
+        self.original = original
+        self.output = output
+        self.matches = matches
+        self.failing = failing
+        self.truncated = truncated
+        self.reasons = reasons
+
+    @property
+    def ok(self) -> bool:
+        return not self.failing and not self.truncated
+
+    def __repr__(self) -> str:
+        return f"ValidationReport(ok={self.ok}, truncated={self.truncated}, failing={self.reasons})"
+
+def _normalized_title(section: Section) -> str:
+    return " ".join(section.title.split())
+
+def step_numbers(text: str) -> List[int]:
+    """The numbers of the numbered lines in text, in order."""
+    return [int(match.group(1)) for match in map(NUMBERED_LINE.match, text.split("\n")) if match]
+
+def _match_sections(original: List[Section], output: List[Section]) -> Dict[str, int]:
+    """Pair original sections with output sections by heading, in order."""
+    matches = {}
+    position = 0
+    for section in original:
+        if not section.title:
+            # An untitled preamble pairs with the output's preamble
+            if output and not output[0].title and position == 0:
+                matches[section.id] = 0
+                position = 1
+            continue
+        title = _normalized_title(section)
+        for index in range(position, len(output)):
+            if output[index].title and _normalized_title(output[index]) == title:
+                matches[section.id] = index
+                position = index + 1
+                break
+    return matches
+
+def _looks_cut_off(text: str) -> bool:
+    """Heuristics for an output that stopped mid-generation."""
+    stripped = text.rstrip()
+    if not stripped:
+        return True
+    if stripped.count("```") % 2:
+        return True
+    last_line = stripped.rsplit("\n", 1)[-1]
+    if last_line.count("**") % 2 or last_line.endswith((",", ";", "(")):
+        return True
+    last_word = _LAST_WORD.search(last_line)
+    return bool(last_word and last_word.group(1).lower() in DANGLING_WORDS)
+
+def validate_output(original: str, output: str, finish_reason: Optional[str] = None,
+                    strict: bool = True) -> ValidationReport:
+    """Compare the heading skeleton and numbered steps of output against original.
+
+    Truncation is detected from finish_reason ("MAX_TOKENS") or, when it is
+    not known, from the output's tail. Strict validation (adaptations, which
+    must keep the structure) also fails sections that are missing, renumbered
+    or emptied; lenient validation (refinements, which may restructure on
+    request) only fails what truncation lost.
+    """
+    original_sections = split_sections(original)
+    output_sections = split_sections(output)
+    matches = _match_sections(original_sections, output_sections)
+    reasons: Dict[str, str] = {}
+
+    matched_ids = [section.id for section in original_sections if section.id in matches]
+    last_matched = [section.id for section in original_sections].index(matched_ids[-1]) if matched_ids else -1
+    missing_tail = [section for section in original_sections[last_matched + 1:] if section.title]
+    last_section_short = False
+    if matched_ids:
+        last_original = original_sections[last_matched]
+        last_output = output_sections[matches[last_original.id]]
+        last_section_short = len(last_output.body.strip()) < TRUNCATED_SECTION_RATIO * len(last_original.body.strip())
+
+    truncated = (finish_reason == "MAX_TOKENS" or _looks_cut_off(output)
+                 or bool(missing_tail and last_section_short))
+    if truncated:
+        for section in missing_tail:
+            reasons[section.id] = "truncated"
+        if matched_ids and last_section_short:
+            reasons[matched_ids[-1]] = "truncated"
+
+    if strict:
+        for section in original_sections:
+            if section.id in reasons or not (section.title or section.body.strip()):
+                continue
+            if section.id not in matches:
+                if section.title:
+                    reasons[section.id] = "missing_heading"
+                continue
+            produced = output_sections[matches[section.id]]
+            if step_numbers(produced.body) != step_numbers(section.body):
+                reasons[section.id] = "step_sequence"
+            elif (len(section.body.strip()) >= MIN_CHECKED_BODY_CHARS
+                  and len(produced.body.strip()) < MIN_BODY_RATIO * len(section.body.strip())):
+                reasons[section.id] = "shortened"
+
+    failing = [section.id for section in original_sections if section.id in reasons]
+    return ValidationReport(original_sections, output_sections, matches, failing, truncated, reasons)
+
+def _with_spacing(text: str, like: str) -> str:
+    trailing = like[len(like.rstrip("\n")):]
+    return text.rstrip("\n") + (trailing or "\n")
+
+def repair_output(report: ValidationReport,
+                  regenerate: Optional[Callable[[List[Section]], str]] = None) -> str:
+    """Rebuild the output, replacing only the failing sections.
+
+    Runs of consecutive failing sections are passed to regenerate(sections),
+    concurrently; without it (or if it fails) they keep their original text.
+    Passing output sections are kept as generated, including any the model
+    added between them, except for trailing text after a truncation.
+    """
+    failing = set(report.failing)
+
+    # Plan the document as kept output sections and runs of failing original sections
+    pieces: List[object] = []
+    position = 0
+    for section in report.original:
+        if section.id in failing:
+            if pieces and isinstance(pieces[-1], list):
+                pieces[-1].append(section)
+            else:
+                pieces.append([section])
+            continue
+        index = report.matches.get(section.id)
+        if index is None:
+            continue
+        for extra in report.output[position:index]:
+            if extra.title or extra.text.strip():
+                pieces.append(extra.text)
+        pieces.append(_with_spacing(report.output[index].text, section.text))
+        position = index + 1
+    if not report.truncated:
+        pieces.extend(extra.text for extra in report.output[position:])
+
+    runs = [piece for piece in pieces if isinstance(piece, list)]
+    repaired: Dict[int, str] = {}
+    if regenerate and runs:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(REPAIR_WORKERS, len(runs))) as executor:
+            futures = {id(run): executor.submit(regenerate, run) for run in runs}
+        for run in runs:
+            try:
+                repaired[id(run)] = futures[id(run)].result()
+            except Exception as e:
+                print(f"Error repairing sections {[section.id for section in run]}: {e}")
+
+    text = []
+    for piece in pieces:
+        if isinstance(piece, list):
+            original_text = join_sections(piece)
+            text.append(_with_spacing(repaired[id(piece)], original_text) if repaired.get(id(piece))
+                        else original_text)
+        else:
+            text.append(piece)
+    return "".join(text)
+
+def validate_and_repair(original: str, output: str, finish_reason: Optional[str] = None, strict: bool = True,
+                        regenerate: Optional[Callable[[List[Section]], str]] = None) -> str:
+    """The output with any failing sections repaired; unchanged if it validates."""
+    report = validate_output(original, output, finish_reason, strict)
+    if report.ok:
+        return output
+    print(f"Output failed validation, repairing {len(report.failing)} section(s): {report.reasons}")
+    return repair_output(report, regenerate)
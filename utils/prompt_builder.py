@@ -0,0 +1,153 @@
+# utils/prompt_builder.py
+import os
+import hashlib
+import threading
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+try:
+    from transformers import AutoTokenizer
+    HAVE_TOKENIZER = True
+except ImportError:
+    HAVE_TOKENIZER = False
+
+# A Hugging Face tokenizer to count tokens with (e.g. "google/gemma-2b", whose vocabulary is
+# close to Gemini's). Unset, tokens are estimated at about four characters each.
+PROMPT_TOKENIZER = os.environ.get("PROMPT_TOKENIZER", "")
+# Input budget per request. The model accepts far more, but every token is paid for.
+PROMPT_MAX_INPUT_TOKENS = int(os.environ.get("PROMPT_MAX_INPUT_TOKENS", "32000"))
+# Hard limit on output tokens per request for the model
+MODEL_MAX_OUTPUT_TOKENS = int(os.environ.get("MODEL_MAX_OUTPUT_TOKENS", "8192"))
+
+TRUNCATION_MARKER = "\n[...]"
+
+class PromptTooLarge(ValueError):
+    """Raised when the required parts of a prompt alone exceed the input budget."""
+
+class Prompt(str):
+    """A prompt whose first `prefix_length` characters are shared by every request for the same template.
+
+    The prompts put their static instructions and the template first and the
+    per-user text last, so the prefix can be cached once by the provider or
+    the local model and reused; `prefix_hash` identifies it. It behaves as a
+    plain string everywhere else.
+    """
+
+    def __new__(cls, text: str, prefix_length: int = 0):
+        prompt = super().__new__(cls, text)
+        prompt.prefix_length = max(0, min(prefix_length, len(text)))
+        return prompt
+
+    @property
+    def prefix(self) -> str:
+        return str(self[:self.prefix_length])
+
+    @property
+    def suffix(self) -> str:
+        return str(self[self.prefix_length:])
+
+    @property
+    def prefix_hash(self) -> str:
+        return hashlib.sha256(self.prefix.encode('utf-8')).hexdigest()
+
+_tokenizer = None
+_tokenizer_failed = False
+_tokenizer_lock = threading.Lock()
+
+def _get_tokenizer():
+    global _tokenizer, _tokenizer_failed
+    if not (PROMPT_TOKENIZER and HAVE_TOKENIZER) or _tokenizer_failed:
+        return None
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None and not _tokenizer_failed:
+                try:
+                    _tokenizer = AutoTokenizer.from_pretrained(PROMPT_TOKENIZER)
+                except Exception as e:
+                    print(f"Could not load tokenizer {PROMPT_TOKENIZER}, estimating tokens instead: {e}")
+                    _tokenizer_failed = True
+    return _tokenizer
+
+@lru_cache(maxsize=1024)
+def count_tokens(text: str) -> int:
+    """Count the tokens in text with the configured tokenizer, or estimate them."""
+    tokenizer = _get_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False))
+    return (len(text) + 3) // 4
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Keep the start of text within max_tokens, cutting at a line (or word) boundary."""
+    if max_tokens <= 0:
+        return ""
+    tokens = count_tokens(text)
+    if tokens <= max_tokens:
+        return text
+
+    budget = max_tokens - count_tokens(TRUNCATION_MARKER)
+    cut = int(len(text) * budget / tokens)
+    while cut > 0:
+        head = text[:cut]
+        boundary = head.rfind("\n")
+        if boundary < cut // 2:
+            boundary = head.rfind(" ")
+        if boundary > cut // 2:
+            head = head[:boundary]
+        if count_tokens(head) <= budget:
+            return head.rstrip() + TRUNCATION_MARKER
+        cut = int(cut * 0.9)
+    return ""
+
+def output_budget(source_tokens: int, ratio: float = 1.25, overhead: int = 64,
+                  minimum: int = 128, maximum: int = MODEL_MAX_OUTPUT_TOKENS) -> int:
+    """max_output_tokens for a response that rewrites `source_tokens` worth of text.
+
+    Leaves room for the rewrite to grow by `ratio`, so a generation is not
+    cut off, without reserving the model's whole output window.
+    """
+    return max(minimum, min(maximum, int(source_tokens * ratio) + overhead))
+
+def _fill(template: str, fields: Dict[str, str], prefix_until: Optional[str]) -> str:
+    prompt = template.format_map(fields)
+    if not prefix_until:
+        return prompt
+    head = template[:template.index("{" + prefix_until + "}")]
+    return Prompt(prompt, len(head.format_map(fields)))
+
+def build_prompt(template: str, fields: Dict[str, str], priorities: Optional[Dict[str, int]] = None,
+                 max_tokens: int = PROMPT_MAX_INPUT_TOKENS,
+                 prefix_until: Optional[str] = None) -> Tuple[str, Dict[str, int]]:
+    """Fill a str.format template, truncating optional fields until the prompt fits max_tokens.
+
+    Fields named in `priorities` may be truncated, lowest priority first;
+    all other fields are required and kept whole. Returns the prompt and
+    the number of tokens cut from each truncated field. Raises
+    PromptTooLarge if the required parts alone don't fit.
+
+    With `prefix_until`, the prompt is a Prompt whose cacheable prefix is
+    everything before that field.
+    """
+    priorities = priorities or {}
+    skeleton = template.format_map({name: "" for name in fields})
+    sizes = {name: count_tokens(value) for name, value in fields.items()}
+    total = count_tokens(skeleton) + sum(sizes.values())
+    if total <= max_tokens:
+        return _fill(template, fields, prefix_until), {}
+
+    required = count_tokens(skeleton) + sum(size for name, size in sizes.items() if name not in priorities)
+    if required > max_tokens:
+        raise PromptTooLarge(f"Prompt needs {required} tokens for its required parts, budget is {max_tokens}")
+
+    fields = dict(fields)
+    truncated = {}
+    for name in sorted(priorities, key=priorities.get):
+        excess = total - max_tokens
+        if excess <= 0:
+            break
+        shortened = truncate_to_tokens(fields[name], sizes[name] - excess)
+        new_size = count_tokens(shortened) if shortened else 0
+        truncated[name] = sizes[name] - new_size
+        total -= truncated[name]
+        fields[name] = shortened
+    print(f"Prompt over budget ({max_tokens} tokens), truncated: {truncated}")
+    return _fill(template, fields, prefix_until), truncated
@@ -0,0 +1,98 @@
+# utils/recommender.py
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
+
+from utils.template_registry import TemplateRegistry, get_registry
+from utils.llm_utils import RECOMMEND_SHORTLIST_SIZE, recommend_templates, local_recommendations
+from utils.coalescing import SingleFlight, normalize_description
+from utils.instrumentation import instrumented, increment
+
+# Rankings kept per process; each is a list of the registry's template dicts, which it shares
+RECOMMENDATION_CACHE_SIZE = int(os.environ.get("RECOMMENDATION_CACHE_SIZE", "512"))
+# Let the LLM reorder the local shortlist when it is available
+RECOMMEND_RERANK = os.environ.get("RECOMMEND_RERANK", "1").lower() not in ("0", "false", "no")
+
+class Recommender:
+    """Ranks a registry's templates for a use case in two stages, memoizing the result.
+
+    Templates matching the chosen dimensions are ranked locally (BM25, or
+    embeddings when enabled); the top `shortlist_size` are then reordered by
+    the LLM, if one is available. Rankings are cached per description,
+    dimensions and library version, so reruns of the page never recompute
+    them or call the LLM again.
+    """
+
+    def __init__(self, registry: TemplateRegistry, shortlist_size: int = RECOMMEND_SHORTLIST_SIZE,
+                 max_entries: int = RECOMMENDATION_CACHE_SIZE, rerank: bool = RECOMMEND_RERANK):
+        self.registry = registry
+        self.shortlist_size = shortlist_size
+        self.max_entries = max_entries
+        self.rerank = rerank
+        self._lock = threading.Lock()
+        self._rankings: "OrderedDict[Tuple, List[Dict[str, Any]]]" = OrderedDict()
+        self._flight = SingleFlight("recommend")
+
+    def recommend(self, user_description: str, scale: str = None, engagement: str = None,
+                  llm=None) -> List[Dict[str, Any]]:
+        """Templates matching the dimensions, best match for the description first."""
+        self.registry.refresh()
+        description_hash = hashlib.sha1(normalize_description(user_description).encode('utf-8')).hexdigest()
+        key = (description_hash, scale, engagement, self.registry.version, bool(llm and self.rerank))
+        with self._lock:
+            ranking = self._rankings.get(key)
+            if ranking is not None:
+                self._rankings.move_to_end(key)
+        if ranking is None:
+            increment("recommendation_cache", outcome="miss")
+            ranking = self._flight.do(key, lambda: self._rank(user_description, scale, engagement, llm))
+            with self._lock:
+                self._rankings[key] = ranking
+                while len(self._rankings) > self.max_entries:
+                    self._rankings.popitem(last=False)
+        else:
+            increment("recommendation_cache", outcome="hit")
+        # The key includes the library version, so the cached templates are the current ones.
+        # Keeping the dicts rather than their ids keeps templates without a unique id apart.
+        return list(ranking)
+
+    @instrumented("pipeline.recommend_ranked")
+    def _rank(self, user_description: str, scale: Optional[str], engagement: Optional[str],
+              llm) -> List[Dict[str, Any]]:
+        candidates = self.registry.filter_by_dimensions(scale=scale, engagement=engagement)
+        if not user_description.strip() or len(candidates) < 2:
+            return list(candidates)
+
+        # Stage 1: order every candidate locally
+        ranked = local_recommendations(user_description, candidates, top_k=len(candidates),
+                                       index=self.registry.search_index())
+
+        # Stage 2: the LLM reorders the shortlist; its picks go first
+        if llm and self.rerank:
+            shortlist = ranked[:self.shortlist_size]
+            picks = []
+            for template in recommend_templates(user_description, shortlist, llm):
+                if all(template is not pick for pick in picks):
+                    picks.append(template)
+            ranked = picks + [template for template in ranked if all(template is not pick for pick in picks)]
+        return ranked
+
+    def clear(self):
+        with self._lock:
+            self._rankings.clear()
+
+_recommenders: Dict[str, Recommender] = {}
+_recommenders_lock = threading.Lock()
+
+def get_recommender(template_dir: str = "templates") -> Recommender:
+    """Get the shared recommender for a template directory's registry."""
+    key = os.path.abspath(template_dir)
+    recommender = _recommenders.get(key)
+    if recommender is None:
+        with _recommenders_lock:
+            recommender = _recommenders.get(key)
+            if recommender is None:
+                recommender = _recommenders[key] = Recommender(get_registry(template_dir))
+    return recommender
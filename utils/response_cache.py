@@ -0,0 +1,162 @@
+# utils/response_cache.py
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE", "1").lower() not in ("0", "false", "no")
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", os.path.join(".cache", "responses.sqlite3"))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+_TRAILING_SPACE = re.compile(r"[ \t]+$", re.MULTILINE)
+_BLANK_LINES = re.compile(r"\n{3,}")
+
+def normalize_prompt(prompt: str) -> str:
+    """Normalize whitespace that does not change what the model is asked."""
+    prompt = prompt.replace("\r\n", "\n")
+    prompt = _TRAILING_SPACE.sub("", prompt)
+    prompt = _BLANK_LINES.sub("\n\n", prompt)
+    return prompt.strip()
+
+def make_cache_key(prompt: str, model_name: str, generation_config: Dict[str, Any]) -> str:
+    """Content-addressed key for a generation request."""
+    payload = json.dumps(
+        {"prompt": normalize_prompt(prompt), "model": model_name, "config": generation_config},
+        sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """Two-tier cache of LLM responses: an in-memory LRU in front of SQLite.
+
+    Entries expire after `ttl` seconds. When the on-disk tier grows past
+    `max_disk_bytes`, the least recently used entries are evicted.
+    """
+
+    def __init__(self, path: str = RESPONSE_CACHE_PATH, memory_entries: int = 256,
+                 ttl: float = RESPONSE_CACHE_TTL, max_disk_bytes: int = RESPONSE_CACHE_MAX_BYTES):
+        self.path = path
+        self.memory_entries = memory_entries
+        self.ttl = ttl
+        self.max_disk_bytes = max_disk_bytes
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, "
+            "accessed REAL NOT NULL, size INTEGER NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._db.commit()
+        self._disk_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached response for key, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created = entry
+                if now - created < self.ttl:
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return value
+                del self._memory[key]
+
+            row = self._db.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] >= self.ttl:
+                if row is not None:
+                    self._delete(key)
+                self.stats["misses"] += 1
+                return None
+
+            value, created = row
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self._remember(key, value, created)
+            self.stats["disk_hits"] += 1
+            return value
+
+    def set(self, key: str, value: str):
+        """Store a response in both tiers."""
+        now = time.time()
+        size = len(value.encode('utf-8'))
+        with self._lock:
+            old = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created, accessed, size) VALUES (?, ?, ?, ?, ?)",
+                (key, value, now, now, size)
+            )
+            self._disk_bytes += size - (old[0] if old else 0)
+            self._evict()
+            self._db.commit()
+            self._remember(key, value, now)
+            self.stats["writes"] += 1
+
+    def _remember(self, key: str, value: str, created: float):
+        self._memory[key] = (value, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _delete(self, key: str):
+        row = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._db.commit()
+            self._disk_bytes -= row[0]
+
+    def _evict(self):
+        """Drop expired entries, then least recently used ones until under the size limit."""
+        if self._disk_bytes <= self.max_disk_bytes:
+            return
+        cursor = self._db.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+        self.stats["evictions"] += cursor.rowcount
+        self._disk_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+        # Evict down to 90% so we don't pay for an eviction pass on every write
+        target = self.max_disk_bytes * 0.9
+        rows = self._db.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall()
+        for key, size in rows:
+            if self._disk_bytes <= target:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._memory.pop(key, None)
+            self._disk_bytes -= size
+            self.stats["evictions"] += 1
+
+    def hit_rate(self) -> float:
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+_response_cache: Optional[ResponseCache] = None
+_response_cache_lock = threading.Lock()
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """Get the shared response cache, or None if caching is disabled or the store can't be opened."""
+    global _response_cache
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                try:
+                    _response_cache = ResponseCache()
+                except (sqlite3.Error, OSError) as e:
+                    print(f"Response cache unavailable: {e}")
+                    return None
+    return _response_cache
@@ -0,0 +1,147 @@
+# utils/search_index.py
+import re
+import math
+import heapq
+import threading
+from collections import Counter, OrderedDict
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Set, Tuple
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+STOPWORDS = frozenset("""
+a about after all also an and any are as at be been but by can could do does for from had
+has have how i if in into is it its just like make may more most my no not of on or other
+our out so some such than that the their them then there these they this to up us very was
+we were what when where which while who will with would you your
+""".split())
+
+# Name and keyword matches say more about a template than a word buried in its content
+FIELD_WEIGHTS = {
+    "name": 3.0,
+    "keywords": 2.5,
+    "description": 2.0,
+    "content": 1.0,
+}
+
+@lru_cache(maxsize=65536)
+def _normalize_term(token: str) -> Optional[str]:
+    if len(token) < 3 or token in STOPWORDS:
+        return None
+    # Fold simple plurals so "tables" matches "table"
+    if len(token) > 4 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercase terms, dropping stopwords and very short words."""
+    terms = (_normalize_term(token) for token in TOKEN_PATTERN.findall(text.lower()))
+    return [term for term in terms if term]
+
+def term_counts(text: str) -> Dict[str, int]:
+    """Count the terms in text; cheaper than tokenize() for long documents."""
+    counts: Dict[str, int] = {}
+    for token, count in Counter(TOKEN_PATTERN.findall(text.lower())).items():
+        term = _normalize_term(token)
+        if term:
+            counts[term] = counts.get(term, 0) + count
+    return counts
+
+def _template_fields(template: Dict[str, Any]) -> Dict[str, str]:
+    keywords = template.get("keywords") or []
+    if isinstance(keywords, str):
+        keywords = [keywords]
+    return {
+        "name": str(template.get("name", "")),
+        "keywords": " ".join(str(keyword) for keyword in keywords),
+        "description": str(template.get("description", "")),
+        "content": str(template.get("content", "")),
+    }
+
+class BM25Index:
+    """Field-weighted BM25 index over a fixed list of templates.
+
+    The per-document term weights are computed once at build time, so a query
+    only touches the postings of its own terms.
+    """
+
+    def __init__(self, templates: List[Dict[str, Any]], k1: float = 1.5, b: float = 0.75):
+        self.templates = templates
+        self.k1 = k1
+        self.b = b
+
+        term_freqs: List[Dict[str, float]] = []
+        doc_lengths = []
+        for template in templates:
+            freqs: Dict[str, float] = {}
+            length = 0.0
+            for field, text in _template_fields(template).items():
+                weight = FIELD_WEIGHTS[field]
+                for term, count in term_counts(text).items():
+                    freqs[term] = freqs.get(term, 0.0) + weight * count
+                    length += weight * count
+            term_freqs.append(freqs)
+            doc_lengths.append(length)
+
+        doc_count = len(templates)
+        avg_length = (sum(doc_lengths) / doc_count) if doc_count else 0.0
+
+        # term -> list of (document number, saturated term weight)
+        postings: Dict[str, List[Tuple[int, float]]] = {}
+        for doc, freqs in enumerate(term_freqs):
+            norm = k1 * (1 - b + b * doc_lengths[doc] / avg_length) if avg_length else k1
+            for term, tf in freqs.items():
+                postings.setdefault(term, []).append((doc, tf * (k1 + 1) / (tf + norm)))
+
+        self.postings = postings
+        self.idf = {
+            term: math.log(1 + (doc_count - len(docs) + 0.5) / (len(docs) + 0.5))
+            for term, docs in postings.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.templates)
+
+    def search(self, query: str, top_k: int = 3,
+               allowed: Optional[Set[int]] = None) -> List[Tuple[Dict[str, Any], float]]:
+        """Return up to top_k (template, score) pairs with a positive score, best first.
+
+        If allowed is given, only templates whose id() is in it are considered;
+        identities rather than template ids, which may be missing or repeated.
+        """
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            docs = self.postings.get(term)
+            if not docs:
+                continue
+            idf = self.idf[term]
+            for doc, weight in docs:
+                scores[doc] = scores.get(doc, 0.0) + idf * weight
+
+        if allowed is not None:
+            scores = {doc: score for doc, score in scores.items() if id(self.templates[doc]) in allowed}
+
+        # Ties keep library order (lower document number first)
+        best = heapq.nsmallest(top_k, scores.items(), key=lambda item: (-item[1], item[0]))
+        return [(self.templates[doc], score) for doc, score in best]
+
+_INDEX_CACHE_SIZE = 8
+_index_cache: "OrderedDict[Tuple[int, ...], Tuple[List[Dict[str, Any]], BM25Index]]" = OrderedDict()
+_index_cache_lock = threading.Lock()
+
+def get_search_index(templates: List[Dict[str, Any]]) -> BM25Index:
+    """Get a BM25 index for a list of templates, building it only the first time it is seen."""
+    # The cache keeps the template objects alive, so their identities stay unique
+    key = tuple(id(template) for template in templates)
+    with _index_cache_lock:
+        cached = _index_cache.get(key)
+        if cached is not None:
+            _index_cache.move_to_end(key)
+            return cached[1]
+
+    index = BM25Index(templates)
+    with _index_cache_lock:
+        _index_cache[key] = (list(templates), index)
+        while len(_index_cache) > _INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+    return index
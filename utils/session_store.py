@@ -0,0 +1,292 @@
+# utils/session_store.py
+import os
+import json
+import time
+import uuid
+import zlib
+import pickle
+import difflib
+import threading
+from typing import List, Dict, Iterator, Optional, Tuple
+
+# Undo steps kept per session, and the most compressed history bytes a session may hold
+SESSION_MAX_REVISIONS = int(os.environ.get("SESSION_MAX_REVISIONS", "25"))
+SESSION_HISTORY_MAX_BYTES = int(os.environ.get("SESSION_HISTORY_MAX_BYTES", str(256 * 1024)))
+# Chat messages kept per session; the oldest are dropped first
+CHAT_MAX_MESSAGES = int(os.environ.get("CHAT_MAX_MESSAGES", "100"))
+CHAT_MAX_CHARS = int(os.environ.get("CHAT_MAX_CHARS", "50000"))
+CHAT_MAX_MESSAGE_CHARS = 4000
+# Sessions untouched for this many seconds are written to disk and dropped from memory
+SESSION_IDLE_SECONDS = float(os.environ.get("SESSION_IDLE_SECONDS", "600"))
+SESSION_SPILL_DIR = os.environ.get("SESSION_SPILL_DIR", os.path.join(".cache", "sessions"))
+# Spilled sessions nobody came back for are deleted after this many seconds
+SESSION_SPILL_TTL = float(os.environ.get("SESSION_SPILL_TTL", str(7 * 24 * 3600)))
+SWEEP_INTERVAL = 60.0
+
+def _compress(text: str) -> bytes:
+    return zlib.compress(text.encode('utf-8'))
+
+def _decompress(data: bytes) -> str:
+    return zlib.decompress(data).decode('utf-8')
+
+class RevisionHistory:
+    """The current text of a template plus compressed deltas back to its earlier revisions.
+
+    Only the current text is stored whole (compressed). Each earlier revision
+    is a line-based delta that turns its successor back into it, so undo
+    applies the newest delta and the oldest can be evicted without touching
+    the rest.
+    """
+
+    def __init__(self, text: str = "", max_revisions: int = SESSION_MAX_REVISIONS,
+                 max_bytes: int = SESSION_HISTORY_MAX_BYTES):
+        self.max_revisions = max_revisions
+        self.max_bytes = max_bytes
+        self._current = _compress(text)
+        self._deltas: List[bytes] = []
+
+    @property
+    def current(self) -> str:
+        return _decompress(self._current)
+
+    @property
+    def can_undo(self) -> bool:
+        return bool(self._deltas)
+
+    def __len__(self) -> int:
+        """Number of earlier revisions available to undo to."""
+        return len(self._deltas)
+
+    def commit(self, text: str):
+        """Make text the current revision, keeping the previous one for undo."""
+        previous = self.current
+        if text == previous:
+            return
+        self._deltas.append(self._delta(text, previous))
+        self._current = _compress(text)
+        self._evict()
+
+    def reset(self, text: str = ""):
+        """Replace the current text and forget every earlier revision."""
+        self._current = _compress(text)
+        self._deltas = []
+
+    def undo(self) -> Optional[str]:
+        """Go back to the previous revision and return it, or None if there is none."""
+        if not self._deltas:
+            return None
+        previous = self._apply(self.current, self._deltas.pop())
+        self._current = _compress(previous)
+        return previous
+
+    def size(self) -> int:
+        """Compressed bytes held by this history."""
+        return len(self._current) + sum(len(delta) for delta in self._deltas)
+
+    @staticmethod
+    def _delta(new: str, old: str) -> bytes:
+        new_lines = new.splitlines(keepends=True)
+        old_lines = old.splitlines(keepends=True)
+        # (start, end, replacement lines) edits that turn new into old
+        edits = [
+            (i1, i2, "".join(old_lines[j1:j2]))
+            for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, new_lines, old_lines, autojunk=False).get_opcodes()
+            if tag != "equal"
+        ]
+        return zlib.compress(json.dumps(edits, ensure_ascii=False, separators=(",", ":")).encode('utf-8'))
+
+    @staticmethod
+    def _apply(text: str, delta: bytes) -> str:
+        lines = text.splitlines(keepends=True)
+        edits = json.loads(zlib.decompress(delta).decode('utf-8'))
+        # Apply from the end so earlier line numbers stay valid
+        for start, end, replacement in reversed(edits):
+            lines[start:end] = [replacement] if replacement else []
+        return "".join(lines)
+
+    def _evict(self):
+        while self._deltas and (len(self._deltas) > self.max_revisions or self.size() > self.max_bytes):
+            self._deltas.pop(0)
+
+class ChatLog:
+    """A size-limited conversation, stored as (is_user, text) pairs rather than dicts."""
+
+    def __init__(self, max_messages: int = CHAT_MAX_MESSAGES, max_chars: int = CHAT_MAX_CHARS):
+        self.max_messages = max_messages
+        self.max_chars = max_chars
+        self._messages: List[Tuple[bool, str]] = []
+        self._chars = 0
+
+    def append(self, role: str, content: str):
+        if len(content) > CHAT_MAX_MESSAGE_CHARS:
+            content = content[:CHAT_MAX_MESSAGE_CHARS] + "…"
+        self._messages.append((role == "user", content))
+        self._chars += len(content)
+        while len(self._messages) > 1 and (len(self._messages) > self.max_messages or self._chars > self.max_chars):
+            self._chars -= len(self._messages.pop(0)[1])
+
+    def clear(self):
+        self._messages = []
+        self._chars = 0
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        """Messages as {"role": ..., "content": ...} dicts, oldest first."""
+        for is_user, content in self._messages:
+            yield {"role": "user" if is_user else "assistant", "content": content}
+
+class SessionData:
+    """What a session keeps beyond a few scalars: the selected template's registry key, the revisions and the chat."""
+
+    def __init__(self):
+        self.template_key: Optional[str] = None
+        self.revisions = RevisionHistory()
+        self.chat = ChatLog()
+        self.last_access = time.time()
+
+    def __setstate__(self, state):
+        # Sessions spilled before the template key replaced the template id restart at template selection
+        state.pop("template_id", None)
+        state.setdefault("template_key", None)
+        self.__dict__.update(state)
+
+    def reset(self):
+        self.template_key = None
+        self.revisions.reset()
+        self.chat.clear()
+
+class SessionStore:
+    """Process-wide session data, with idle sessions spilled to disk.
+
+    Sessions not accessed for `idle_seconds` are pickled to `spill_dir` and
+    loaded back on their next access. Spilled files older than `spill_ttl`
+    are deleted.
+    """
+
+    def __init__(self, spill_dir: str = SESSION_SPILL_DIR, idle_seconds: float = SESSION_IDLE_SECONDS,
+                 spill_ttl: float = SESSION_SPILL_TTL):
+        self.spill_dir = spill_dir
+        self.idle_seconds = idle_seconds
+        self.spill_ttl = spill_ttl
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, SessionData] = {}
+        self._last_sweep = time.monotonic()
+        self.stats = {"spilled": 0, "restored": 0, "expired": 0}
+
+    @staticmethod
+    def new_session_id() -> str:
+        return uuid.uuid4().hex
+
+    def _spill_path(self, session_id: str) -> str:
+        return os.path.join(self.spill_dir, f"{session_id}.pickle")
+
+    def get(self, session_id: str) -> SessionData:
+        """The data for a session, restored from disk if it was spilled, or new."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._restore(session_id) or SessionData()
+                self._sessions[session_id] = session
+            session.last_access = time.time()
+            sweep = time.monotonic() - self._last_sweep > SWEEP_INTERVAL
+            if sweep:
+                self._last_sweep = time.monotonic()
+        if sweep:
+            self.spill_idle()
+        return session
+
+    def discard(self, session_id: str):
+        """Forget a session, in memory and on disk."""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        try:
+            os.remove(self._spill_path(session_id))
+        except OSError:
+            pass
+
+    def _restore(self, session_id: str) -> Optional[SessionData]:
+        path = self._spill_path(session_id)
+        try:
+            with open(path, 'rb') as file:
+                session = pickle.load(file)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Ignoring unreadable spilled session {path}: {e}")
+            return None
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        self.stats["restored"] += 1
+        return session
+
+    def spill_idle(self, now: Optional[float] = None) -> int:
+        """Write sessions idle for longer than idle_seconds to disk; returns how many were spilled."""
+        now = time.time() if now is None else now
+        with self._lock:
+            idle = {session_id: session for session_id, session in self._sessions.items()
+                    if now - session.last_access > self.idle_seconds}
+            for session_id in idle:
+                del self._sessions[session_id]
+
+        spilled = 0
+        kept = {}
+        if idle:
+            try:
+                os.makedirs(self.spill_dir, exist_ok=True)
+            except OSError as e:
+                print(f"Could not create session spill directory {self.spill_dir}: {e}")
+                kept, idle = idle, {}
+        for session_id, session in idle.items():
+            path = self._spill_path(session_id)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, 'wb') as file:
+                    pickle.dump(session, file, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, path)
+                spilled += 1
+            except OSError as e:
+                print(f"Could not spill session {session_id}: {e}")
+                kept[session_id] = session
+        if kept:
+            # Sessions that couldn't be written stay in memory, unless one was started again meanwhile
+            with self._lock:
+                for session_id, session in kept.items():
+                    self._sessions.setdefault(session_id, session)
+        self.stats["spilled"] += spilled
+        self._expire_spilled(now)
+        return spilled
+
+    def _expire_spilled(self, now: float):
+        try:
+            filenames = os.listdir(self.spill_dir)
+        except FileNotFoundError:
+            return
+        for filename in filenames:
+            path = os.path.join(self.spill_dir, filename)
+            try:
+                if now - os.path.getmtime(path) > self.spill_ttl:
+                    os.remove(path)
+                    self.stats["expired"] += 1
+            except OSError:
+                pass
+
+    def __len__(self) -> int:
+        """Number of sessions held in memory."""
+        with self._lock:
+            return len(self._sessions)
+
+_session_store: Optional[SessionStore] = None
+_session_store_lock = threading.Lock()
+
+def get_session_store() -> SessionStore:
+    """Get the process-wide session store, creating it on first use."""
+    global _session_store
+    if _session_store is None:
+        with _session_store_lock:
+            if _session_store is None:
+                _session_store = SessionStore()
+    return _session_store
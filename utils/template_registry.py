@@ -0,0 +1,296 @@
+# utils/template_registry.py
+import os
+import time
+import hashlib
+import threading
+import yaml
+from typing import List, Dict, Any, Optional, Set
+
+from utils.dimension_definitions import normalize_dimension_values
+from utils.search_index import BM25Index
+from utils.instrumentation import span
+from utils.template_snapshot import TEMPLATE_SNAPSHOT_ENABLED, default_snapshot_path, load_snapshot, save_snapshot
+
+TEMPLATE_EXTENSIONS = (".yaml", ".yml")
+
+# Convert .docx templates into YAML on refresh (see utils/docx_ingest.py); this writes into the template directory
+INGEST_DOCX = os.environ.get("TEMPLATE_INGEST_DOCX", "").lower() in ("1", "true", "yes")
+
+# libyaml's loader is several times faster than the pure-Python one
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+class _TemplateEntry:
+    """A parsed template file together with the stat data used to detect changes."""
+
+    __slots__ = ("path", "mtime_ns", "size", "digest", "template")
+
+    def __init__(self, path: str, mtime_ns: int, size: int, digest: str, template: Optional[Dict[str, Any]]):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.digest = digest
+        self.template = template
+
+class _RegistryIndex:
+    """Immutable set of lookup structures, swapped in as a whole on every rebuild."""
+
+    __slots__ = ("templates", "by_id", "by_key", "keys", "dimensions", "search")
+
+    def __init__(self, templates=None, by_id=None, by_key=None, keys=None, dimensions=None):
+        self.templates: List[Dict[str, Any]] = templates or []
+        self.by_id: Dict[str, Dict[str, Any]] = by_id or {}
+        # File name -> template, and id() of each template -> its file name; unlike
+        # template ids, file names are always present and unique
+        self.by_key: Dict[str, Dict[str, Any]] = by_key or {}
+        self.keys: Dict[int, str] = keys or {}
+        # dimension key -> dimension value -> positions in `templates` of templates with that value,
+        # so templates without a unique id are still filterable
+        self.dimensions: Dict[str, Dict[str, Set[int]]] = dimensions or {}
+        # Built lazily on first search
+        self.search: Optional[BM25Index] = None
+
+class TemplateRegistry:
+    """Process-wide, incrementally refreshed index of the templates on disk.
+
+    Templates are parsed once and indexed by id. On refresh only files whose
+    mtime or size changed are re-read, and only files whose content hash
+    changed are re-parsed.
+
+    If `snapshot_path` is set, the first refresh primes the entries from that
+    snapshot, so a cold start only parses files changed since it was written,
+    and the snapshot is rewritten whenever entries change.
+
+    With `ingest_docx`, new or changed Word documents in the directory are
+    converted to YAML templates before each scan.
+    """
+
+    def __init__(self, template_dir: str = "templates", refresh_interval: float = 2.0,
+                 snapshot_path: Optional[str] = None, ingest_docx: bool = False):
+        self.template_dir = template_dir
+        self.refresh_interval = refresh_interval
+        self.snapshot_path = snapshot_path
+        self.ingest_docx = ingest_docx
+        self.version = 0
+        self._lock = threading.RLock()
+        self._entries: Dict[str, _TemplateEntry] = {}
+        self._index = _RegistryIndex()
+        self._last_refresh = 0.0
+        self._snapshot_dirty = False
+
+    def refresh(self, force: bool = False) -> bool:
+        """Re-scan the template directory, re-parsing only changed files.
+
+        Scans are throttled to one per `refresh_interval` seconds unless
+        `force` is set. Returns True if the set of templates changed.
+        """
+        now = time.monotonic()
+        if not force and self._last_refresh and now - self._last_refresh < self.refresh_interval:
+            return False
+
+        with self._lock:
+            # Another session may have refreshed while we waited for the lock
+            if not force and self._last_refresh and time.monotonic() - self._last_refresh < self.refresh_interval:
+                return False
+            with span("templates.refresh", template_dir=self.template_dir) as current:
+                if self.snapshot_path and not self.version:
+                    self._load_snapshot()
+
+                if self.ingest_docx:
+                    from utils.docx_ingest import sync_docx_templates
+                    sync_docx_templates(self.template_dir)
+
+                changed = False
+                seen = set()
+                try:
+                    dir_entries = list(os.scandir(self.template_dir))
+                except FileNotFoundError:
+                    print(f"Template directory not found: {self.template_dir}")
+                    dir_entries = []
+
+                for dir_entry in dir_entries:
+                    if not dir_entry.name.endswith(TEMPLATE_EXTENSIONS) or not dir_entry.is_file():
+                        continue
+                    seen.add(dir_entry.path)
+                    if self._refresh_entry(dir_entry.path, dir_entry.stat()):
+                        changed = True
+
+                for path in list(self._entries):
+                    if path not in seen:
+                        del self._entries[path]
+                        changed = True
+                        self._snapshot_dirty = True
+
+                if changed or not self.version:
+                    self._rebuild_indexes()
+                    self.version += 1
+                if self._snapshot_dirty and self.snapshot_path:
+                    self.save_snapshot()
+                self._last_refresh = time.monotonic()
+                current.set(files=len(seen), changed=changed, version=self.version)
+                return changed
+
+    def _load_snapshot(self):
+        """Prime entries from the snapshot; refresh() then re-checks each against the disk."""
+        entries = load_snapshot(self.snapshot_path, self.template_dir)
+        if entries is None:
+            self._snapshot_dirty = True
+            return
+        for filename, (mtime_ns, size, digest, template) in entries.items():
+            path = os.path.join(self.template_dir, filename)
+            self._entries[path] = _TemplateEntry(path, mtime_ns, size, digest, template)
+
+    def save_snapshot(self):
+        """Write the current entries to the snapshot file."""
+        with self._lock:
+            entries = {
+                os.path.basename(path): (entry.mtime_ns, entry.size, entry.digest, entry.template)
+                for path, entry in self._entries.items()
+            }
+            try:
+                save_snapshot(self.snapshot_path, self.template_dir, entries)
+            except OSError as e:
+                print(f"Could not write template snapshot {self.snapshot_path}: {e}")
+            self._snapshot_dirty = False
+
+    def _refresh_entry(self, path: str, stat: os.stat_result) -> bool:
+        """Update a single entry from disk. Returns True if its template changed."""
+        entry = self._entries.get(path)
+        if entry and entry.mtime_ns == stat.st_mtime_ns and entry.size == stat.st_size:
+            return False
+
+        try:
+            with open(path, 'rb') as file:
+                raw = file.read()
+        except OSError as e:
+            print(f"Error reading template {os.path.basename(path)}: {e}")
+            return False
+
+        digest = hashlib.sha1(raw).hexdigest()
+        if entry and entry.digest == digest:
+            # Touched but not modified - keep the parsed template
+            entry.mtime_ns = stat.st_mtime_ns
+            entry.size = stat.st_size
+            self._snapshot_dirty = True
+            return False
+
+        try:
+            template = yaml.load(raw.decode('utf-8'), Loader=YAML_LOADER)
+        except Exception as e:
+            print(f"Error loading template {os.path.basename(path)}: {e}")
+            template = None
+
+        self._entries[path] = _TemplateEntry(path, stat.st_mtime_ns, stat.st_size, digest, template)
+        self._snapshot_dirty = True
+        return True
+
+    def _rebuild_indexes(self):
+        templates = []
+        by_id = {}
+        by_key = {}
+        keys = {}
+        dimension_index: Dict[str, Dict[str, Set[int]]] = {}
+        for path in sorted(self._entries):
+            template = self._entries[path].template
+            if not isinstance(template, dict):
+                continue
+            position = len(templates)
+            templates.append(template)
+            by_key[os.path.basename(path)] = template
+            keys[id(template)] = os.path.basename(path)
+            template_id = template.get("id")
+            if template_id is None:
+                print(f"Template {os.path.basename(path)} has no id; it can't be looked up by id")
+            elif template_id in by_id:
+                print(f"Template {os.path.basename(path)} repeats id {template_id!r}; lookups by id return the first")
+            else:
+                by_id[template_id] = template
+
+            dimensions = template.get("dimensions") or {}
+            for key, value in dimensions.items():
+                values_index = dimension_index.setdefault(str(key).lower(), {})
+                for normalized in normalize_dimension_values(value):
+                    values_index.setdefault(normalized, set()).add(position)
+
+        # Swap in a new index so readers never see a half-built one
+        self._index = _RegistryIndex(templates, by_id, by_key, keys, dimension_index)
+
+    def all(self) -> List[Dict[str, Any]]:
+        """Return all templates, ordered by file name."""
+        self.refresh()
+        return self._index.templates
+
+    def get(self, template_id: str) -> Optional[Dict[str, Any]]:
+        """Look up a template by id."""
+        self.refresh()
+        return self._index.by_id.get(template_id)
+
+    def key_of(self, template: Dict[str, Any]) -> Optional[str]:
+        """A key that identifies one of the current templates even without a unique id: its file name."""
+        return self._index.keys.get(id(template))
+
+    def get_by_key(self, key: str) -> Optional[Dict[str, Any]]:
+        """Look up a template by the key from key_of()."""
+        self.refresh()
+        return self._index.by_key.get(key)
+
+    def filter_by_dimensions(self, scale: str = None, engagement: str = None,
+                             **dimensions: str) -> List[Dict[str, Any]]:
+        """Return templates matching every given dimension, in registry order.
+
+        Any dimension key present in the template YAML can be passed as a
+        keyword argument; None or empty values are ignored.
+        """
+        self.refresh()
+        index = self._index
+        criteria = dict(dimensions, scale=scale, engagement=engagement)
+        criteria = {key.lower(): value for key, value in criteria.items() if value}
+        if not criteria:
+            return index.templates
+
+        candidate_sets = []
+        for key, value in criteria.items():
+            positions = index.dimensions.get(key, {}).get(str(value).strip().lower())
+            if not positions:
+                return []
+            candidate_sets.append(positions)
+
+        # Intersect starting from the smallest set
+        candidate_sets.sort(key=len)
+        matches = set(candidate_sets[0])
+        for positions in candidate_sets[1:]:
+            matches &= positions
+            if not matches:
+                return []
+
+        return [index.templates[position] for position in sorted(matches)]
+
+    def search_index(self) -> BM25Index:
+        """Return the full-text search index for the current templates, building it on first use."""
+        self.refresh()
+        index = self._index
+        if index.search is None:
+            with self._lock:
+                if index.search is None:
+                    with span("templates.build_search_index", templates=len(index.templates)):
+                        index.search = BM25Index(index.templates)
+        return index.search
+
+    def __len__(self) -> int:
+        self.refresh()
+        return len(self._index.templates)
+
+_registries: Dict[str, TemplateRegistry] = {}
+_registries_lock = threading.Lock()
+
+def get_registry(template_dir: str = "templates") -> TemplateRegistry:
+    """Get the shared registry for a template directory, creating it on first use."""
+    key = os.path.abspath(template_dir)
+    registry = _registries.get(key)
+    if registry is None:
+        with _registries_lock:
+            registry = _registries.get(key)
+            if registry is None:
+                snapshot_path = default_snapshot_path(template_dir) if TEMPLATE_SNAPSHOT_ENABLED else None
+                registry = TemplateRegistry(template_dir, snapshot_path=snapshot_path, ingest_docx=INGEST_DOCX)
+                _registries[key] = registry
+    return registry
@@ -0,0 +1,87 @@
+# utils/template_snapshot.py
+"""Binary snapshot of the parsed template library.
+
+Build one ahead of deployment so cold starts load a single file instead of
+parsing every YAML template:
+
+    python -m utils.template_snapshot [template_dir] [--output PATH]
+
+The registry also keeps the snapshot up to date whenever it re-parses
+templates, and on startup only re-parses files whose mtime/size no longer
+match the snapshot's manifest.
+"""
+import os
+import sys
+import pickle
+import hashlib
+import argparse
+from typing import Dict, Any, Optional, Tuple
+
+# Bump when the snapshot layout or the parsed template format changes
+SNAPSHOT_VERSION = 1
+
+TEMPLATE_SNAPSHOT_ENABLED = os.environ.get("TEMPLATE_SNAPSHOT", "1").lower() not in ("0", "false", "no")
+SNAPSHOT_DIR = os.environ.get("TEMPLATE_SNAPSHOT_DIR", ".cache")
+
+# filename -> (mtime_ns, size, sha1 of the raw file, parsed template)
+SnapshotEntries = Dict[str, Tuple[int, int, str, Optional[Dict[str, Any]]]]
+
+def default_snapshot_path(template_dir: str) -> str:
+    """Snapshot location for a template directory, unique per absolute path."""
+    key = hashlib.sha1(os.path.abspath(template_dir).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(SNAPSHOT_DIR, f"templates-{key}.snapshot")
+
+def load_snapshot(path: str, template_dir: str) -> Optional[SnapshotEntries]:
+    """Load snapshot entries, or None if the file is missing, stale or from another directory."""
+    try:
+        with open(path, 'rb') as file:
+            snapshot = pickle.load(file)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Ignoring unreadable template snapshot {path}: {e}")
+        return None
+
+    if (not isinstance(snapshot, dict) or snapshot.get("version") != SNAPSHOT_VERSION
+            or snapshot.get("template_dir") != os.path.abspath(template_dir)):
+        return None
+    return snapshot["entries"]
+
+def save_snapshot(path: str, template_dir: str, entries: SnapshotEntries):
+    """Atomically write snapshot entries."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "template_dir": os.path.abspath(template_dir),
+        "entries": entries,
+    }
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as file:
+        pickle.dump(snapshot, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def build_snapshot(template_dir: str = "templates", path: str = None) -> str:
+    """Parse the whole template library (re-using an existing snapshot) and write a fresh one."""
+    from utils.template_registry import TemplateRegistry
+
+    path = path or default_snapshot_path(template_dir)
+    registry = TemplateRegistry(template_dir, snapshot_path=path)
+    registry.refresh(force=True)
+    registry.save_snapshot()
+    return path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compile the YAML template library into a binary snapshot.")
+    parser.add_argument("template_dir", nargs="?", default="templates")
+    parser.add_argument("--output", help="snapshot file (default: under TEMPLATE_SNAPSHOT_DIR)")
+    args = parser.parse_args(argv)
+
+    path = build_snapshot(args.template_dir, args.output)
+    entries = load_snapshot(path, args.template_dir) or {}
+    print(f"Wrote {len(entries)} templates to {path}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
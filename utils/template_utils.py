@@ -2,8 +2,16 @@
 import os
 import yaml
 import re
-from typing import List, Dict, Any
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Callable, Iterable
 
+from utils.template_registry import get_registry, YAML_LOADER
+from utils.dimension_definitions import normalize_dimension_values
+from utils.instrumentation import instrumented
+
+@instrumented("templates.load_all")
 def load_all_templates(template_dir: str = "templates") -> List[Dict[str, Any]]:
     """Load all template YAML files from the templates directory."""
     templates = []
@@ -12,85 +20,137 @@ def load_all_templates(template_dir: str = "templates") -> List[Dict[str, Any]]:
             file_path = os.path.join(template_dir, filename)
             try:
                 with open(file_path, 'r', encoding='utf-8') as file:
-                    template = yaml.safe_load(file)
+                    template = yaml.load(file, Loader=YAML_LOADER)
                     templates.append(template)
             except Exception as e:
                 print(f"Error loading template {filename}: {e}")
     return templates
 
+@instrumented("templates.get")
 def get_template_by_id(template_id: str, template_dir: str = "templates") -> Dict[str, Any]:
-    """Get a specific template by its ID."""
-    templates = load_all_templates(template_dir)
-    for template in templates:
-        if template.get("id") == template_id:
-            return template
-    return None
+    """Get a specific template by its ID from the shared template registry."""
+    return get_registry(template_dir).get(template_id)
 
-def fill_template(template: Dict[str, Any], variables: Dict[str, str]) -> str:
-    """Fill a template with user-provided variables."""
-    content = template.get("content", "")
-    
-    # Replace all variables in the content
-    for key, value in variables.items():
-        placeholder = "{{" + key + "}}"
-        content = content.replace(placeholder, value)
-    
-    # Find any remaining placeholders that weren't filled
-    remaining_placeholders = re.findall(r'{{([^}]+)}}', content)
-    
-    # If there are remaining placeholders, add them to the variables dict with empty strings
-    if remaining_placeholders:
-        for placeholder in remaining_placeholders:
-            content = content.replace("{{" + placeholder + "}}", "")
-    
-    return content
+# Matches an escaped "\{{" (kept as a literal "{{") or a "{{name}}" / "{{name|default}}" placeholder
+PLACEHOLDER_PATTERN = re.compile(r'\\{{|{{([^}]+)}}')
+
+MARKDOWN_SPECIAL_CHARS = re.compile(r'([\\`*_{}\[\]<>()#+!|])')
+
+def escape_markdown(value: str) -> str:
+    """Escape characters that markdown would otherwise interpret, for use as a render escape."""
+    return MARKDOWN_SPECIAL_CHARS.sub(r'\\\1', value)
+
+class CompiledTemplate:
+    """Template content parsed once into literal and placeholder segments.
+
+    Rendering fills the placeholder slots of a copy of the segment list and
+    joins it once, instead of copying the whole content for every variable.
+    """
+
+    __slots__ = ("segments", "slots", "variables")
+
+    def __init__(self, content: str):
+        segments: List[str] = []
+        slots = []  # (segment index, variable name, default)
+        literal_start = 0
+        for match in PLACEHOLDER_PATTERN.finditer(content):
+            if match.group(1) is None:
+                # Escaped braces stay as literal text
+                segments.append(content[literal_start:match.start()] + "{{")
+            else:
+                segments.append(content[literal_start:match.start()])
+                name, _, default = match.group(1).partition("|")
+                slots.append((len(segments), name.strip(), default.strip()))
+                segments.append("")
+            literal_start = match.end()
+        segments.append(content[literal_start:])
+
+        self.segments = segments
+        self.slots = slots
+        # Unique variable names in order of first appearance
+        self.variables = list(dict.fromkeys(name for _, name, _ in slots))
 
+    def render(self, variables: Dict[str, str], escape: Callable[[str], str] = None) -> str:
+        """Fill the placeholders; unknown variables get their default, or an empty string."""
+        parts = self.segments.copy()
+        for index, name, default in self.slots:
+            value = variables.get(name)
+            if value is None:
+                parts[index] = default
+            else:
+                parts[index] = escape(str(value)) if escape else str(value)
+        return "".join(parts)
+
+    def render_many(self, variable_sets: Iterable[Dict[str, str]],
+                    escape: Callable[[str], str] = None) -> List[str]:
+        """Render the template once for each set of variables."""
+        return [self.render(variables, escape) for variables in variable_sets]
+
+_COMPILED_CACHE_SIZE = 256
+_compiled_cache: "OrderedDict[str, CompiledTemplate]" = OrderedDict()
+_compiled_cache_lock = threading.Lock()
+
+def compile_template(content: str) -> CompiledTemplate:
+    """Get the compiled form of template content, cached by content hash."""
+    key = hashlib.sha1(content.encode('utf-8')).hexdigest()
+    with _compiled_cache_lock:
+        compiled = _compiled_cache.get(key)
+        if compiled is not None:
+            _compiled_cache.move_to_end(key)
+            return compiled
+
+    compiled = CompiledTemplate(content)
+    with _compiled_cache_lock:
+        _compiled_cache[key] = compiled
+        while len(_compiled_cache) > _COMPILED_CACHE_SIZE:
+            _compiled_cache.popitem(last=False)
+    return compiled
+
+@instrumented("templates.fill")
+def fill_template(template: Dict[str, Any], variables: Dict[str, str],
+                  escape: Callable[[str], str] = None) -> str:
+    """Fill a template with user-provided variables.
+
+    Placeholders without a value are replaced by their default
+    ({{name|default}}) or removed.
+    """
+    return compile_template(template.get("content", "")).render(variables, escape)
+
+def render_template_batch(template: Dict[str, Any], variable_sets: Iterable[Dict[str, str]],
+                          escape: Callable[[str], str] = None) -> List[str]:
+    """Fill one template with many sets of variables, e.g. one handout per table."""
+    return compile_template(template.get("content", "")).render_many(variable_sets, escape)
+
+@instrumented("templates.extract_variables")
 def extract_template_variables(template: Dict[str, Any]) -> List[str]:
     """Extract all variable placeholders from a template."""
-    content = template.get("content", "")
-    placeholders = re.findall(r'{{([^}]+)}}', content)
-    return list(set(placeholders))  # Remove duplicates
+    return list(compile_template(template.get("content", "")).variables)
 
+@instrumented("templates.filter")
 def filter_templates_by_dimensions(templates: List[Dict[str, Any]], 
                                  scale: str = None, 
-                                 engagement: str = None) -> List[Dict[str, Any]]:
-    """Filter templates based on scale and engagement levels."""
-    if not scale and not engagement:
+                                 engagement: str = None,
+                                 **dimensions: str) -> List[Dict[str, Any]]:
+    """Filter templates based on scale, engagement and any other dimension levels.
+
+    This scans the given list; for the full library use the registry's
+    filter_by_dimensions, which answers from a precomputed index.
+    """
+    criteria = dict(dimensions, scale=scale, engagement=engagement)
+    criteria = {key.lower(): str(value).strip().lower() for key, value in criteria.items() if value}
+    if not criteria:
         return templates
     
     filtered_templates = []
     
     for template in templates:
-        dimensions = template.get("dimensions", {})
+        template_dimensions = {
+            str(key).lower(): value for key, value in (template.get("dimensions") or {}).items()
+        }
         
-        # Check if template matches scale criteria
-        if scale:
-            template_scale = dimensions.get("scale")
-            # Handle case where scale is a list or a string
-            if isinstance(template_scale, list) and scale in template_scale:
-                scale_match = True
-            elif template_scale == scale:
-                scale_match = True
-            else:
-                scale_match = False
-        else:
-            scale_match = True
-            
-        # Check if template matches engagement criteria
-        if engagement:
-            template_engagement = dimensions.get("engagement")
-            # Handle case where engagement is a list or a string
-            if isinstance(template_engagement, list) and engagement in template_engagement:
-                engagement_match = True
-            elif template_engagement == engagement:
-                engagement_match = True
-            else:
-                engagement_match = False
-        else:
-            engagement_match = True
-            
-        # Include template if it matches both criteria
-        if scale_match and engagement_match:
+        # Include template if it matches every criterion; list and scalar values are both handled
+        if all(value in normalize_dimension_values(template_dimensions.get(key))
+               for key, value in criteria.items()):
             filtered_templates.append(template)
             
-    return filtered_templates
\ No newline at end of file
+    return filtered_templates